@@ -4,6 +4,9 @@ from io import BytesIO
 from pdf2image import convert_from_bytes
 import pytesseract
 
+from app.services import extraction_cache, extraction_executor
+from app.utils import timing
+
 router = APIRouter()
 
 @router.post("/debug/extract-text")
@@ -27,3 +30,19 @@ async def debug_extract_text(file: UploadFile = File(...)):
         "sample_pdfminer": pdfminer_text[:600],
         "sample_ocr": ocr_text[:600]
     }
+
+
+@router.get("/debug/cache")
+def debug_cache_stats():
+    return extraction_cache.stats()
+
+
+@router.get("/debug/timings")
+def debug_timings():
+    # istogrammi per fase dall'avvio del processo
+    return timing.histograms()
+
+
+@router.get("/debug/executor")
+def debug_executor():
+    return extraction_executor.stats()
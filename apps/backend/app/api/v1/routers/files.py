@@ -0,0 +1,36 @@
+import os
+import time
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import FileResponse
+
+from app.services import storage, storage_local
+
+# File del backend di storage locale, serviti tramite gli URL firmati di
+# storage_local.presigned_url (equivalenti degli URL presigned di S3).
+router = APIRouter(prefix="/files", tags=["files"])
+
+
+@router.get("/{bucket}/{key:path}")
+def get_file(
+    bucket: str,
+    key: str,
+    expires: int = Query(...),
+    signature: str = Query(...),
+    disposition: str = Query(""),
+    content_type: str = Query(""),
+):
+    if not storage.is_local():
+        raise HTTPException(status_code=404, detail="Not found")
+    if not storage_local.verify(bucket, key, expires, signature, disposition, content_type):
+        raise HTTPException(status_code=403, detail="Invalid or expired signature")
+    try:
+        path = storage_local.object_path(key, bucket)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Not found")
+    headers = {"Cache-Control": f"private, max-age={max(0, expires - int(time.time()))}"}
+    if disposition:
+        headers["Content-Disposition"] = disposition
+    return FileResponse(path, media_type=content_type or "application/octet-stream", headers=headers)
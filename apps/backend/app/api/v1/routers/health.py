@@ -5,34 +5,17 @@ from typing import Dict, Any
 # DB
 from app.services.db import execute
 
-# S3/MinIO
-import boto3
-from botocore.client import Config
+# S3/MinIO (client condiviso di app/services/storage.py)
+from app.services import storage
+from app.services.storage import S3_ENDPOINT
 
 # Redis
 import redis
 
-router = APIRouter(prefix="/health", tags=["health"])
-
-
-def _s3_client():
-    endpoint = (
-        os.getenv("S3_ENDPOINT")
-        or os.getenv("MINIO_ENDPOINT")
-        or "http://minio:9000"
-    )
-    access_key = os.getenv("S3_ACCESS_KEY") or os.getenv("MINIO_ACCESS_KEY") or "minioadmin"
-    secret_key = os.getenv("S3_SECRET_KEY") or os.getenv("MINIO_SECRET_KEY") or "minioadmin"
-    region = os.getenv("S3_REGION") or "us-east-1"
+# OCR
+from app.services import ocr_executor
 
-    return boto3.client(
-        "s3",
-        endpoint_url=endpoint,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        region_name=region,
-        config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-    )
+router = APIRouter(prefix="/health", tags=["health"])
 
 
 def _ok(data: Dict[str, Any] = None):
@@ -57,10 +40,8 @@ def health_root():
 
     # S3/MinIO
     try:
-        s3 = _s3_client()
-        # list_buckets come "ping"
-        s3.list_buckets()
-        out["s3"] = _ok({"endpoint": os.getenv("S3_ENDPOINT") or os.getenv("MINIO_ENDPOINT")})
+        storage.ping()  # list_buckets
+        out["s3"] = _ok({"endpoint": S3_ENDPOINT})
     except Exception as e:
         out["s3"] = _down(str(e))
 
@@ -87,11 +68,10 @@ def health_db():
 
 
 @router.get("/s3")
-def health_s3():
+async def health_s3():
     try:
-        s3 = _s3_client()
-        s3.list_buckets()
-        return _ok({"endpoint": os.getenv("S3_ENDPOINT") or os.getenv("MINIO_ENDPOINT")})
+        await storage.aping()
+        return _ok({"endpoint": S3_ENDPOINT})
     except Exception as e:
         return _down(str(e))
 
@@ -104,3 +84,11 @@ def health_redis():
         return _ok()
     except Exception as e:
         return _down(str(e))
+
+
+@router.get("/ocr")
+def health_ocr():
+    try:
+        return _ok(ocr_executor.health())
+    except Exception as e:
+        return _down(str(e))
@@ -1,23 +1,25 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query
-import uuid
+import json
 import os
-import mimetypes
-from typing import List, Optional
+import zipfile
+from functools import partial
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
 from uuid import UUID
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment
 from openpyxl.utils import get_column_letter
 from datetime import datetime
-from app.services.storage import upload_bytes
-from app.services.repository_invoices import insert_invoice_header, insert_invoice_lines
-from app.services.parsers.invoice_xml import parse_xml_fatturapa
-from app.services.parsers.invoice_pdf import parse_pdf_invoice
+from app.services import extraction_executor, jobs
+from app.services.extraction import extract_document, remove_upload, save_upload, store_upload
+from app.core.config import settings
+from app.utils import timing
 
 from app.schemas.invoice import (
-    InvoiceOut, InvoiceListItem, InvoiceListResponse, PresignedUrlOut
+    InvoiceOut, InvoiceListItem, InvoiceListResponse, JobOut, PresignedUrlOut,
+    PresignBatchIn, PresignBatchOut,
 )
 from app.services.invoice_service import (
-    list_invoices, get_invoice, get_presigned_url
+    list_invoices, get_invoice, presign, presign_preview, presign_invoices, delete_invoice
 )
 
 from fastapi import Response
@@ -29,118 +31,233 @@ from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 
 router = APIRouter(prefix="/invoices", tags=["invoices"])
-IS_TESTING = os.getenv("TESTING") == "1"
 
 
-def _merge_defaults(parsed: dict) -> dict:
-    fields = parsed.get("fields", {}) or {}
-    fields.setdefault("valuta", "EUR")
-    parsed["fields"] = fields
-    parsed.setdefault("righe", [])
-    return parsed
+def _busy() -> HTTPException:
+    # coda piena: meglio un 429 immediato che richieste accumulate in attesa
+    return HTTPException(
+        status_code=429,
+        detail="Too many extractions in progress",
+        headers={"Retry-After": str(settings.extract_retry_after_s)},
+    )
 
 
-def _to_float_safe(x) -> Optional[float]:
+@router.post("/extract", response_model=Union[InvoiceOut, List[InvoiceOut], JobOut])
+async def extract_invoice(
+    response: Response,
+    file: UploadFile = File(...),
+    timings: bool = Query(False, description="include i tempi per fase (ms) nella risposta"),
+    async_mode: bool = Query(False, alias="async", description="accoda un job e risponde subito (202) con il suo id"),
+):
+    """
+    Estrae e salva la fattura; per un lotto XML la risposta è una lista di
+    InvoiceOut. Con ?async=1 il file viene caricato su S3, l'estrazione va in
+    coda (app/cli/worker.py) e l'esito si legge da GET /invoices/jobs/{id}.
+    """
+    if not extraction_executor.try_acquire():
+        raise _busy()
+    path = None
     try:
-        if x is None:
-            return None
-        if isinstance(x, (int, float)):
-            return float(x)
-        s = str(x).replace(".", "").replace(",", ".").replace("%", "").strip()
-        return float(s)
-    except Exception:
-        return None
-
-
-def _backfill_amounts(fields: dict) -> dict:
-    imp = _to_float_safe(fields.get("imponibile"))
-    iva = _to_float_safe(fields.get("iva"))
-    tot = _to_float_safe(fields.get("totale"))
-
-    if imp is None and iva is not None and tot is not None:
-        base = round(tot - iva, 2)
-        if base >= 0:
-            imp = base
-    elif iva is None and imp is not None and tot is not None:
-        tax = round(tot - imp, 2)
-        if tax >= 0:
-            iva = tax
-    elif tot is None and imp is not None and iva is not None:
-        tot = round(imp + iva, 2)
-
-    if imp is not None and iva is not None:
-        calc = round(imp + iva, 2)
-        if tot is None or abs(calc - tot) <= 0.05:
-            tot = calc
-
-    fields["imponibile"] = imp
-    fields["iva"] = iva
-    fields["totale"] = tot
-    return fields
-
-
-@router.post("/extract", response_model=InvoiceOut)
-async def extract_invoice(file: UploadFile = File(...)):
+        with timing.collect() as rec:
+            with timing.span("read"):
+                # l'upload resta su disco: parser e S3 (multipart) leggono il file
+                try:
+                    path = await extraction_executor.run_io(save_upload, file.file, file.filename)
+                except ValueError as e:
+                    raise HTTPException(status_code=413, detail=str(e))
+            if async_mode:
+                s3 = await extraction_executor.run_io(store_upload, path, file.filename, file.content_type)
+                job_id = await extraction_executor.run_io(jobs.enqueue, file.filename, file.content_type, s3)
+                response.status_code = 202
+                return JobOut(id=job_id, status="queued", filename=file.filename)
+            # parsing (pool di processi), S3 e DB fuori dall'event loop
+            out = await extraction_executor.run_io(extract_document, path, file.filename, file.content_type)
+
+        if settings.server_timing_enabled:
+            response.headers["Server-Timing"] = rec.server_timing()
+        if timings:
+            for inv in out:
+                inv.timings = rec.as_dict()
+        return out[0] if len(out) == 1 else out
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if path is not None:
+            remove_upload(path)
+        extraction_executor.release()
+
+
+ARCHIVE_TYPES = {".pdf": "application/pdf", ".xml": "application/xml"}
+
+
+def _archive_entry(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> Dict[str, Any]:
+    # un documento rotto non ferma l'archivio: l'errore finisce nella sua riga
+    name = info.filename
+    content_type = ARCHIVE_TYPES[os.path.splitext(name)[1].lower()]
     try:
-        file_bytes = await file.read()
-
-        name_lower = (file.filename or "").lower()
-        content_type = (file.content_type or "").lower()
-        if name_lower.endswith(".xml") or "xml" in content_type:
-            parsed = parse_xml_fatturapa(file_bytes)
-        elif name_lower.endswith(".pdf") or "pdf" in content_type:
-            parsed = parse_pdf_invoice(file_bytes)
-        else:
-            parsed = {"fields": {"valuta": "EUR"}, "righe": []}
-
-        parsed = _merge_defaults(parsed)
-        parsed["fields"] = _backfill_amounts(parsed["fields"])
-        f = parsed["fields"]
-
-        fake_s3 = {"bucket": "test-bucket", "key": f"invoices/{uuid.uuid4()}_{file.filename or 'file'}"}
-        upload_result = None
+        if info.file_size > settings.archive_max_entry_bytes:
+            raise ValueError("documento troppo grande")
+        # decompresso qui, nel thread: i documenti piccoli restano in memoria,
+        # gli altri scendono a blocchi su disco. ZipExtFile non legge oltre
+        # la dimensione dichiarata (se mente, il CRC fallisce)
+        path = None
+        with zf.open(info) as member:
+            if info.file_size <= settings.archive_spool_bytes:
+                source = member.read()
+            else:
+                source = path = save_upload(member, name)
         try:
-            file_id = str(uuid.uuid4())
-            s3_key = f"invoices/{file_id}_{file.filename}"
-            upload_result = upload_bytes(s3_key, file_bytes, content_type=(file.content_type or "application/octet-stream"))
-        except Exception:
-            if not IS_TESTING:
-                raise
-            upload_result = fake_s3
+            out = extract_document(source, os.path.basename(name), content_type)
+        finally:
+            if path is not None:
+                remove_upload(path)
+    except Exception as e:
+        return {"entry": name, "status": "error", "error": f"{type(e).__name__}: {e}"}
+    return {"entry": name, "status": "ok", "invoices": [inv.model_dump(mode="json", exclude_none=True) for inv in out]}
+
+
+def _ndjson(obj: Dict[str, Any]) -> bytes:
+    return (json.dumps(obj, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+async def _archive_results(zf: zipfile.ZipFile, spool, slots: int) -> AsyncIterator[bytes]:
+    """
+    Una riga NDJSON per documento, nell'ordine in cui finiscono, poi un
+    riepilogo. I documenti si decomprimono dallo ZIP uno alla volta (in
+    memoria fino a `archive_spool_bytes`, altrimenti in un file temporaneo) e
+    al massimo `slots` (i posti prenotati, non più di `archive_concurrency`)
+    sono in elaborazione insieme.
+    """
+    summary = {"entries": 0, "ok": 0, "errors": 0, "skipped": 0}
+
+    def entries():
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            if os.path.splitext(info.filename)[1].lower() not in ARCHIVE_TYPES or summary["entries"] >= settings.archive_max_entries:
+                summary["skipped"] += 1
+                continue
+            summary["entries"] += 1
+            yield partial(_archive_entry, zf, info)
 
-        invoice_uuid = str(uuid.uuid4())
+    try:
+        async for res in extraction_executor.map_unordered(entries(), slots):
+            summary["ok" if res["status"] == "ok" else "errors"] += 1
+            yield _ndjson(res)
+        yield _ndjson({"summary": summary})
+    finally:
+        zf.close()
+        spool.close()
+        extraction_executor.release(slots)
+
+
+@router.post("/extract/archive")
+async def extract_archive(file: UploadFile = File(...)):
+    """
+    Estrae tutti i PDF/XML di un archivio ZIP. La risposta è NDJSON: una riga
+    per documento ({"entry", "status", "invoices" | "error"}) man mano che
+    finiscono, e per ultima {"summary": {...}}.
+    """
+    # FastAPI chiude i file del form prima di inviare una StreamingResponse:
+    # il file temporaneo dell'upload passa al generatore, che lo chiude a fine
+    # archivio
+    spool, file.file = file.file, BytesIO()
+    try:
+        zf = zipfile.ZipFile(spool)
+    except (zipfile.BadZipFile, OSError):
+        spool.close()
+        raise HTTPException(status_code=400, detail="Invalid ZIP archive")
+    # un posto per ogni documento in parallelo: se ne restano meno si lavora
+    # con quelli, se non ce n'è nessuno 429 come /extract; tornano a fine stream
+    slots = extraction_executor.try_acquire(settings.archive_concurrency)
+    if not slots:
+        zf.close()
+        spool.close()
+        raise _busy()
+    return StreamingResponse(_archive_results(zf, spool, slots), media_type="application/x-ndjson")
+
+
+def _batch_entry(spool, filename: Optional[str], content_type: Optional[str]) -> List[Dict[str, Any]]:
+    try:
+        path = save_upload(spool, filename)
         try:
-            insert_invoice_header(
-                id=invoice_uuid,
-                s3_bucket=upload_result["bucket"],
-                s3_key=upload_result["key"],
-                filename=file.filename,
-                invoice_number=f.get("invoice_number"),
-                intestatario=f.get("intestatario"),
-                partita_iva=f.get("partita_iva"),
-                codice_fiscale=f.get("codice_fiscale"),
-                issue_date=f.get("data_emissione"),
-                due_date=f.get("data_scadenza"),
-                currency=f.get("valuta", "EUR"),
-                imponibile=f.get("imponibile"),
-                iva=f.get("iva"),
-                totale=f.get("totale"),
-            )
-            insert_invoice_lines(invoice_id=invoice_uuid, lines=parsed.get("righe", []))
-        except Exception:
-            if not IS_TESTING:
-                raise
+            out = extract_document(path, filename, content_type)
+        finally:
+            remove_upload(path)
+        return [inv.model_dump(mode="json", exclude_none=True) for inv in out]
+    except Exception as e:
+        return [{"filename": filename, "error": f"{type(e).__name__}: {e}"}]
+    finally:
+        spool.close()
 
-        return InvoiceOut(
-            id=invoice_uuid,
-            s3=upload_result,
-            filename=file.filename,
-            fields=f,
-            righe=parsed.get("righe", []),
-        )
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def _batch_results(uploads: List[tuple], slots: int) -> AsyncIterator[bytes]:
+    """Un InvoiceOut per riga (o {"filename", "error"}) man mano che i file finiscono."""
+    calls = (partial(_batch_entry, *u) for u in uploads)
+    try:
+        async for rows in extraction_executor.map_unordered(calls, slots):
+            for row in rows:
+                yield _ndjson(row)
+    finally:
+        for spool, _name, _ct in uploads:
+            spool.close()
+        extraction_executor.release(slots)
+
+
+@router.post("/extract/batch")
+async def extract_batch(files: List[UploadFile] = File(...)):
+    """
+    Estrae più file caricati in un'unica richiesta multipart, con lo stesso
+    flusso di /extract e al più `batch_concurrency` file in parallelo (client
+    S3 e connessioni Postgres condivisi). La risposta è NDJSON: un InvoiceOut
+    per riga (più righe per un lotto XML), o {"filename", "error"} per un file
+    fallito, nell'ordine in cui finiscono.
+    """
+    if len(files) > settings.batch_max_files:
+        raise HTTPException(status_code=413, detail=f"Too many files (max {settings.batch_max_files})")
+    # come per gli archivi: un posto per ogni file in parallelo, 429 se non
+    # ce n'è nessuno
+    slots = extraction_executor.try_acquire(min(settings.batch_concurrency, len(files)))
+    if not slots:
+        raise _busy()
+    # i file temporanei dell'upload passano al generatore
+    uploads = []
+    for f in files:
+        uploads.append((f.file, f.filename, f.content_type))
+        f.file = BytesIO()
+    return StreamingResponse(_batch_results(uploads, slots), media_type="application/x-ndjson")
+
+
+@router.post("/presign", response_model=PresignBatchOut)
+def presign_batch_route(body: PresignBatchIn):
+    """
+    URL di download e/o anteprima per molte fatture in una richiesta (es. una
+    pagina della lista): una query per tutti gli id, firme dalla cache quando
+    possibile. Gli id inesistenti finiscono in `missing`.
+    """
+    if len(body.ids) > settings.presign_max_ids:
+        raise HTTPException(status_code=413, detail=f"Too many ids (max {settings.presign_max_ids})")
+    ids = list(dict.fromkeys(str(i) for i in body.ids))
+    items, missing = presign_invoices(ids, body.expires_in, download=body.download, preview=body.preview)
+    return PresignBatchOut(items=items, missing=missing)
+
+
+@router.get("/jobs/{job_id}", response_model=JobOut)
+def get_job_route(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return JobOut(
+        id=job["id"],
+        status=job["status"],
+        attempts=job["attempts"],
+        filename=job["filename"],
+        error=job["error"],
+        result=job["result"],
+    )
 
 
 @router.get("", response_model=InvoiceListResponse)
@@ -184,6 +301,17 @@ def get_invoice_route(invoice_id: UUID):
     )
 
 
+@router.delete("/{invoice_id}", status_code=204)
+def delete_invoice_route(invoice_id: UUID):
+    """
+    Cancella fattura e righe. Il file su S3 viene rimosso solo se nessun'altra
+    fattura lo referenzia (lotti, layout per contenuto).
+    """
+    if not delete_invoice(str(invoice_id)):
+        raise HTTPException(status_code=404, detail="Invoice not found")
+    return Response(status_code=204)
+
+
 @router.get("/{invoice_id}/download", response_model=PresignedUrlOut)
 def download_invoice_route(
     invoice_id: UUID,
@@ -192,10 +320,11 @@ def download_invoice_route(
     inv = get_invoice(str(invoice_id))
     if not inv:
         raise HTTPException(status_code=404, detail="Invoice not found")
-    url = get_presigned_url(bucket=inv["s3"]["bucket"], key=inv["s3"]["key"], expires_in=expires_in)
-    if not url:
+    signed = presign(bucket=inv["s3"]["bucket"], key=inv["s3"]["key"], expires_in=expires_in)
+    if not signed:
         raise HTTPException(status_code=500, detail="Unable to generate presigned URL")
-    return PresignedUrlOut(url=url, expires_in=expires_in)
+    # expires_in: validità residua (l'URL può venire dalla cache)
+    return PresignedUrlOut(url=signed[0], expires_in=signed[1])
 
 
 @router.get("/{invoice_id}/preview", response_model=PresignedUrlOut)
@@ -206,23 +335,10 @@ def preview_invoice_route(
     inv = get_invoice(str(invoice_id))
     if not inv:
         raise HTTPException(status_code=404, detail="Unable to find invoice")
-
-    filename = inv.get("filename") or ""
-    key = inv["s3"]["key"]
-    guessed, _ = mimetypes.guess_type(filename or key)
-    content_type = guessed or "application/octet-stream"
-
-    url = get_presigned_url(
-        bucket=inv["s3"]["bucket"],
-        key=key,
-        expires_in=expires_in,
-        inline=True,
-        content_type=content_type,
-        filename=filename,
-    )
-    if not url:
+    signed = presign_preview(inv["s3"], inv.get("filename") or "", expires_in)
+    if not signed:
         raise HTTPException(status_code=500, detail="Unable to generate preview URL")
-    return PresignedUrlOut(url=url, expires_in=expires_in)
+    return PresignedUrlOut(url=signed[0], expires_in=signed[1])
 
 
 # ========= ESPORTAZIONI =========
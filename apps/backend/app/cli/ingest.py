@@ -0,0 +1,275 @@
+"""
+Import massivo offline di fatture storiche (PDF e XML FatturaPA).
+
+    python -m app.cli.ingest <cartella-o-zip> [--workers N] [--batch 500]
+                             [--checkpoint FILE] [--retry-errors] [--dry-run]
+
+Lettura, parsing e upload su S3 girano in un pool di processi; il processo
+principale raccoglie i risultati e li scrive su Postgres a batch (una
+transazione per batch). Dopo ogni batch i documenti salvati vengono aggiunti al
+file di checkpoint (JSON lines): rilanciando lo stesso comando dopo un crash si
+riparte da dove ci si era fermati. Un crash fra upload e commit lascia al più
+qualche oggetto orfano su S3, mai righe a metà nel DB.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from app.core.config import settings
+from app.services.invoice_fields import header_kwargs, normalize_parsed
+from app.services.parsers.invoice_pdf import parse_pdf_invoice
+from app.services.parsers.invoice_xml import iter_invoices
+from app.services.repository_invoices import insert_invoices_batch
+from app.services.storage import upload_bytes, upload_content_addressed
+
+EXTENSIONS = {".pdf": "pdf", ".xml": "xml"}
+CONTENT_TYPES = {"pdf": "application/pdf", "xml": "application/xml"}
+STAGES = ("read", "parse", "upload", "db")
+
+# (id nel checkpoint, percorso della cartella/zip, nome del file al suo interno)
+Source = Tuple[str, str, str]
+
+_zips: Dict[str, zipfile.ZipFile] = {}  # zip aperti, uno per processo worker
+
+
+def _kind(name: str) -> Optional[str]:
+    return EXTENSIONS.get(os.path.splitext(name)[1].lower())
+
+
+def iter_sources(path: str) -> Iterator[Source]:
+    """Documenti da importare, in ordine stabile (serve al checkpoint)."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            names = sorted(i.filename for i in zf.infolist() if not i.is_dir())
+        for name in names:
+            if _kind(name):
+                yield name, path, name
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fn in sorted(files):
+            if _kind(fn):
+                rel = os.path.relpath(os.path.join(root, fn), path)
+                yield rel, path, rel
+
+
+def _read(container: str, name: str) -> bytes:
+    if os.path.isdir(container):
+        with open(os.path.join(container, name), "rb") as fh:
+            return fh.read()
+    zf = _zips.get(container)
+    if zf is None:
+        zf = _zips[container] = zipfile.ZipFile(container)
+    return zf.read(name)
+
+
+def process_one(src: Source, upload: bool = True) -> Dict[str, Any]:
+    """Lettura + parsing + upload di un documento (gira nel worker)."""
+    source_id, container, name = src
+    timings = {}
+    try:
+        t0 = time.perf_counter()
+        data = _read(container, name)
+        t1 = time.perf_counter()
+        kind = _kind(name)
+        # un XML può essere un lotto: una fattura per FatturaElettronicaBody
+        docs = [parse_pdf_invoice(data)] if kind == "pdf" else list(iter_invoices(data))
+        docs = [normalize_parsed(d) for d in docs]
+        t2 = time.perf_counter()
+        filename = os.path.basename(name)
+        if upload and settings.s3_content_addressed:
+            s3 = upload_content_addressed(hashlib.sha256(data).hexdigest(), data, content_type=CONTENT_TYPES[kind])
+        elif upload:
+            s3 = upload_bytes(f"invoices/{uuid.uuid4()}_{filename}", data, content_type=CONTENT_TYPES[kind])
+        else:
+            s3 = {"bucket": "dry-run", "key": f"invoices/{filename}"}
+        t3 = time.perf_counter()
+        timings = {"read": t1 - t0, "parse": t2 - t1, "upload": t3 - t2}
+        return {
+            "source": source_id,
+            "invoices": [
+                {"source": source_id, "header": header_kwargs(str(uuid.uuid4()), s3, filename, d["fields"]), "righe": d.get("righe", [])}
+                for d in docs
+            ],
+            "pages": sum(d.get("pages", 1 if kind == "xml" else 0) for d in docs),
+            "bytes": len(data),
+            "timings": timings,
+        }
+    except Exception as e:
+        return {"source": source_id, "error": f"{type(e).__name__}: {e}", "timings": timings}
+
+
+def load_checkpoint(path: str, retry_errors: bool = False) -> Set[str]:
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue  # riga troncata da un crash
+            if rec.get("status") == "ok" or not retry_errors:
+                done.add(rec["source"])
+    return done
+
+
+class Ingest:
+    def __init__(self, checkpoint: Optional[str], batch_size: int = 500, dry_run: bool = False):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.pending: List[Dict[str, Any]] = []
+        self.stats = {"ok": 0, "errors": 0, "skipped": 0, "pages": 0, "bytes": 0}
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self._ckpt = open(checkpoint, "a", encoding="utf-8") if checkpoint else None
+
+    def _mark(self, records: List[Dict[str, Any]]) -> None:
+        if self._ckpt is None:
+            return
+        for rec in records:
+            self._ckpt.write(json.dumps(rec) + "\n")
+        self._ckpt.flush()
+        os.fsync(self._ckpt.fileno())
+
+    def add(self, res: Dict[str, Any]) -> None:
+        for k, v in res.get("timings", {}).items():
+            self.timings[k] += v
+        if "error" in res:
+            self.stats["errors"] += 1
+            print(f"ERRORE {res['source']}: {res['error']}", file=sys.stderr)
+            self._mark([{"source": res["source"], "status": "error", "error": res["error"]}])
+            return
+        self.pending.append(res)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        t0 = time.perf_counter()
+        if not self.dry_run:
+            insert_invoices_batch([inv for r in batch for inv in r["invoices"]])
+        self.timings["db"] += time.perf_counter() - t0
+        # checkpoint solo dopo il commit
+        self._mark([{"source": r["source"], "status": "ok", "ids": [inv["header"]["id"] for inv in r["invoices"]]} for r in batch])
+        for r in batch:
+            self.stats["ok"] += 1
+            self.stats["pages"] += r["pages"]
+            self.stats["bytes"] += r["bytes"]
+
+    def close(self) -> None:
+        self.flush()
+        if self._ckpt is not None:
+            self._ckpt.close()
+
+
+def run(
+    path: str,
+    *,
+    workers: int = 0,
+    batch_size: int = 500,
+    checkpoint: Optional[str] = None,
+    retry_errors: bool = False,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    """
+    Importa tutto `path` e ritorna il report. workers=0 esegue tutto nel
+    processo corrente (debug); il default della CLI è un worker per CPU.
+    """
+    checkpoint = checkpoint or path.rstrip("/\\") + ".ingest-checkpoint"
+    # il dry-run non legge né scrive il checkpoint: non ha salvato niente
+    if dry_run:
+        checkpoint = None
+    done = load_checkpoint(checkpoint, retry_errors) if checkpoint else set()
+    job = Ingest(checkpoint, batch_size=batch_size, dry_run=dry_run)
+    upload = not dry_run
+    started = time.perf_counter()
+
+    def todo() -> Iterator[Source]:
+        for src in iter_sources(path):
+            if src[0] in done:
+                job.stats["skipped"] += 1
+            else:
+                yield src
+
+    try:
+        if workers <= 0:
+            for src in todo():
+                job.add(process_one(src, upload))
+        else:
+            # finestra limitata di task in volo: la memoria non cresce con l'archivio
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                inflight = set()
+                for src in todo():
+                    if len(inflight) >= workers * 4:
+                        finished, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+                        for fut in finished:
+                            job.add(fut.result())
+                    inflight.add(pool.submit(process_one, src, upload))
+                for fut in wait(inflight).done:
+                    job.add(fut.result())
+    finally:
+        job.close()
+
+    elapsed = time.perf_counter() - started
+    stats = job.stats
+    return {
+        **stats,
+        "elapsed_s": round(elapsed, 3),
+        "docs_per_s": round(stats["ok"] / elapsed, 2) if elapsed else 0.0,
+        "pages_per_s": round(stats["pages"] / elapsed, 2) if elapsed else 0.0,
+        "stage_s": {k: round(v, 3) for k, v in job.timings.items()},
+        "checkpoint": checkpoint,
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    n = max(1, report["ok"] + report["errors"])
+    rows = [
+        f"documenti: {report['ok']} importati, {report['errors']} errori, "
+        f"{report['skipped']} saltati (checkpoint)",
+        f"tempo: {report['elapsed_s']:.1f} s  |  {report['docs_per_s']:.1f} doc/s  |  "
+        f"{report['pages_per_s']:.1f} pagine/s  |  {report['bytes'] / 1e6:.1f} MB",
+        "fasi (somma sui worker, media per documento):",
+    ]
+    for stage in STAGES:
+        tot = report["stage_s"][stage]
+        rows.append(f"  {stage:<7}{tot:10.2f} s {1000 * tot / n:10.1f} ms")
+    return "\n".join(rows)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.cli.ingest", description=__doc__.strip().splitlines()[0])
+    ap.add_argument("path", help="cartella o archivio .zip con PDF/XML")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="processi (0 = nessun pool)")
+    ap.add_argument("--batch", type=int, default=500, help="documenti per transazione (un lotto XML conta uno)")
+    ap.add_argument("--checkpoint", help="file di checkpoint (default <path>.ingest-checkpoint)")
+    ap.add_argument("--retry-errors", action="store_true", help="riprova i documenti falliti nei run precedenti")
+    ap.add_argument("--dry-run", action="store_true", help="solo parsing: niente upload, DB né checkpoint")
+    ap.add_argument("--json", action="store_true", help="report finale in JSON")
+    args = ap.parse_args(argv)
+
+    if not os.path.exists(args.path):
+        ap.error(f"{args.path} non esiste")
+    report = run(
+        args.path,
+        workers=args.workers,
+        batch_size=max(1, args.batch),
+        checkpoint=args.checkpoint,
+        retry_errors=args.retry_errors,
+        dry_run=args.dry_run,
+    )
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
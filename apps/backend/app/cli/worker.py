@@ -0,0 +1,143 @@
+"""
+Worker dei job di estrazione asincroni (POST /invoices/extract?async=1).
+
+    python -m app.cli.worker [--concurrency N] [--burst]
+
+Ogni processo esegue fino a N job insieme (thread); il parsing va nel pool di
+processi OCR avviato dal worker. Per scalare si lanciano più processi (o
+repliche del container): la coda Redis li coordina. Un job fallito torna in
+coda fino a `jobs_max_attempts` tentativi. Mentre un job è in corso il worker
+ne rinnova la scadenza in background; uno rimasto "running" oltre
+`jobs_visibility_timeout` senza rinnovi (worker morto) viene ripreso da un
+altro worker.
+"""
+import argparse
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from app.core.config import settings
+from app.services import jobs, ocr_executor
+from app.services.extraction import extract_document, remove_upload
+from app.services.storage import download_file, local_path
+from app.utils.logger import logger
+
+REAPER_INTERVAL_S = 5.0
+HEARTBEAT_FRACTION = 3  # la scadenza si rinnova ogni visibility_timeout / 3
+
+
+@contextmanager
+def _heartbeat(job_id: str, token: str) -> Iterator[None]:
+    """
+    Rinnova la scadenza del job (jobs.touch) a intervalli regolari finché il
+    blocco è in corso: un OCR lungo non viene ripreso da un altro worker
+    (e inserito due volte) solo perché dura più di `jobs_visibility_timeout`.
+    """
+    interval = max(0.05, settings.jobs_visibility_timeout / HEARTBEAT_FRACTION)
+    done = threading.Event()
+
+    def beat() -> None:
+        while not done.wait(interval):
+            try:
+                if not jobs.touch(job_id, token):
+                    return  # non è più nostro: lo ha ripreso un altro worker
+            except Exception as e:  # Redis giù: si riprova al prossimo giro
+                logger.warning("heartbeat job {}: {}", job_id, e)
+
+    t = threading.Thread(target=beat, name=f"job-heartbeat-{job_id[:8]}", daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        done.set()
+        t.join()
+
+
+def process(job_id: str, token: str) -> str:
+    """Download da S3 -> parsing -> insert; ritorna lo stato finale del job."""
+    job = jobs.get(job_id)
+    if job is None:
+        return "missing"
+    # il file scende su disco a blocchi (col backend locale si legge dov'è)
+    path = local = local_path(job["s3"]["key"], bucket=job["s3"]["bucket"])
+    if path is None:
+        fd, path = tempfile.mkstemp(prefix="job-", suffix=os.path.splitext(job["filename"] or "")[1].lower(), dir=settings.upload_tmp_dir)
+        os.close(fd)
+    try:
+        with _heartbeat(job_id, token):
+            if local is None:
+                download_file(job["s3"]["key"], path, bucket=job["s3"]["bucket"])
+            out = extract_document(path, job["filename"], job["content_type"], s3=job["s3"])
+        result = [inv.model_dump(mode="json", exclude_none=True) for inv in out]
+    except Exception as e:
+        logger.warning("job {}: tentativo {} fallito: {}: {}", job_id, job["attempts"], type(e).__name__, e)
+        return jobs.fail(job_id, token, f"{type(e).__name__}: {e}")
+    finally:
+        if local is None:
+            remove_upload(path)
+    return "done" if jobs.complete(job_id, token, result) else "stale"
+
+
+def _loop(stop: threading.Event, burst: bool, poll_s: float) -> None:
+    while not stop.is_set():
+        try:
+            reserved = jobs.reserve(timeout=poll_s)
+        except Exception as e:  # Redis giù: si riprova
+            logger.error("coda dei job: {}", e)
+            time.sleep(poll_s)
+            continue
+        if reserved is None:
+            if burst:
+                return
+            continue
+        job_id, token = reserved
+        status = process(job_id, token)
+        logger.info("job {}: {}", job_id, status)
+
+
+def run(concurrency: int = 1, burst: bool = False, poll_s: float = 1.0, stop: Optional[threading.Event] = None) -> None:
+    """
+    Esegue i job finché `stop` non viene impostato; con burst=True esce
+    appena la coda è vuota (utile per cron e test).
+    """
+    stop = stop or threading.Event()
+    threads = [
+        threading.Thread(target=_loop, args=(stop, burst, poll_s), name=f"job-worker-{i}", daemon=True)
+        for i in range(max(1, concurrency))
+    ]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        try:
+            jobs.requeue_expired()
+        except Exception as e:
+            logger.error("requeue dei job scaduti: {}", e)
+        for t in threads:
+            t.join(timeout=REAPER_INTERVAL_S / len(threads))
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(prog="python -m app.cli.worker", description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--concurrency", type=int, default=settings.jobs_concurrency, help="job in parallelo in questo processo")
+    ap.add_argument("--burst", action="store_true", help="esce quando la coda è vuota")
+    args = ap.parse_args(argv)
+
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # i job in corso finiscono, poi si esce
+        signal.signal(sig, lambda *_: stop.set())
+    ocr_executor.start()
+    try:
+        run(args.concurrency, burst=args.burst, stop=stop)
+    finally:
+        ocr_executor.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
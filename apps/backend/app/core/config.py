@@ -1,5 +1,6 @@
+from pydantic import AliasChoices, Field
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -14,17 +15,89 @@ class Settings(BaseSettings):
     postgres_password: str = "ai_agent_pw"
     postgres_port: int = 5432
     postgres_host: str = "db"
+    db_pool_size: int = 10             # connessioni Postgres riusate per processo
+
+    # Storage: "s3" (S3/MinIO) oppure "local" (disco, nodo singolo / test)
+    storage_backend: str = "s3"
+    storage_local_root: str = "data/storage"
+    storage_local_url: str = "http://localhost:8000/api/v1/files"  # base degli URL firmati (route /files)
+    storage_local_secret: str = ""             # chiave HMAC degli URL firmati; vuota: generata in <root>/.url-secret
 
     # S3
     s3_endpoint: str = "http://minio:9000"
-    s3_region: str = "eu-south-1"
-    s3_bucket: str = "ai-agent-dev"
+    s3_region: str = "us-east-1"           # regione di default di MinIO
+    s3_bucket: str = Field("ai-agent-dev", validation_alias=AliasChoices("s3_bucket", "minio_bucket"))
     s3_access_key: str = "minioadmin"
     s3_secret_key: str = "minioadmin"
+    s3_max_pool_connections: int = 32     # connessioni HTTP per client S3 (condivise fra thread)
+    s3_part_size: int = 8 * 1024 * 1024    # parti dell'upload multipart (e soglia oltre cui si usa)
+    s3_upload_concurrency: int = 4         # parti caricate in parallelo per file
+    s3_content_addressed: bool = False     # chiave = SHA-256 del file: niente oggetti/upload duplicati
+
+    # URL presigned (download/anteprima)
+    presign_cache_size: int = 10_000      # URL firmati tenuti in cache (LRU, per processo)
+    presign_cache_reuse: float = 0.5      # un URL si riusa per questa frazione della sua validità
+    presign_max_ids: int = 500            # id massimi per POST /invoices/presign
+
+    # Upload
+    max_upload_bytes: int = 100_000_000    # corpo della richiesta più grande accettato (413 oltre)
+    upload_tmp_dir: Optional[str] = None   # dove finiscono gli upload durante l'estrazione (default: tmp di sistema)
 
     # Redis
     redis_url: str = "redis://redis:6379/0"
 
+    # Cache risultati di estrazione (Redis + LRU in-process)
+    extract_cache_enabled: bool = True
+    extract_cache_ttl: int = 7 * 24 * 3600
+    extract_cache_lru_size: int = 256
+    extract_cache_max_entry_bytes: int = 1_000_000
+    extract_cache_retry_s: float = 30.0  # pausa dopo un errore Redis
+
+    # Header Server-Timing sulle risposte di /invoices/extract
+    server_timing_enabled: bool = True
+
+    # Estrazioni concorrenti (app/services/extraction_executor.py)
+    extract_max_inflight: int = 8      # oltre, /invoices/extract risponde 429
+    extract_io_threads: int = 16       # thread per S3/Postgres/Redis e attesa del pool di processi
+    extract_retry_after_s: int = 5     # header Retry-After delle risposte 429
+
+    # Job di estrazione asincroni (coda Redis, worker: python -m app.cli.worker)
+    jobs_prefix: str = "jobs"
+    jobs_concurrency: int = 2          # job in parallelo per processo worker
+    jobs_visibility_timeout: int = 300 # s: un job non completato entro questo tempo torna in coda
+    jobs_max_attempts: int = 3         # tentativi prima di segnare il job come fallito
+    jobs_result_ttl: int = 7 * 24 * 3600
+
+    # Upload di archivi ZIP (/invoices/extract/archive)
+    archive_concurrency: int = 4                 # documenti dell'archivio elaborati in parallelo
+    archive_max_entries: int = 5000              # oltre, i documenti restanti sono ignorati
+    archive_max_entry_bytes: int = 50_000_000    # documento decompresso più grande accettato
+    archive_spool_bytes: int = 8_000_000         # documenti fino a questa dimensione restano in memoria (oltre, file temporaneo)
+
+    # Upload multiplo (/invoices/extract/batch)
+    batch_concurrency: int = 4         # file della richiesta elaborati in parallelo
+    batch_max_files: int = 50
+
+    # PDF / OCR
+    pdf_max_pages: int = 20            # pagine massime lette per documento
+    pdf_min_text_chars: int = 200      # sotto questa soglia la pagina va in OCR
+    pdf_page_workers: int = 4          # pagine renderizzate/OCR in parallelo
+    ocr_workers: int = 0               # processi del pool OCR (0 = numero di CPU)
+    ocr_queue_depth: int = 32          # task OCR massimi in coda/esecuzione
+    ocr_parse_queue_depth: int = 16    # parsing di documenti massimi in coda/esecuzione nel pool
+    ocr_osd_min_conf: float = 2.0      # sotto questa confidenza OSD si provano le 3 rotazioni
+    ocr_adaptive_dpi: bool = True      # parte dal DPI più basso e sale solo se serve
+    ocr_dpi_levels: List[int] = [150, 300]
+    ocr_min_score: float = 0.8         # punteggio OCR (0-1) sotto cui si passa al DPI successivo
+    ocr_threshold: str = "fixed"       # binarizzazione: fixed | otsu | sauvola
+    ocr_sauvola_window: int = 45       # lato della finestra di Sauvola (pixel, dopo l'ingrandimento 1.5x)
+    ocr_sauvola_k: float = 0.2
+    ocr_roi: bool = True               # prima solo intestazione e riquadro totali, pagina intera se non bastano
+    ocr_roi_header: float = 0.30       # frazione alta dell'area scritta letta come intestazione
+    ocr_roi_footer: float = 0.35       # frazione bassa letta come riquadro totali
+    ocr_amount_whitelist: str = "0123456789,.€%"
+    ocr_tessdata: Optional[str] = None  # cartella dei traineddata (default: TESSDATA_PREFIX o quella di libtesseract)
+
     class Config:
         env_file = ".env"
         extra = "ignore"
@@ -1,12 +1,38 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.core.config import settings
+from app.services import db, extraction_executor, ocr_executor, storage
+from app.utils.upload_limit import MaxUploadSizeMiddleware
 from app.api.v1.routers.health import router as health_router
 from app.api.v1.routers.debug import router as debug_router
+from app.api.v1.routers.files import router as files_router
 from app.api.v1.routers.invoices import router as invoices_router  # ✅ router corretto
 
-app = FastAPI(title="AI Agent API", version="0.1.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Configurazione dello storage prima di accettare richieste
+    storage.check()
+    # Pool OCR/parsing e thread delle estrazioni: vivono quanto l'applicazione
+    ocr_executor.start()
+    extraction_executor.start()
+    try:
+        yield
+    finally:
+        extraction_executor.shutdown()
+        ocr_executor.shutdown()
+        db.close_pool()
+        storage.close_clients()
+
+
+app = FastAPI(title="AI Agent API", version="0.1.0", lifespan=lifespan)
+
+# Upload oltre `max_upload_bytes`: 413 prima di leggere/spoolare il corpo
+# (aggiunto prima di CORS, così anche il 413 ha gli header CORS)
+app.add_middleware(MaxUploadSizeMiddleware)
 
 # Configura CORS (robusto e con default per Vite)
 raw_origins = getattr(settings, "cors_origins", "") or ""
@@ -33,6 +59,7 @@ app.add_middleware(
 app.include_router(health_router, prefix="/api/v1")
 app.include_router(invoices_router, prefix="/api/v1")  # => /api/v1/invoices/...
 app.include_router(debug_router, prefix="/api/v1")
+app.include_router(files_router, prefix="/api/v1")  # URL firmati dello storage locale
 
 
 @app.get("/")
@@ -1,4 +1,5 @@
-from typing import Optional, List
+from typing import Dict, Optional, List
+from uuid import UUID
 from pydantic import BaseModel, Field
 
 
@@ -33,12 +34,40 @@ class InvoiceFields(BaseModel):
     totale: Optional[float] = None
 
 
+class OcrPage(BaseModel):
+    page: int
+    angle: Optional[int] = None         # rotazione applicata (gradi, antiorario)
+    confidence: Optional[float] = None  # confidenza della sonda di orientamento
+    fallback: bool = False              # True se si sono provate tutte le rotazioni
+    dpi: Optional[int] = None           # DPI del rendering scelto
+    escalations: int = 0                # ri-rendering a DPI più alto
+    word_conf: Optional[float] = None   # confidenza media delle parole (0-100)
+    roi: bool = False                   # True se sono bastate intestazione e totali
+
+
+class OcrInfo(BaseModel):
+    pages: List[OcrPage] = Field(default_factory=list)
+
+
 class InvoiceOut(BaseModel):
     id: str
     s3: S3Ref
     filename: Optional[str] = None
     fields: InvoiceFields
     righe: List[InvoiceLine] = Field(default_factory=list)
+    ocr: Optional[OcrInfo] = None
+    timings: Optional[Dict[str, float]] = None  # ms per fase, solo con ?timings=true
+
+
+# ---- Job di estrazione asincroni ----
+
+class JobOut(BaseModel):
+    id: str
+    status: str                          # queued | running | done | failed
+    attempts: int = 0
+    filename: Optional[str] = None
+    error: Optional[str] = None
+    result: Optional[List[InvoiceOut]] = None  # fatture estratte, a job concluso
 
 
 # ---- Liste / paginazione ----
@@ -62,3 +91,22 @@ class InvoiceListResponse(BaseModel):
 class PresignedUrlOut(BaseModel):
     url: str
     expires_in: int
+
+
+class PresignBatchIn(BaseModel):
+    ids: List[UUID]
+    expires_in: int = Field(900, ge=60, le=86400)
+    download: bool = True
+    preview: bool = True
+
+
+class PresignedInvoiceUrls(BaseModel):
+    id: str
+    download: Optional[str] = None
+    preview: Optional[str] = None
+    expires_in: int                      # validità residua minima degli URL (s)
+
+
+class PresignBatchOut(BaseModel):
+    items: List[PresignedInvoiceUrls]
+    missing: List[str] = Field(default_factory=list)
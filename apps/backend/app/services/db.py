@@ -1,7 +1,21 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
 import psycopg2
 import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
+
 from ..core.config import settings
 
+# Connessioni Postgres riusate fra richieste: un ThreadedConnectionPool di
+# processo (creato al primo uso) con al più `db_pool_size` connessioni; oltre,
+# chi chiede una connessione attende che se ne liberi una.
+_pool: Optional[ThreadedConnectionPool] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_lock = threading.Lock()
+
+
 def get_conn():
     return psycopg2.connect(
         dbname=settings.postgres_db,
@@ -11,11 +25,65 @@ def get_conn():
         port=settings.postgres_port,
     )
 
+
+def _get_pool() -> ThreadedConnectionPool:
+    global _pool, _slots
+    with _lock:
+        if _pool is None:
+            size = max(1, settings.db_pool_size)
+            _pool = ThreadedConnectionPool(
+                0, size,
+                dbname=settings.postgres_db,
+                user=settings.postgres_user,
+                password=settings.postgres_password,
+                host=settings.postgres_host,
+                port=settings.postgres_port,
+            )
+            _slots = threading.BoundedSemaphore(size)
+        return _pool
+
+
+@contextmanager
+def pooled_conn() -> Iterator["psycopg2.extensions.connection"]:
+    pool = _get_pool()
+    slots = _slots
+    slots.acquire()
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    try:
+        yield conn
+    finally:
+        # una connessione caduta (server riavviato, rete) non torna nel pool
+        pool.putconn(conn, close=bool(conn.closed))
+        slots.release()
+
+
+def close_pool() -> None:
+    global _pool, _slots
+    with _lock:
+        pool, _pool, _slots = _pool, None, None
+    if pool is not None:
+        pool.closeall()
+
+
 def execute(query: str, params: tuple = ()):
-    with get_conn() as conn:
-        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-            cur.execute(query, params)
-            try:
-                return cur.fetchall()
-            except psycopg2.ProgrammingError:
-                return None
+    with pooled_conn() as conn:
+        with conn:
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(query, params)
+                try:
+                    return cur.fetchall()
+                except psycopg2.ProgrammingError:
+                    return None
+
+
+@contextmanager
+def transaction():
+    """Cursore su una connessione del pool: commit all'uscita, rollback se c'è un'eccezione."""
+    with pooled_conn() as conn:
+        with conn:
+            with conn.cursor() as cur:
+                yield cur
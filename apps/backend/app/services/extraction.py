@@ -0,0 +1,177 @@
+import os
+import tempfile
+import uuid
+from concurrent.futures import Future
+from functools import partial
+from typing import IO, Any, Dict, Iterator, List, Optional, Union
+
+from ..schemas.invoice import InvoiceOut
+from . import extraction_cache, extraction_executor
+from .invoice_fields import header_kwargs, normalize_parsed
+from .parsers.invoice_xml import iter_invoices
+from .repository_invoices import insert_invoices_batch, release_object
+from ..core.config import settings
+from ..utils.timing import timed_iter
+from .storage import delete_object, object_exists, upload_bytes, upload_content_addressed, upload_file
+
+# Flusso di estrazione di un documento (parse e upload in parallelo -> insert), condiviso
+# da /invoices/extract, dall'upload di archivi e dal worker dei job asincroni.
+# Funzioni bloccanti: dall'event loop si chiamano via extraction_executor.run_io.
+# Il documento è un `Source`: i byte oppure il percorso di un file su disco.
+# Gli upload HTTP passano dal disco (save_upload): parser, pool di processi e
+# upload multipart su S3 leggono lo stesso file, senza copie in memoria.
+# Gli XML si leggono in questo thread, un body alla volta, e finiscono
+# nell'insert a blocchi man mano: l'albero XML e i parametri SQL di un lotto
+# non sono mai tutti in memoria. La risposta invece sì: extract_document
+# ritorna un InvoiceOut (con le righe) per ogni body.
+
+Source = Union[bytes, str]
+
+COPY_CHUNK = 1024 * 1024
+
+
+def save_upload(fileobj: IO[bytes], filename: Optional[str]) -> str:
+    """
+    Copia a blocchi il file caricato (lo spool di Starlette) in un file
+    temporaneo con nome e ne ritorna il percorso; va rimosso con
+    remove_upload. Oltre `max_upload_bytes` solleva ValueError.
+    """
+    suffix = os.path.splitext(filename or "")[1].lower()
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=suffix, dir=settings.upload_tmp_dir)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            fileobj.seek(0)
+            size = 0
+            for chunk in iter(lambda: fileobj.read(COPY_CHUNK), b""):
+                size += len(chunk)
+                if size > settings.max_upload_bytes:
+                    raise ValueError(f"file troppo grande (max {settings.max_upload_bytes} byte)")
+                out.write(chunk)
+    except BaseException:
+        remove_upload(path)
+        raise
+    return path
+
+
+def remove_upload(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def store_upload(source: Source, filename: Optional[str], content_type: Optional[str]) -> Dict[str, str]:
+    """Carica il file originale su S3 e ne ritorna il riferimento {"bucket", "key"}."""
+    content_type = content_type or "application/octet-stream"
+    if settings.s3_content_addressed:
+        sha256 = extraction_cache.sha256_hex(source)
+        return upload_content_addressed(sha256, source, content_type=content_type)
+    file_id = str(uuid.uuid4())
+    s3_key = f"invoices/{file_id}_{filename}"
+    if isinstance(source, str):
+        return upload_file(s3_key, source, content_type=content_type)
+    return upload_bytes(s3_key, source, content_type=content_type)
+
+
+def _iter_xml(source: Source) -> Iterator[Dict[str, Any]]:
+    return timed_iter("parse_xml", iter_invoices(source))
+
+
+def _parse_document(source: Source, name_lower: str, content_type: str) -> Iterator[Dict[str, Any]]:
+    if name_lower.endswith(".xml") or "xml" in content_type:
+        return extraction_cache.iter_or_parse("xml", source, _iter_xml)
+    if name_lower.endswith(".pdf") or "pdf" in content_type:
+        return iter([extraction_cache.get_or_parse("pdf", source, partial(extraction_executor.parse, "pdf"))])
+    return iter([{"fields": {"valuta": "EUR"}, "righe": []}])
+
+
+def _delete_orphan(s3: Dict[str, str]) -> None:
+    # best-effort: l'errore da riportare è quello che ha reso orfano l'oggetto
+    try:
+        if "sha256" in s3:
+            # oggetto per contenuto: altre fatture possono puntarlo
+            release_object(s3["bucket"], s3["key"], delete_object)
+        else:
+            delete_object(s3["key"], bucket=s3["bucket"])
+    except Exception:
+        pass
+
+
+def _ensure_object(s3: Dict[str, str], source: Source, content_type: str) -> None:
+    # gira sotto il lock condiviso dell'insert: un DELETE concorrente può aver
+    # rimosso l'oggetto fra il controllo di upload_content_addressed e qui (o,
+    # per un job, dopo l'enqueue: si ricarica dal file scaricato dal worker)
+    if not object_exists(s3["key"], bucket=s3["bucket"]):
+        upload = upload_file if isinstance(source, str) else upload_bytes
+        upload(s3["key"], source, content_type=content_type or "application/octet-stream", bucket=s3["bucket"])
+
+
+def _discard_upload(upload: Optional[Future]) -> None:
+    """Attende l'upload avviato insieme al parsing fallito e ne cancella l'oggetto."""
+    if upload is None:
+        return
+    try:
+        s3 = upload.result()
+    except Exception:
+        return  # upload fallito anch'esso: niente da cancellare
+    _delete_orphan(s3)
+
+
+def extract_document(
+    source: Source,
+    filename: Optional[str],
+    content_type: Optional[str],
+    s3: Optional[Dict[str, str]] = None,
+) -> List[InvoiceOut]:
+    """
+    Parsing, upload e salvataggio di un documento. Un XML FatturaPA con più
+    body (lotto) produce una fattura per body, salvate tutte in un'unica
+    transazione: i body si leggono man mano che l'insert li consuma. Con
+    `s3` il file è già su S3 (job asincroni) e non si ricarica.
+
+    Upload e parsing (di un PDF, o del primo body di un XML) partono
+    insieme; l'insert attende entrambi. Se il parsing o l'insert falliscono
+    l'oggetto appena caricato viene cancellato, così su S3 non restano file
+    senza fattura.
+    """
+    name_lower = (filename or "").lower()
+    content_type = (content_type or "").lower()
+    upload = None if s3 is not None else extraction_executor.submit_upload(store_upload, source, filename, content_type)
+    try:
+        docs = _parse_document(source, name_lower, content_type)
+        first = next(docs, None)
+    except BaseException:
+        _discard_upload(upload)
+        raise
+
+    upload_result = s3 or upload.result()
+    out: List[InvoiceOut] = []
+
+    def items():
+        d = first
+        while d is not None:
+            d = normalize_parsed(d)
+            item = {"header": header_kwargs(str(uuid.uuid4()), upload_result, filename, d["fields"]), "righe": d.get("righe", [])}
+            out.append(InvoiceOut(
+                id=item["header"]["id"],
+                s3=upload_result,
+                filename=filename,
+                fields=d["fields"],
+                righe=item["righe"],
+                ocr=d.get("ocr"),
+            ))
+            yield item
+            d = next(docs, None)
+
+    # tutte le fatture del file (una, o il lotto) nella stessa transazione
+    try:
+        if "sha256" in upload_result:
+            insert_invoices_batch(items(), before_commit=partial(_ensure_object, upload_result, source, content_type))
+        else:
+            insert_invoices_batch(items())
+    except Exception:
+        if upload is not None:
+            _delete_orphan(upload_result)
+        raise
+
+    return out
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+import redis
+
+from ..core.config import settings
+from .parsers import PARSER_VERSION
+from ..utils.timing import span
+
+# Cache dei risultati di estrazione indirizzata per contenuto: chiave =
+# SHA-256 dei byte + tipo di parser + PARSER_VERSION + hash corto delle
+# impostazioni OCR che cambiano l'output. Davanti a Redis c'è una
+# piccola LRU in-process. La cache è best-effort: se Redis non risponde si
+# prosegue senza (e lo si riprova dopo `extract_cache_retry_s`).
+
+_lock = threading.Lock()
+_local: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+_redis: Optional[redis.Redis] = None
+_redis_down_until = 0.0
+_stats = {"hits_local": 0, "hits_redis": 0, "misses": 0, "errors": 0}
+
+
+def sha256_hex(source: Union[bytes, str]) -> str:
+    """SHA-256 dei byte o del file al percorso `source` (letto a blocchi)."""
+    if not isinstance(source, str):
+        return hashlib.sha256(source).hexdigest()
+    h = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# impostazioni da cui dipende il risultato dei parser (non quelle del pool)
+_OUTPUT_SETTINGS = (
+    "ocr_osd_min_conf", "ocr_adaptive_dpi", "ocr_dpi_levels", "ocr_min_score",
+    "ocr_threshold", "ocr_sauvola_window", "ocr_sauvola_k",
+    "ocr_roi", "ocr_roi_header", "ocr_roi_footer", "ocr_amount_whitelist",
+)
+
+
+def _settings_tag() -> str:
+    values = json.dumps([getattr(settings, name) for name in _OUTPUT_SETTINGS])
+    return hashlib.sha256(values.encode("utf-8")).hexdigest()[:12]
+
+
+def cache_key(kind: str, source: Union[bytes, str]) -> str:
+    return f"extract:{PARSER_VERSION}:{_settings_tag()}:{kind}:{sha256_hex(source)}"
+
+
+def set_redis_client(client: Optional[redis.Redis]) -> None:
+    """Sostituisce il client Redis (es. fakeredis nei test)."""
+    global _redis, _redis_down_until
+    _redis = client
+    _redis_down_until = 0.0
+
+
+def _client() -> Optional[redis.Redis]:
+    global _redis
+    if time.monotonic() < _redis_down_until:
+        return None
+    if _redis is None:
+        _redis = redis.Redis.from_url(
+            settings.redis_url, socket_timeout=0.5, socket_connect_timeout=0.5
+        )
+    return _redis
+
+
+def _redis_failed() -> None:
+    global _redis_down_until
+    with _lock:
+        _stats["errors"] += 1
+    _redis_down_until = time.monotonic() + settings.extract_cache_retry_s
+
+
+def _local_get(key: str) -> Optional[str]:
+    with _lock:
+        item = _local.get(key)
+        if item is None:
+            return None
+        expires, payload = item
+        if expires < time.monotonic():
+            del _local[key]
+            return None
+        _local.move_to_end(key)
+        return payload
+
+
+def _local_put(key: str, payload: str) -> None:
+    with _lock:
+        _local[key] = (time.monotonic() + settings.extract_cache_ttl, payload)
+        _local.move_to_end(key)
+        while len(_local) > settings.extract_cache_lru_size:
+            _local.popitem(last=False)
+
+
+def get(key: str) -> Optional[Dict[str, Any]]:
+    payload = _local_get(key)
+    if payload is not None:
+        with _lock:
+            _stats["hits_local"] += 1
+        return json.loads(payload)
+
+    r = _client()
+    if r is not None:
+        try:
+            raw = r.get(key)
+        except redis.RedisError:
+            _redis_failed()
+            raw = None
+        if raw is not None:
+            payload = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+            _local_put(key, payload)
+            with _lock:
+                _stats["hits_redis"] += 1
+            return json.loads(payload)
+
+    with _lock:
+        _stats["misses"] += 1
+    return None
+
+
+def put(key: str, parsed: Dict[str, Any]) -> None:
+    _put_payload(key, json.dumps(parsed, separators=(",", ":")))
+
+
+def _put_payload(key: str, payload: str) -> None:
+    if len(payload) > settings.extract_cache_max_entry_bytes:
+        return
+    _local_put(key, payload)
+    r = _client()
+    if r is None:
+        return
+    try:
+        r.set(key, payload, ex=settings.extract_cache_ttl)
+    except redis.RedisError:
+        _redis_failed()
+
+
+def get_or_parse(kind: str, source: Union[bytes, str], parse: Callable[[Union[bytes, str]], Dict[str, Any]]) -> Dict[str, Any]:
+    """`source`: byte del documento o percorso del file su disco."""
+    if not settings.extract_cache_enabled:
+        return parse(source)
+    with span("cache_get"):
+        key = cache_key(kind, source)
+        hit = get(key)
+    if hit is not None:
+        return hit
+    parsed = parse(source)
+    # serializzato subito: il chiamante può poi modificare `parsed` liberamente
+    with span("cache_put"):
+        put(key, parsed)
+    return parsed
+
+
+def iter_or_parse(
+    kind: str, source: Union[bytes, str], iterate: Callable[[Union[bytes, str]], Iterable[Dict[str, Any]]]
+) -> Iterator[Dict[str, Any]]:
+    """
+    Come get_or_parse, per i parser che producono i documenti uno alla volta
+    (i body di un lotto XML): in cache c'è {"fatture": [...]}. Senza hit i
+    documenti passano avanti man mano e si serializzano mentre passano; si
+    mettono in cache a fine lettura solo se stanno in
+    `extract_cache_max_entry_bytes` (oltre si smette di tenerli).
+    """
+    if not settings.extract_cache_enabled:
+        yield from iterate(source)
+        return
+    with span("cache_get"):
+        key = cache_key(kind, source)
+        hit = get(key)
+    if hit is not None:
+        yield from hit["fatture"]
+        return
+    kept: Optional[List[str]] = []
+    size = 0
+    for doc in iterate(source):
+        if kept is not None:
+            # serializzato subito: il chiamante può poi modificare `doc` liberamente
+            kept.append(json.dumps(doc, separators=(",", ":")))
+            size += len(kept[-1]) + 1
+            if size > settings.extract_cache_max_entry_bytes:
+                kept = None
+        yield doc
+    if kept is not None:
+        with span("cache_put"):
+            _put_payload(key, '{"fatture":[' + ",".join(kept) + "]}")
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {**_stats, "local_entries": len(_local), "parser_version": PARSER_VERSION}
+
+
+def clear_local() -> None:
+    with _lock:
+        _local.clear()
+        for k in _stats:
+            _stats[k] = 0
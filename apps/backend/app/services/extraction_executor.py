@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Optional, Union
+
+from ..core.config import settings
+from ..utils.timing import replay, run_collected, span
+from . import ocr_executor
+from .parsers.invoice_pdf import parse_pdf_invoice
+
+# Esecuzione delle estrazioni fuori dall'event loop di uvicorn:
+# - il parsing (pdfminer, OCR) gira nel pool di processi condiviso
+#   (ocr_executor, coda dei parsing), così non contende il GIL con le altre
+#   richieste; gli span del processo tornano nella richiesta. Gli XML no:
+#   i body di un lotto si leggono nel thread di I/O man mano che l'insert li
+#   consuma (v. extraction.extract_document);
+# - upload S3, Postgres, Redis e l'attesa del pool girano in un thread pool
+#   dedicato (run_io), con il contesto della richiesta (span di timing);
+# - l'upload S3 di un documento parte insieme al parsing (submit_upload), in
+#   un pool suo: chi lo attende occupa già un thread di `_threads`, e con un
+#   pool condiviso le attese potrebbero esaurirlo;
+# - al massimo `extract_max_inflight` estrazioni sono in corso: oltre,
+#   try_acquire() fallisce e la route risponde subito 429 + Retry-After
+#   invece di accodare richieste all'infinito. Batch e archivi prenotano
+#   più posti in una volta (uno per documento in parallelo).
+# Senza start() (test, script) il thread pool è quello di default del loop e
+# parsing e upload avvengono nel thread stesso, uno dopo l'altro.
+
+_threads: Optional[ThreadPoolExecutor] = None
+_uploads: Optional[ThreadPoolExecutor] = None
+_lock = threading.Lock()
+_inflight = 0
+_stats = {"accepted": 0, "rejected": 0}
+
+_PARSERS: Dict[str, Callable[[Union[bytes, str]], Dict[str, Any]]] = {
+    "pdf": parse_pdf_invoice,
+}
+
+
+def start() -> None:
+    global _threads, _uploads
+    with _lock:
+        if _threads is None:
+            _threads = ThreadPoolExecutor(
+                max_workers=max(1, settings.extract_io_threads), thread_name_prefix="extract-io"
+            )
+        if _uploads is None:
+            _uploads = ThreadPoolExecutor(
+                max_workers=max(1, settings.extract_io_threads), thread_name_prefix="extract-upload"
+            )
+
+
+def shutdown() -> None:
+    global _threads, _uploads
+    with _lock:
+        threads, _threads = _threads, None
+        uploads, _uploads = _uploads, None
+    for pool in (threads, uploads):
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+
+def try_acquire(n: int = 1) -> int:
+    """
+    Prenota fino a `n` posti per estrazioni: ritorna quanti (0 se sono già
+    tutti occupati). Vanno restituiti con release(quanti).
+    """
+    global _inflight
+    with _lock:
+        free = settings.extract_max_inflight - _inflight
+        if free <= 0:
+            _stats["rejected"] += 1
+            return 0
+        got = min(max(1, n), free)
+        _inflight += got
+        _stats["accepted"] += 1
+        return got
+
+
+def release(n: int = 1) -> None:
+    global _inflight
+    with _lock:
+        _inflight = max(0, _inflight - n)
+
+
+def _parse(kind: str, data: Union[bytes, str]) -> Dict[str, Any]:
+    # top-level: è ciò che viene eseguito nei processi del pool
+    return _PARSERS[kind](data)
+
+
+def parse(kind: str, data: Union[bytes, str]) -> Dict[str, Any]:
+    """
+    Parsing di `data` nel pool di processi (bloccante: va chiamata da un
+    thread). Con un percorso al processo passa solo il nome del file. Gli
+    span misurati nel processo (pdfminer, OCR, ...) tornano col risultato e
+    finiscono nei tempi della richiesta come se il parsing fosse locale.
+    """
+    with span("parse"):
+        if ocr_executor.is_running():
+            result, spans = ocr_executor.submit_parse(run_collected, _parse, kind, data).result()
+            replay(spans)
+            return result
+        return _parse(kind, data)
+
+
+def submit_upload(fn: Callable, *args, **kwargs) -> Future:
+    """Avvia `fn` (upload S3) in background col contesto corrente; senza start() la esegue subito."""
+    pool = _uploads
+    if pool is not None:
+        return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    fut: Future = Future()
+    try:
+        fut.set_result(fn(*args, **kwargs))
+    except BaseException as e:
+        fut.set_exception(e)
+    return fut
+
+
+async def run_io(fn: Callable, *args, **kwargs) -> Any:
+    """Esegue `fn` nel thread pool delle estrazioni conservando il contesto (timing)."""
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_threads, partial(ctx.run, fn, *args, **kwargs))
+
+
+async def map_unordered(calls: Iterable[Callable[[], Any]], concurrency: int) -> AsyncIterator[Any]:
+    """
+    Esegue le funzioni (bloccanti, senza argomenti) con run_io, al più
+    `concurrency` insieme, e ne produce i risultati man mano che finiscono.
+    `calls` è consumato solo quando si libera un posto: può essere lazy.
+    """
+    pending: set = set()
+    try:
+        for call in calls:
+            while len(pending) >= max(1, concurrency):
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    yield task.result()
+            pending.add(asyncio.ensure_future(run_io(call)))
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        return {
+            **_stats,
+            "inflight": _inflight,
+            "max_inflight": settings.extract_max_inflight,
+            "process_pool": ocr_executor.is_running(),
+        }
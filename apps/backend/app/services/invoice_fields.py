@@ -0,0 +1,78 @@
+from typing import Any, Dict, Optional
+
+# Normalizzazione dell'output dei parser prima del salvataggio: condivisa fra
+# l'endpoint /invoices/extract e l'import massivo (app/cli/ingest.py).
+
+
+def merge_defaults(parsed: dict) -> dict:
+    fields = parsed.get("fields", {}) or {}
+    fields.setdefault("valuta", "EUR")
+    parsed["fields"] = fields
+    parsed.setdefault("righe", [])
+    return parsed
+
+
+def to_float_safe(x) -> Optional[float]:
+    try:
+        if x is None:
+            return None
+        if isinstance(x, (int, float)):
+            return float(x)
+        s = str(x).replace(".", "").replace(",", ".").replace("%", "").strip()
+        return float(s)
+    except Exception:
+        return None
+
+
+def backfill_amounts(fields: dict) -> dict:
+    imp = to_float_safe(fields.get("imponibile"))
+    iva = to_float_safe(fields.get("iva"))
+    tot = to_float_safe(fields.get("totale"))
+
+    if imp is None and iva is not None and tot is not None:
+        base = round(tot - iva, 2)
+        if base >= 0:
+            imp = base
+    elif iva is None and imp is not None and tot is not None:
+        tax = round(tot - imp, 2)
+        if tax >= 0:
+            iva = tax
+    elif tot is None and imp is not None and iva is not None:
+        tot = round(imp + iva, 2)
+
+    if imp is not None and iva is not None:
+        calc = round(imp + iva, 2)
+        if tot is None or abs(calc - tot) <= 0.05:
+            tot = calc
+
+    fields["imponibile"] = imp
+    fields["iva"] = iva
+    fields["totale"] = tot
+    return fields
+
+
+def normalize_parsed(parsed: dict) -> dict:
+    parsed = merge_defaults(parsed)
+    parsed["fields"] = backfill_amounts(parsed["fields"])
+    return parsed
+
+
+def header_kwargs(invoice_id: str, s3: Dict[str, str], filename: Optional[str], f: Dict[str, Any]) -> Dict[str, Any]:
+    """Argomenti per insert_invoice_header a partire dai campi normalizzati."""
+    return dict(
+        id=invoice_id,
+        s3_bucket=s3["bucket"],
+        s3_key=s3["key"],
+        filename=filename,
+        invoice_number=f.get("invoice_number"),
+        intestatario=f.get("intestatario"),
+        partita_iva=f.get("partita_iva"),
+        codice_fiscale=f.get("codice_fiscale"),
+        issue_date=f.get("data_emissione"),
+        due_date=f.get("data_scadenza"),
+        currency=f.get("valuta", "EUR"),
+        imponibile=f.get("imponibile"),
+        iva=f.get("iva"),
+        totale=f.get("totale"),
+        content_sha256=s3.get("sha256"),
+    )
@@ -1,12 +1,13 @@
-import os
+import mimetypes
+import threading
+import time
+from collections import OrderedDict
 from typing import List, Tuple, Optional, Dict, Any
 from decimal import Decimal
-import boto3
-from botocore.client import Config
-
+from app.core.config import settings
 from app.services.db import execute
-
-IS_TESTING = os.getenv("TESTING") == "1"
+from app.services.repository_invoices import delete_invoice as _delete_invoice_row
+from app.services.storage import delete_object, presigned_url
 
 
 def _to_float_db(x) -> Optional[float]:
@@ -57,9 +58,6 @@ def list_invoices(
     order_by: Optional[str] = "created_at",
     order_dir: Optional[str] = "desc",
 ) -> Tuple[List[Dict[str, Any]], int]:
-    if IS_TESTING:
-        return [], 0
-
     allowed_order_by = {
         "created_at": "created_at",
         "issue_date": "issue_date",
@@ -116,9 +114,6 @@ def list_invoices(
 
 
 def get_invoice(invoice_id: str) -> Optional[Dict[str, Any]]:
-    if IS_TESTING:
-        return None
-
     sql = """
         SELECT
           id, filename, s3_bucket, s3_key,
@@ -134,34 +129,53 @@ def get_invoice(invoice_id: str) -> Optional[Dict[str, Any]]:
     return _row_to_api_item(rows[0])
 
 
-# ---------- MinIO / S3 presigned URL ----------
+def delete_invoice(invoice_id: str) -> bool:
+    """Cancella la fattura; il file su S3 solo se nessun'altra fattura lo usa ancora."""
+    return _delete_invoice_row(invoice_id, delete_object)
 
-def _s3_client(signing_endpoint: Optional[str] = None):
-    """
-    Crea un client S3. Se signing_endpoint è passato, lo usa per la FIRMA
-    (host incluso nella firma). Altrimenti usa S3_ENDPOINT/MINIO_ENDPOINT.
-    """
-    endpoint = (
-        signing_endpoint
-        or os.getenv("S3_ENDPOINT")
-        or os.getenv("MINIO_ENDPOINT")
-        or "http://minio:9000"
-    )
-    access_key = os.getenv("S3_ACCESS_KEY") or os.getenv("MINIO_ACCESS_KEY") or "minioadmin"
-    secret_key = os.getenv("S3_SECRET_KEY") or os.getenv("MINIO_SECRET_KEY") or "minioadmin"
-    region = os.getenv("S3_REGION") or "us-east-1"
-
-    return boto3.client(
-        "s3",
-        endpoint_url=endpoint,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-        region_name=region,
-        config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
-    )
 
-
-def get_presigned_url(
+# ---------- MinIO / S3 presigned URL ----------
+# Gli URL firmati sono in cache per (bucket, key, durata, parametri della
+# risposta): una pagina della lista riaperta, o lo stesso file chiesto da più
+# utenti, non viene rifirmata. Un URL si riusa solo per la prima frazione
+# (`presign_cache_reuse`) della sua validità, così chi lo riceve ha sempre
+# almeno il resto del tempo per usarlo.
+
+_presign_lock = threading.Lock()
+_presign_cache: "OrderedDict[tuple, tuple[float, str]]" = OrderedDict()
+
+
+def _response_params(inline: bool, content_type: Optional[str], filename: Optional[str]) -> Dict[str, str]:
+    params = {}
+    disp = "inline" if inline else "attachment"
+    if filename:
+        disp += f'; filename="{filename}"'
+    params["ResponseContentDisposition"] = disp
+    if content_type:
+        params["ResponseContentType"] = content_type
+    return params
+
+
+def _presign_cached(bucket: str, key: str, expires_in: int, params: Dict[str, str]) -> Tuple[str, int]:
+    cache_key = (bucket, key, expires_in, tuple(sorted(params.items())))
+    now = time.time()
+    with _presign_lock:
+        item = _presign_cache.get(cache_key)
+        if item is not None and now - item[0] < expires_in * settings.presign_cache_reuse:
+            _presign_cache.move_to_end(cache_key)
+            return item[1], int(item[0] + expires_in - now)
+    # Se abbiamo un endpoint pubblico, il client condiviso firma con
+    # quello: non riscrivere l'URL, è già firmato con il giusto host.
+    url = presigned_url(bucket, key, expires_in, **params)
+    with _presign_lock:
+        _presign_cache[cache_key] = (now, url)
+        _presign_cache.move_to_end(cache_key)
+        while len(_presign_cache) > settings.presign_cache_size:
+            _presign_cache.popitem(last=False)
+    return url, expires_in
+
+
+def presign(
     bucket: str,
     key: str,
     expires_in: int = 900,
@@ -169,44 +183,67 @@ def get_presigned_url(
     inline: bool = False,
     content_type: Optional[str] = None,
     filename: Optional[str] = None,
-) -> Optional[str]:
+) -> Optional[Tuple[str, int]]:
     """
-    Genera un URL presigned usando **l'endpoint pubblico** se disponibile,
-    così l'host nella firma coincide con quello usato dal browser.
+    (URL presigned, secondi di validità residua), firmato con **l'endpoint
+    pubblico** se disponibile, così l'host nella firma coincide con quello
+    usato dal browser. None se la firma fallisce.
     """
-    # In test ritorniamo solo un URL "finto" ma già pubblico
-    if IS_TESTING:
-        base = (
-            os.getenv("S3_PUBLIC_ENDPOINT")
-            or os.getenv("MINIO_PUBLIC_ENDPOINT")
-            or os.getenv("S3_ENDPOINT")
-            or os.getenv("MINIO_ENDPOINT")
-            or "http://localhost:9000"
-        )
-        return f"{base.rstrip('/')}/{bucket}/{key}?exp={expires_in}"
-
-    public_base = os.getenv("S3_PUBLIC_ENDPOINT") or os.getenv("MINIO_PUBLIC_ENDPOINT")
-    internal_base = os.getenv("S3_ENDPOINT") or os.getenv("MINIO_ENDPOINT") or "http://minio:9000"
-
-    # Se abbiamo un endpoint pubblico, firmiamo direttamente con quello
-    signing_endpoint = public_base or internal_base
-    s3 = _s3_client(signing_endpoint)
-
     try:
-        params = {"Bucket": bucket, "Key": key}
-        disp = "inline" if inline else "attachment"
-        if filename:
-            disp += f'; filename="{filename}"'
-        params["ResponseContentDisposition"] = disp
-        if content_type:
-            params["ResponseContentType"] = content_type
-
-        url = s3.generate_presigned_url(
-            ClientMethod="get_object",
-            Params=params,
-            ExpiresIn=expires_in,
-        )
-        # Non riscrivere l'URL: è già firmato con il giusto host.
-        return url
+        return _presign_cached(bucket, key, expires_in, _response_params(inline, content_type, filename))
     except Exception:
         return None
+
+
+def presign_preview(s3: Dict[str, str], filename: Optional[str], expires_in: int) -> Optional[Tuple[str, int]]:
+    """URL per la visualizzazione nel browser (inline, Content-Type dal nome del file)."""
+    guessed, _ = mimetypes.guess_type(filename or s3["key"])
+    return presign(
+        s3["bucket"], s3["key"], expires_in,
+        inline=True, content_type=guessed or "application/octet-stream", filename=filename or "",
+    )
+
+
+def _s3_refs(invoice_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    rows = execute(
+        "SELECT id, filename, s3_bucket, s3_key FROM invoices WHERE id = ANY(%s::uuid[])",
+        (invoice_ids,),
+    ) or []
+    return {
+        str(r["id"]): {"filename": r.get("filename") or "", "s3": {"bucket": r["s3_bucket"], "key": r["s3_key"]}}
+        for r in rows
+    }
+
+
+def presign_invoices(
+    invoice_ids: List[str],
+    expires_in: int = 900,
+    download: bool = True,
+    preview: bool = True,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    URL di download e/o anteprima per molte fatture: una sola query per i
+    riferimenti S3, poi le firme (locali, dalla cache se possibile).
+    Ritorna (voci nell'ordine degli id, id non trovati).
+    """
+    refs = _s3_refs(invoice_ids)
+    items: List[Dict[str, Any]] = []
+    missing: List[str] = []
+    for invoice_id in invoice_ids:
+        ref = refs.get(invoice_id)
+        if ref is None:
+            missing.append(invoice_id)
+            continue
+        item: Dict[str, Any] = {"id": invoice_id}
+        ttls = []
+        if download:
+            signed = presign(ref["s3"]["bucket"], ref["s3"]["key"], expires_in)
+            item["download"] = signed[0] if signed else None
+            ttls.append(signed[1] if signed else 0)
+        if preview:
+            signed = presign_preview(ref["s3"], ref["filename"], expires_in)
+            item["preview"] = signed[0] if signed else None
+            ttls.append(signed[1] if signed else 0)
+        item["expires_in"] = min(ttls) if ttls else expires_in
+        items.append(item)
+    return items, missing
@@ -0,0 +1,183 @@
+import json
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import redis
+
+from ..core.config import settings
+
+# Coda Redis dei job di estrazione asincroni (POST /invoices/extract?async=1,
+# worker: python -m app.cli.worker). Chiavi, tutte sotto `jobs_prefix`:
+# - <prefix>:queue       lista degli id in attesa (LPUSH / BLMOVE da destra)
+# - <prefix>:processing  id presi da un worker e non ancora conclusi
+# - <prefix>:job:<id>    hash con stato, tentativi, riferimento S3, risultato
+#
+# reserve() sposta l'id in "processing" in modo atomico e gli assegna una
+# scadenza (visibility timeout) e un token. Se il worker muore, o non chiude
+# entro la scadenza, requeue_expired() rimette il job in coda contandolo come
+# tentativo fallito; dopo `jobs_max_attempts` il job è "failed". complete() e
+# fail() valgono solo con il token della prenotazione corrente: un worker in
+# ritardo non sovrascrive l'esito di chi ha ripreso il job. La consegna è
+# quindi "almeno una volta": il worker rinnova la scadenza con touch() a
+# intervalli per tutta la durata del job, così conta solo il tempo fra due
+# rinnovi e non la durata dell'OCR.
+
+_redis: Optional[redis.Redis] = None
+
+
+def set_redis_client(client: Optional[redis.Redis]) -> None:
+    """Sostituisce il client Redis (es. fakeredis nei test)."""
+    global _redis
+    _redis = client
+
+
+def _client() -> redis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.redis_url)
+    return _redis
+
+
+def _key(*parts: str) -> str:
+    return ":".join((settings.jobs_prefix,) + parts)
+
+
+def _job_key(job_id: str) -> str:
+    return _key("job", job_id)
+
+
+def _str(v: Any) -> Optional[str]:
+    return v.decode("utf-8") if isinstance(v, bytes) else v
+
+
+def enqueue(filename: Optional[str], content_type: Optional[str], s3: Dict[str, str]) -> str:
+    """Registra un job per il file già caricato su S3 e lo mette in coda."""
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    key = _job_key(job_id)
+    pipe = _client().pipeline(transaction=True)
+    pipe.hset(key, mapping={
+        "status": "queued",
+        "attempts": 0,
+        "filename": filename or "",
+        "content_type": content_type or "",
+        "s3_bucket": s3["bucket"],
+        "s3_key": s3["key"],
+        "s3_sha256": s3.get("sha256") or "",  # layout per contenuto (v. storage.upload_content_addressed)
+        "created_at": now,
+        "updated_at": now,
+    })
+    pipe.expire(key, settings.jobs_result_ttl)
+    pipe.lpush(_key("queue"), job_id)
+    pipe.execute()
+    return job_id
+
+
+def reserve(timeout: float = 1.0) -> Optional[Tuple[str, str]]:
+    """Prende il prossimo job (attende al più `timeout` s): (id, token) o None."""
+    r = _client()
+    raw = r.blmove(_key("queue"), _key("processing"), timeout, "RIGHT", "LEFT")
+    if raw is None:
+        return None
+    job_id = _str(raw)
+    token = uuid.uuid4().hex
+    now = time.time()
+    pipe = r.pipeline(transaction=True)
+    pipe.hset(_job_key(job_id), mapping={
+        "status": "running",
+        "token": token,
+        "deadline": now + settings.jobs_visibility_timeout,
+        "updated_at": now,
+    })
+    pipe.hincrby(_job_key(job_id), "attempts", 1)
+    pipe.execute()
+    return job_id, token
+
+
+def touch(job_id: str, token: str) -> bool:
+    """Rinvia la scadenza di un job in corso (False se non è più nostro)."""
+    return _finish(job_id, token, {"deadline": time.time() + settings.jobs_visibility_timeout}, keep=True)
+
+
+def _finish(job_id: str, token: Optional[str], mapping: Dict[str, Any], keep: bool = False, requeue: bool = False) -> bool:
+    key = _job_key(job_id)
+    with _client().pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                if token is not None and _str(pipe.hget(key, "token")) != token:
+                    pipe.unwatch()
+                    return False
+                pipe.multi()
+                pipe.hset(key, mapping={**mapping, "updated_at": time.time()})
+                if not keep:
+                    pipe.hdel(key, "token", "deadline")
+                    pipe.lrem(_key("processing"), 0, job_id)
+                    pipe.expire(key, settings.jobs_result_ttl)
+                if requeue:
+                    pipe.lpush(_key("queue"), job_id)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+
+
+def complete(job_id: str, token: str, result: List[Dict[str, Any]]) -> bool:
+    return _finish(job_id, token, {"status": "done", "error": "", "result": json.dumps(result, separators=(",", ":"))})
+
+
+def fail(job_id: str, token: Optional[str], error: str) -> str:
+    """Tentativo fallito: torna in coda o, finiti i tentativi, "failed". Ritorna lo stato."""
+    attempts = int(_str(_client().hget(_job_key(job_id), "attempts")) or 0)
+    status = "failed" if attempts >= settings.jobs_max_attempts else "queued"
+    if not _finish(job_id, token, {"status": status, "error": error}, requeue=status == "queued"):
+        return "stale"
+    return status
+
+
+def requeue_expired(now: Optional[float] = None) -> int:
+    """Rimette in coda (o fa fallire) i job in corso oltre la scadenza. Ritorna quanti."""
+    r = _client()
+    now = time.time() if now is None else now
+    moved = 0
+    for raw in r.lrange(_key("processing"), 0, -1):
+        job_id = _str(raw)
+        key = _job_key(job_id)
+        deadline, token = (_str(v) for v in r.hmget(key, "deadline", "token"))
+        if deadline is None:
+            if not r.exists(key):
+                r.lrem(_key("processing"), 0, job_id)  # job scaduto (TTL)
+            else:
+                # worker morto fra BLMOVE e la prenotazione: la scadenza parte da ora
+                r.hset(key, "deadline", now + settings.jobs_visibility_timeout)
+            continue
+        if float(deadline) < now:
+            fail(job_id, token, "visibility timeout scaduto")
+            moved += 1
+    return moved
+
+
+def get(job_id: str) -> Optional[Dict[str, Any]]:
+    raw = _client().hgetall(_job_key(job_id))
+    if not raw:
+        return None
+    job = {_str(k): _str(v) for k, v in raw.items()}
+    s3 = {"bucket": job.get("s3_bucket"), "key": job.get("s3_key")}
+    if job.get("s3_sha256"):
+        s3["sha256"] = job["s3_sha256"]
+    return {
+        "id": job_id,
+        "status": job.get("status"),
+        "attempts": int(job.get("attempts") or 0),
+        "filename": job.get("filename") or None,
+        "content_type": job.get("content_type") or None,
+        "s3": s3,
+        "error": job.get("error") or None,
+        "result": json.loads(job["result"]) if job.get("result") else None,
+    }
+
+
+def stats() -> Dict[str, int]:
+    r = _client()
+    return {"queued": r.llen(_key("queue")), "processing": r.llen(_key("processing"))}
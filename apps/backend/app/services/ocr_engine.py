@@ -0,0 +1,166 @@
+import os
+import shlex
+import threading
+from typing import Any, Dict, List, Optional
+
+import pytesseract
+from PIL import Image
+
+from ..core.config import settings
+
+try:  # binding a libtesseract: modelli caricati una volta, immagini passate in memoria
+    import tesserocr
+except ImportError:  # pragma: no cover - dipende dall'ambiente
+    tesserocr = None
+
+# Motore OCR del processo. Con tesserocr ogni istanza di PyTessBaseAPI tiene
+# caricati i traineddata e riceve l'immagine in memoria: le istanze vivono in
+# un piccolo pool del processo (una per thread in uso, riusate fra documenti).
+# Senza tesserocr (o se l'inizializzazione fallisce) si ripiega su pytesseract,
+# cioè un processo `tesseract` e un PNG temporaneo per chiamata.
+#
+# La lingua ("ita+eng" se installata, altrimenti "eng") è scelta una volta
+# sola: niente secondo tentativo con "eng" a ogni chiamata.
+
+_lock = threading.Lock()
+_free: List[Any] = []
+_created = 0
+_lang: Optional[str] = None
+_binding_ok = tesserocr is not None
+
+
+def _tessdata() -> Optional[str]:
+    return settings.ocr_tessdata or os.getenv("TESSDATA_PREFIX") or None
+
+
+def language() -> str:
+    global _lang
+    if _lang is None:
+        try:
+            if _binding_ok:
+                _path, langs = tesserocr.get_languages(*([_tessdata()] if _tessdata() else []))
+            else:
+                langs = pytesseract.get_languages(config="")
+            _lang = "ita+eng" if {"ita", "eng"} <= set(langs) else ("eng" if "eng" in langs else "ita+eng")
+        except Exception:
+            _lang = "ita+eng"
+    return _lang
+
+
+def engine() -> str:
+    return "tesserocr" if _binding_ok else "pytesseract"
+
+
+def _parse_config(config: str) -> tuple[Optional[int], Dict[str, str]]:
+    """`--psm N` e `-c chiave=valore` della riga di comando di tesseract."""
+    psm, variables = None, {}
+    args = shlex.split(config or "")
+    for i, arg in enumerate(args):
+        if arg == "--psm" and i + 1 < len(args):
+            psm = int(args[i + 1])
+        elif arg == "-c" and i + 1 < len(args) and "=" in args[i + 1]:
+            k, v = args[i + 1].split("=", 1)
+            variables[k] = v
+    return psm, variables
+
+
+def _acquire() -> Optional[Any]:
+    global _binding_ok, _created
+    if not _binding_ok:
+        return None
+    with _lock:
+        if _free:
+            return _free.pop()
+    try:
+        kwargs = {"path": _tessdata()} if _tessdata() else {}
+        api = tesserocr.PyTessBaseAPI(lang=language(), **kwargs)
+    except Exception:
+        # traineddata mancanti o libreria incompatibile: pytesseract da qui in poi
+        _binding_ok = False
+        return None
+    with _lock:
+        _created += 1
+    return api
+
+
+def _release(api: Any) -> None:
+    # a fine chiamata l'istanza torna com'era: la prossima non eredita psm/whitelist
+    api.Clear()
+    api.SetPageSegMode(tesserocr.PSM.AUTO)
+    api.SetVariable("tessedit_char_whitelist", "")
+    with _lock:
+        _free.append(api)
+
+
+def _prepare(api: Any, img: Image.Image, config: str) -> None:
+    psm, variables = _parse_config(config)
+    if psm is not None:
+        api.SetPageSegMode(psm)
+    for k, v in variables.items():
+        api.SetVariable(k, v)
+    api.SetImage(img)
+
+
+def image_to_string(img: Image.Image, config: str = "") -> str:
+    api = _acquire()
+    if api is not None:
+        try:
+            _prepare(api, img, config)
+            return api.GetUTF8Text()
+        finally:
+            _release(api)
+    return pytesseract.image_to_string(img, lang=language(), config=config)
+
+
+def _data_from_api(api: Any) -> Dict[str, List[Any]]:
+    """Stesse chiavi di pytesseract.image_to_data(..., Output.DICT), livello parola."""
+    RIL = tesserocr.RIL
+    out: Dict[str, List[Any]] = {k: [] for k in ("text", "conf", "page_num", "block_num", "par_num", "line_num")}
+    api.Recognize()
+    it = api.GetIterator()
+    if it is None:
+        return out
+    block = par = line = 0
+    while True:
+        if it.IsAtBeginningOf(RIL.BLOCK):
+            block, par, line = block + 1, 0, 0
+        if it.IsAtBeginningOf(RIL.PARA):
+            par, line = par + 1, 0
+        if it.IsAtBeginningOf(RIL.TEXTLINE):
+            line += 1
+        word = it.GetUTF8Text(RIL.WORD)
+        if word:
+            out["text"].append(word)
+            out["conf"].append(it.Confidence(RIL.WORD))
+            out["page_num"].append(1)
+            out["block_num"].append(block)
+            out["par_num"].append(par)
+            out["line_num"].append(line)
+        if not it.Next(RIL.WORD):
+            break
+    return out
+
+
+def image_to_data(img: Image.Image, config: str = "") -> Dict[str, List[Any]]:
+    api = _acquire()
+    if api is not None:
+        try:
+            _prepare(api, img, config)
+            return _data_from_api(api)
+        finally:
+            _release(api)
+    return pytesseract.image_to_data(img, lang=language(), config=config, output_type=pytesseract.Output.DICT)
+
+
+def warm_up() -> None:
+    """Carica lingua e modelli subito (initializer dei processi del pool OCR)."""
+    language()
+    api = _acquire()
+    if api is not None:
+        _release(api)
+
+
+def ping() -> Dict[str, Any]:
+    """Health check: OCR di un'immagine vuota nel processo che lo esegue."""
+    image_to_string(Image.new("1", (32, 32), 1))
+    return {"pid": os.getpid(), "engine": engine(), "lang": language(), "instances": _created}
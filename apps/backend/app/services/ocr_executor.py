@@ -0,0 +1,178 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional
+
+from ..core.config import settings
+from . import ocr_engine
+
+# Pool di processi condiviso per OCR e parsing delle estrazioni
+# (extraction_executor): creato/chiuso dal lifecycle dell'app (app/main.py). Se non è avviato (test, script, processi figli) chi lo usa
+# ricade sull'esecuzione nel processo corrente.
+#
+# I processi del pool sono persistenti: l'initializer carica subito il motore
+# OCR (ocr_engine.warm_up), così lingua e modelli restano in memoria fra un
+# documento e l'altro. Se un processo muore (OOM, crash di libtesseract) il
+# pool diventa "broken": viene ricreato e i task in volo (o in coda) vengono
+# riprovati una volta nel pool nuovo.
+#
+# Due code separate davanti al pool: `ocr_queue_depth` task OCR (rotazioni,
+# health) e `ocr_parse_queue_depth` parsing interi di extraction_executor.
+# Un parsing resta in un processo per tutto il documento: con una coda sola
+# i parsing in attesa toglierebbero i posti all'OCR e a /health.
+_pool: Optional[ProcessPoolExecutor] = None
+_owner_pid: Optional[int] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_parse_slots: Optional[threading.BoundedSemaphore] = None
+_lock = threading.Lock()
+_restarts = 0
+_in_worker = False  # True nei processi del pool
+
+
+def _pool_size() -> int:
+    return settings.ocr_workers or (os.cpu_count() or 1)
+
+
+def _new_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=_pool_size(),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    )
+
+
+def _init_worker() -> None:
+    global _in_worker
+    _in_worker = True
+    ocr_engine.warm_up()
+
+
+def start() -> None:
+    global _pool, _owner_pid, _slots, _parse_slots
+    with _lock:
+        if _pool is not None:
+            return
+        _pool = _new_pool()
+        _slots = threading.BoundedSemaphore(max(1, settings.ocr_queue_depth))
+        _parse_slots = threading.BoundedSemaphore(max(1, settings.ocr_parse_queue_depth))
+        _owner_pid = os.getpid()
+
+
+def shutdown() -> None:
+    global _pool, _owner_pid, _slots, _parse_slots
+    with _lock:
+        pool, _pool, _owner_pid, _slots, _parse_slots = _pool, None, None, None, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def is_running() -> bool:
+    return _pool is not None and _owner_pid == os.getpid()
+
+
+def in_worker() -> bool:
+    """True se il codice gira in un processo del pool (es. un parsing)."""
+    return _in_worker
+
+
+def submit(fn: Callable, *args, **kwargs) -> Future:
+    """
+    Accoda `fn` nel pool. Al massimo `ocr_queue_depth` task possono essere in
+    coda/esecuzione: oltre, il chiamante attende che se ne liberi uno.
+    """
+    if not is_running():
+        raise RuntimeError("OCR executor non avviato")
+    slots = _slots
+    slots.acquire()
+    return _submit_holding(slots, fn, *args, **kwargs)
+
+
+def submit_parse(fn: Callable, *args, **kwargs) -> Future:
+    """Come submit, ma nella coda dei parsing (`ocr_parse_queue_depth`)."""
+    if not is_running():
+        raise RuntimeError("OCR executor non avviato")
+    slots = _parse_slots
+    slots.acquire()
+    return _submit_holding(slots, fn, *args, **kwargs)
+
+
+def _submit_holding(slots: threading.BoundedSemaphore, fn: Callable, *args, **kwargs) -> Future:
+    """
+    Sottomette `fn` con uno slot già preso: lo slot si libera a fine task.
+    Se il pool è rotto all'invio, o si rompe con il task in volo (un
+    processo morto), il pool viene ricreato e il task riprovato una volta.
+    Il Future ritornato è quello del tentativo buono; cancel() annulla il
+    tentativo in corso se non è ancora partito.
+    """
+    outer: Future = Future()
+    current: list = [None]
+
+    def attempt() -> Future:
+        try:
+            return _pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool as e:
+            _restart(e)
+            return _pool.submit(fn, *args, **kwargs)
+
+    def settle(inner: Future, retries: int) -> None:
+        error = None if inner.cancelled() else inner.exception()
+        if isinstance(error, BrokenProcessPool) and retries and not outer.cancelled():
+            _restart(error)
+            try:
+                follow(attempt(), retries - 1)
+                return
+            except Exception as e:
+                error = e
+        slots.release()
+        try:
+            if inner.cancelled():
+                outer.cancel()
+            elif error is not None:
+                outer.set_exception(error)
+            else:
+                outer.set_result(inner.result())
+        except InvalidStateError:
+            pass  # `outer` annullato dal chiamante nel frattempo
+
+    def follow(inner: Future, retries: int) -> None:
+        current[0] = inner
+        inner.add_done_callback(lambda f: settle(f, retries))
+
+    try:
+        first = attempt()
+    except Exception:
+        slots.release()
+        raise
+    outer.add_done_callback(lambda f: f.cancelled() and current[0].cancel())
+    follow(first, 1)
+    return outer
+
+
+def _restart(error: Exception) -> None:
+    """Sostituisce un pool rotto (i task in volo si riprovano in _submit_holding)."""
+    global _pool, _restarts
+    with _lock:
+        broken = _pool
+        if broken is None or not getattr(broken, "_broken", True):
+            return  # già sostituito da un altro thread
+        _pool = _new_pool()
+        _restarts += 1
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def health(timeout: float = 10.0) -> Dict[str, Any]:
+    """
+    Esegue ocr_engine.ping in un processo del pool (o qui se il pool non c'è).
+    Non attende in coda: se tutti gli slot sono occupati risponde subito
+    "busy" invece di bloccare /health dietro al lavoro OCR.
+    """
+    if not is_running():
+        return {"pool": "off", **ocr_engine.ping()}
+    info = {"workers": _pool_size(), "restarts": _restarts}
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        return {"pool": "busy", **info}
+    ping = _submit_holding(slots, ocr_engine.ping).result(timeout=timeout)
+    return {"pool": "up", **info, **ping}
@@ -0,0 +1,3 @@
+# Versione della logica di parsing: va incrementata a ogni modifica che cambia
+# l'output dei parser (invalida la cache dei risultati di estrazione).
+PARSER_VERSION = "2025.10.4"
@@ -0,0 +1,107 @@
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# -------- Riconciliazione importi: imponibile + iva = totale --------
+#
+# Sostituisce la ricerca cubica su tutte le terne di importi. Per ogni importo
+# candidato a totale si cercano, su un array ordinato, le coppie la cui somma
+# cade nella tolleranza (searchsorted vettoriale sul secondo elemento, a
+# blocchi di totali): O(n² log n) nel caso peggiore invece di O(n³), con i
+# cicli interni in NumPy.
+#
+# Le regole di scelta restano quelle della vecchia enumerazione, che dipendono
+# dall'ordine di visita (a parità di errore entro 0.001 vince il totale più
+# grande, ma solo se visitato dopo). Per questo le terne valide vengono
+# rigiocate nello stesso ordine (i, j, k, permutazione) del vecchio ciclo.
+
+TOLERANCE = 0.05
+_EPS = 1e-6
+_BLOCK = 1 << 20
+
+# ordine delle permutazioni (iva, imp, tot) del vecchio ciclo sulla terna (a, b, c)
+_PERM_ORDER = {"abc": 0, "acb": 1, "bac": 2, "bca": 3, "cab": 4, "cba": 5}
+
+
+def _empty() -> Dict[str, Optional[float]]:
+    return {"iva": None, "imponibile": None, "totale": None}
+
+
+def _candidates(values: Sequence[float], permutations: bool) -> List[tuple]:
+    """
+    Terne (i, j, k, perm, iva, imp, tot) con |imp + iva - tot| entro la
+    tolleranza. Con permutations=False valgono solo i < j < k nei ruoli
+    (iva, imp, tot), come nella passata sugli importi unici ordinati.
+    """
+    order = sorted((v, p) for p, v in enumerate(values) if v > 0)
+    svals = np.fromiter((v for v, _ in order), dtype=float, count=len(order))
+    spos = [p for _, p in order]
+    n = len(order)
+    out: List[tuple] = []
+    if n < 2:
+        return out
+    nexts = np.arange(1, n + 1)
+    tots = np.asarray(values, dtype=float)
+    # totali in ordine crescente, a blocchi (una riga di matrice per totale):
+    # poche chiamate NumPy sui documenti piccoli, memoria limitata su quelli grandi
+    cand_t = np.nonzero(tots > 0)[0]
+    cand_t = cand_t[np.argsort(tots[cand_t], kind="stable")]
+    rows = max(1, _BLOCK // n)
+
+    for b in range(0, len(cand_t), rows):
+        ts = cand_t[b:b + rows]
+        lo = tots[ts, None] - TOLERANCE - _EPS
+        hi = tots[ts, None] + TOLERANCE + _EPS
+        # x è il minore della coppia: bastano gli importi <= metà del totale
+        m = int(np.searchsorted(svals, hi[-1, 0] / 2.0, side="right"))
+        if m == 0:
+            continue
+        xs = svals[:m]
+        starts = np.maximum(np.searchsorted(svals, lo - xs), nexts[:m])
+        ends = np.searchsorted(svals, hi - xs, side="right")
+        hit = (ends > starts) & (xs <= hi / 2.0)
+        for r, sx in zip(*(a.tolist() for a in np.nonzero(hit))):
+            t = int(ts[r])
+            tot = values[t]
+            px = spos[sx]
+            if px == t:
+                continue
+            for s in range(int(starts[r, sx]), int(ends[r, sx])):
+                py = spos[s]
+                if py == t:
+                    continue
+                if permutations:
+                    roles = ((px, py), (py, px))
+                else:
+                    if t < px or t < py:
+                        continue
+                    roles = ((min(px, py), max(px, py)),)
+                i, j, k = sorted((px, py, t))
+                for p_iva, p_imp in roles:
+                    letters = "".join("abc"[(i, j, k).index(p)] for p in (p_iva, p_imp, t))
+                    out.append((i, j, k, _PERM_ORDER[letters], values[p_iva], values[p_imp], tot))
+    out.sort(key=lambda c: c[:4])
+    return out
+
+
+def reconcile(values: Sequence[float], permutations: bool = True) -> Dict[str, Optional[float]]:
+    """
+    Sceglie (iva, imponibile, totale) fra gli importi: errore minimo, a
+    parità il totale più grande; IVA > 0, totale >= imponibile > 0, niente
+    IVA < 1 su totali > 50. Con permutations=True ogni terna è provata in
+    tutti i ruoli (importi in ordine di apparizione), altrimenti solo in
+    ordine crescente (importi unici ordinati).
+    """
+    best = _empty()
+    best_err = 1e9
+    for _i, _j, _k, _p, iva, imp, tot in _candidates(values, permutations):
+        if tot < imp or tot < iva:
+            continue
+        if tot > 50 and iva < 1:
+            continue
+        err = abs((imp + iva) - tot)
+        if err <= TOLERANCE and tot >= imp > 0 and iva > 0:
+            if err < best_err or (abs(err - best_err) <= 0.001 and tot > (best["totale"] or 0)):
+                best = {"iva": round(iva, 2), "imponibile": round(imp, 2), "totale": round(tot, 2)}
+                best_err = err
+    return best
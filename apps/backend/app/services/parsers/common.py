@@ -62,6 +62,10 @@ def is_noise_name(line: str) -> bool:
     low = line.lower()
     if any(lbl in low for lbl in LABEL_NO_NAME):
         return True
+    return is_noise_line(line)
+
+def is_noise_line(line: str) -> bool:
+    """Come is_noise_name ma senza il controllo sulle etichette."""
     if CITY_LINE.search(line):
         return True
     if ADDRESS_LINE.search(line):
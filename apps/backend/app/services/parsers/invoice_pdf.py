@@ -1,19 +1,34 @@
 import re
-from io import BytesIO
-from typing import Dict, Any, List, Optional
-from collections import Counter
+import contextvars
+import mmap
+from io import BytesIO, StringIO
+from typing import Callable, Dict, Any, List, Optional, Iterator, Deque, IO, Union
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import closing
 
 from pdfminer.high_level import extract_text
-from pdf2image import convert_from_bytes
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+from pdfminer.converter import TextConverter
+from pdfminer.layout import LAParams
+from pdf2image import convert_from_bytes, convert_from_path, pdfinfo_from_bytes, pdfinfo_from_path
 import pytesseract
-from PIL import Image, ImageOps, ImageFilter
+import numpy as np
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+from ...core.config import settings
+from .. import ocr_engine, ocr_executor
+from ...utils.timing import span, timed
+from .amounts import reconcile
 
 from .common import (
     first_match, _to_float, _to_date, lines as split_lines, prev_nonempty,
     IVA_RAW, IVA_LABELED, CF_SPACED, CURRENCY_REGEX,
     TOTAL_LABELED, NET_LABELED, VAT_LABELED,
     DATE_EMISSIONE, DATE_SCADENZA, DATE_ANY, INVOICE_NO_REGEX,
-    is_noise_name, normalize_cf
+    LABEL_NO_NAME, is_noise_line, normalize_cf
 )
 
 # -------- Regex importi/numero documento --------
@@ -46,6 +61,97 @@ LABELY       = {"data", "cliente", "indirizzo", "citta'", "città"}
 def _clean_amount(s: str) -> str:
     return s.replace("\u202f", "").replace("\xa0", "").replace(" ", "")
 
+# Etichette per la lettura esplicita degli importi ("Totale ...")
+LABELS_IMPONIBILE = ("totale imponibile", "imponibile totale")
+LABELS_IVA        = ("totale iva",)
+LABELS_TOTALE     = ("totale documento", "netto a pagare", "totale fattura")
+
+# -------- Indice del documento (una sola passata sulle righe) --------
+INDEX_LABELS = frozenset(LABELS_IMPONIBILE + LABELS_IVA + LABELS_TOTALE) | LABELY | LABEL_NO_NAME | {"fattura", "cliente"}
+# una sola regex per tutte le etichette; la ricerca riparte dal carattere
+# successivo a ogni match così si trovano anche etichette sovrapposte. A parità
+# di posizione vince la più lunga: i suoi prefissi si aggiungono a parte.
+RE_LABELS = re.compile("|".join(re.escape(lbl) for lbl in sorted(INDEX_LABELS, key=len, reverse=True)))
+_LABEL_PREFIXES = {lbl: frozenset(p for p in INDEX_LABELS if lbl.startswith(p)) for lbl in INDEX_LABELS}
+_UNSET = object()
+
+def _line_starts(ll: List[str]) -> List[int]:
+    # offset di ogni riga nella stringa "\x00".join(ll)
+    out, pos = [], 0
+    for l in ll:
+        out.append(pos)
+        pos += len(l) + 1
+    return out
+
+class DocIndex:
+    """
+    Indice del testo: righe, versione minuscola, importi per riga (già esclusi
+    quelli dentro una data) ed etichette note presenti in ogni riga. Ogni regex
+    gira una volta sola sull'intero documento (righe unite da \\x00, che nessun
+    pattern attraversa) e i match sono riportati alla riga con bisect.
+    Gli estrattori consultano l'indice invece di riscansionare le righe.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.lines: List[str] = split_lines(text)
+        self.lower: List[str] = [l.lower() for l in self.lines]
+        self.one_line = re.sub(r"[\r\n]+", " ", text)
+        n = len(self.lines)
+        self.amounts: List[List[Optional[float]]] = [[] for _ in range(n)]  # None se non convertibile
+        self.has_amount: List[bool] = [False] * n  # RE_AMOUNT trova qualcosa (anche in una data)
+        self.labels: List[frozenset] = [frozenset()] * n
+        self.label_lines: Dict[str, List[int]] = {lbl: [] for lbl in INDEX_LABELS}
+        self._idx_piva: Any = _UNSET
+
+        joined = "\x00".join(self.lines)
+        starts = _line_starts(self.lines)
+        dates = [dm.span(0) for dm in DATE_LIKE_ANYWHERE.finditer(joined)]
+        date_starts = [ds for ds, _ in dates]
+        for m in RE_AMOUNT.finditer(joined):
+            start, end = m.span(1)
+            i = bisect_right(starts, start) - 1
+            self.has_amount[i] = True
+            # le date non si sovrappongono: può contenerlo solo l'ultima iniziata prima
+            k = bisect_right(date_starts, start) - 1
+            if k >= 0 and end <= dates[k][1]:
+                continue
+            self.amounts[i].append(_to_float(_clean_amount(m.group(1))))
+
+        low_joined = "\x00".join(self.lower)
+        low_starts = _line_starts(self.lower)
+        hits: Dict[int, set] = {}
+        m = RE_LABELS.search(low_joined)
+        while m:
+            i = bisect_right(low_starts, m.start()) - 1
+            hits.setdefault(i, set()).update(_LABEL_PREFIXES[m.group()])
+            m = RE_LABELS.search(low_joined, m.start() + 1)
+        for i in sorted(hits):
+            self.labels[i] = frozenset(hits[i])
+            for lbl in hits[i]:
+                self.label_lines[lbl].append(i)
+
+    def first_amount(self, i: int) -> Optional[float]:
+        vals = self.amounts[i]
+        return vals[0] if vals else None
+
+    def amount_pairs(self, start: int = 0) -> List[tuple[int, float]]:
+        return [(i, v) for i in range(start, len(self.lines)) for v in self.amounts[i] if v is not None]
+
+    def has_label(self, i: int, labels) -> bool:
+        return not self.labels[i].isdisjoint(labels)
+
+    def lines_with(self, labels) -> List[int]:
+        return sorted(set().union(*(self.label_lines[lbl] for lbl in labels)))
+
+    @property
+    def idx_piva(self) -> Optional[int]:
+        if self._idx_piva is _UNSET:
+            self._idx_piva = next(
+                (i for i, l in enumerate(self.lines) if IVA_LABELED.search(l) or IVA_RAW.search(l)), None
+            )
+        return self._idx_piva
+
 def _is_amount_inside_date(line: str, start: int, end: int) -> bool:
     for dm in DATE_LIKE_ANYWHERE.finditer(line):
         ds, de = dm.span()
@@ -53,13 +159,6 @@ def _is_amount_inside_date(line: str, start: int, end: int) -> bool:
             return True
     return False
 
-def _amount_in_line(s: str) -> Optional[float]:
-    for m in RE_AMOUNT.finditer(s):
-        if _is_amount_inside_date(s, m.start(1), m.end(1)):
-            continue
-        return _to_float(_clean_amount(m.group(1)))
-    return None
-
 def _iva_from_oneline_safe(one_line: str) -> Optional[float]:
     m = RE_IVA_ONELINE.search(one_line)
     if not m:
@@ -85,181 +184,98 @@ def _vat_percent(text: str) -> Optional[float]:
         pass
     return None
 
-def _looks_like_name(s: str) -> bool:
-    s = s.strip()
-    if is_noise_name(s):
+def _looks_like_name_at(idx: "DocIndex", i: int) -> bool:
+    # nome plausibile; le etichette escluse vengono dall'indice
+    s = idx.lines[i]
+    if idx.has_label(i, LABEL_NO_NAME) or is_noise_line(s):
         return False
     words = [w for w in s.split() if w.isalpha()]
     return 2 <= len(words) <= 4 and sum(ch.isdigit() for ch in s) == 0
 
-def _guess_intestatario(ll: List[str], idx_piva: Optional[int]) -> Optional[str]:
+def _guess_intestatario(idx: "DocIndex", idx_piva: Optional[int]) -> Optional[str]:
+    ll = idx.lines
     if idx_piva is not None:
         for look in range(1, 6):
             j = idx_piva - look
             if j < 0:
                 break
-            cand = ll[j].strip()
-            if _looks_like_name(cand):
-                return cand
-    idx_cliente = next((i for i, l in enumerate(ll) if "cliente" in l.lower()), None)
+            if _looks_like_name_at(idx, j):
+                return ll[j]
+    cliente = idx.label_lines["cliente"]
+    idx_cliente = cliente[0] if cliente else None
     for i, cand in enumerate(ll):
         if idx_cliente is not None and abs(i - idx_cliente) <= 2:
             continue
-        if _looks_like_name(cand):
+        if _looks_like_name_at(idx, i):
             return cand
     return None
 
-def _invoice_number_from_lines(ll: List[str]) -> Optional[str]:
-    for i, l in enumerate(ll):
-        if "fattura" in l.lower():
-            m = RE_FATTURA_ONELINE.search(l)
-            if m:
-                cand = m.group(1).strip()
-                if cand and not DATE_LIKE.match(cand) and "." not in cand and CAND_INVOICE.match(cand):
-                    return cand
-            steps = 0
-            j = i + 1
-            while j < len(ll) and steps < 4:
-                nxt = ll[j].strip()
-                if nxt:
-                    low = nxt.lower()
-                    if not DATE_LIKE.match(nxt) and "." not in nxt and not any(lbl in low for lbl in LABELY):
-                        if CAND_INVOICE.match(nxt):
-                            return nxt
-                    steps += 1
-                j += 1
-    return None
-
-# -------- Block parser per importi etichettati --------
-def _find_amount_block(ll: List[str], label: str, window: int = 6) -> Optional[float]:
-    label_l = label.lower()
-    for i, line in enumerate(ll):
-        low = line.lower()
-        if label_l in low:
-            if label_l == "totale" and "imponibile" in low:
-                continue
-            val_same = _amount_in_line(line)
-            if val_same is not None:
-                return val_same
-            steps = 0
-            j = i + 1
-            while j < len(ll) and steps < window:
-                nxt = ll[j].strip()
-                if nxt:
-                    if "%" in nxt and not RE_AMOUNT.search(nxt):
-                        j += 1
-                        continue
-                    v = _amount_in_line(nxt)
-                    if v is not None:
-                        return v
-                    steps += 1
-                j += 1
+def _invoice_number_from_lines(idx: "DocIndex") -> Optional[str]:
+    ll = idx.lines
+    for i in idx.label_lines["fattura"]:
+        m = RE_FATTURA_ONELINE.search(ll[i])
+        if m:
+            cand = m.group(1).strip()
+            if cand and not DATE_LIKE.match(cand) and "." not in cand and CAND_INVOICE.match(cand):
+                return cand
+        steps = 0
+        j = i + 1
+        while j < len(ll) and steps < 4:
+            nxt = ll[j]
+            if not DATE_LIKE.match(nxt) and "." not in nxt and not idx.has_label(j, LABELY):
+                if CAND_INVOICE.match(nxt):
+                    return nxt
+            steps += 1
+            j += 1
     return None
 
 # -------- Lettura esplicita da etichette "Totale ..." --------
-LABELS_IMPONIBILE = ("totale imponibile", "imponibile totale")
-LABELS_IVA        = ("totale iva",)
-LABELS_TOTALE     = ("totale documento", "netto a pagare", "totale fattura")
-
-def _amount_after_label(ll: List[str], labels: tuple[str, ...], window: int = 6, role: Optional[str] = None) -> Optional[float]:
-    for i, line in enumerate(ll):
-        low = line.lower()
-        if any(lbl in low for lbl in labels):
-            steps = 0
-            j = i + 1
-            cands: List[float] = []
-            while j < len(ll) and steps < window:
-                nxt = ll[j].strip()
-                if nxt:
-                    if "%" in nxt and not RE_AMOUNT.search(nxt):
-                        j += 1
-                        continue
-                    v = _amount_in_line(nxt)
-                    if v is not None:
-                        cands.append(v)
-                    steps += 1
+def _amount_after_label(idx: DocIndex, labels: tuple[str, ...], window: int = 6, role: Optional[str] = None) -> Optional[float]:
+    ll = idx.lines
+    for i in idx.lines_with(labels):
+        steps = 0
+        j = i + 1
+        cands: List[float] = []
+        while j < len(ll) and steps < window:
+            if "%" in ll[j] and not idx.has_amount[j]:
                 j += 1
-            if cands:
-                if role == "iva":
-                    return min(cands)              # l'IVA è quasi sempre la più piccola
-                if role == "totale":
-                    return max(cands)              # il totale è quasi sempre il più grande
-                return max(cands)                  # imponibile: tipicamente il più grande fra i candidati
+                continue
+            v = idx.first_amount(j)
+            if v is not None:
+                cands.append(v)
+            steps += 1
+            j += 1
+        if cands:
+            if role == "iva":
+                return min(cands)              # l'IVA è quasi sempre la più piccola
+            if role == "totale":
+                return max(cands)              # il totale è quasi sempre il più grande
+            return max(cands)                  # imponibile: tipicamente il più grande fra i candidati
     return None
 
-def _totals_by_explicit_labels(ll: List[str]) -> Dict[str, Optional[float]]:
+def _totals_by_explicit_labels(idx: DocIndex) -> Dict[str, Optional[float]]:
     return {
-        "imponibile": _amount_after_label(ll, LABELS_IMPONIBILE, window=8, role="imponibile"),
-        "iva":        _amount_after_label(ll, LABELS_IVA,        window=8, role="iva"),
-        "totale":     _amount_after_label(ll, LABELS_TOTALE,     window=8, role="totale"),
+        "imponibile": _amount_after_label(idx, LABELS_IMPONIBILE, window=8, role="imponibile"),
+        "iva":        _amount_after_label(idx, LABELS_IVA,        window=8, role="iva"),
+        "totale":     _amount_after_label(idx, LABELS_TOTALE,     window=8, role="totale"),
     }
 
 # -------- Euristiche sugli importi --------
-def _amounts_with_indexes(ll: List[str]) -> List[tuple[int, float]]:
-    res: List[tuple[int, float]] = []
-    for idx, line in enumerate(ll):
-        for m in RE_AMOUNT.finditer(line):
-            if _is_amount_inside_date(line, m.start(1), m.end(1)):
-                continue
-            v = _to_float(_clean_amount(m.group(1)))
-            if v is not None:
-                res.append((idx, v))
-    return res
-
-def _assign_from_bottom(ll: List[str]) -> Dict[str, Optional[float]]:
-    tail = ll[-20:] if len(ll) > 20 else ll[:]
-    base = len(ll) - len(tail)
-    pairs = []
-    for i, line in enumerate(tail):
-        for m in RE_AMOUNT.finditer(line):
-            if _is_amount_inside_date(line, m.start(1), m.end(1)):
-                continue
-            v = _to_float(_clean_amount(m.group(1)))
-            if v is not None:
-                pairs.append((base + i, v))
-
-    best = {"iva": None, "imponibile": None, "totale": None}
-    best_err = 1e9
-    n = len(pairs)
-    for i in range(n):
-        for j in range(i+1, n):
-            for k in range(j+1, n):
-                a = pairs[i][1]; b = pairs[j][1]; c = pairs[k][1]
-                for iva, imp, tot in ((a,b,c),(a,c,b),(b,a,c),(b,c,a),(c,a,b),(c,b,a)):
-                    if tot < imp or tot < iva:
-                        continue
-                    if tot > 50 and iva < 1:
-                        continue
-                    err = abs((imp + iva) - tot)
-                    if err <= 0.05 and tot >= imp > 0 and iva > 0:
-                        if err < best_err or (abs(err-best_err) <= 0.001 and tot > (best["totale"] or 0)):
-                            best = {"iva": round(iva,2), "imponibile": round(imp,2), "totale": round(tot,2)}
-                            best_err = err
-    return best
-
-def _assign_amounts_by_heuristic(text: str, ll: List[str]) -> Dict[str, Optional[float]]:
-    best = _assign_from_bottom(ll)
+def _amounts_with_indexes(idx: DocIndex) -> List[tuple[int, float]]:
+    return idx.amount_pairs()
+
+def _assign_from_bottom(idx: DocIndex) -> Dict[str, Optional[float]]:
+    # importi delle ultime 20 righe
+    base = max(0, len(idx.lines) - 20)
+    return reconcile([v for _, v in idx.amount_pairs(base)], permutations=True)
+
+def _assign_amounts_by_heuristic(idx: DocIndex) -> Dict[str, Optional[float]]:
+    best = _assign_from_bottom(idx)
     if best["totale"] is not None:
         return best
 
-    vals = sorted(set(round(v,2) for _, v in _amounts_with_indexes(ll)))
-    m = len(vals)
-    best = {"iva": None, "imponibile": None, "totale": None}
-    best_err = 1e9
-    for i in range(m):
-        for j in range(i+1, m):
-            for k in range(j+1, m):
-                iva, imp, tot = vals[i], vals[j], vals[k]
-                if tot < imp or tot < iva:
-                    continue
-                if tot > 50 and iva < 1:
-                    continue
-                err = abs((imp + iva) - tot)
-                if err <= 0.05 and tot >= imp > 0 and iva > 0:
-                    if err < best_err or (abs(err-best_err) <= 0.001 and tot > (best["totale"] or 0)):
-                        best = {"iva": iva, "imponibile": imp, "totale": tot}
-                        best_err = err
-    return best
+    vals = sorted(set(round(v,2) for _, v in _amounts_with_indexes(idx)))
+    return reconcile(vals, permutations=False)
 
 # -------- Utility per anno dominante --------
 def _dominant_year(text: str) -> Optional[int]:
@@ -282,56 +298,482 @@ def _replace_year_iso(date_s: Optional[str], year: int) -> Optional[str]:
         return date_s
 
 # -------- Estrazione testo --------
-def _extract_text_pdfminer(file_bytes: bytes) -> str:
+# Il documento arriva come byte o come percorso di un file su disco (upload
+# grandi, storage locale): col percorso pdfminer legge il file mappato in
+# memoria (mmap: le letture a salti dell'xref non passano da read() e buffer)
+# e pdftoppm/pdfinfo lo aprono direttamente, senza copie né file temporanei
+# per pagina.
+PdfSource = Union[bytes, str]
+
+def _open_source(source: PdfSource) -> IO[bytes]:
+    if not isinstance(source, str):
+        return BytesIO(source)
+    with open(source, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # file vuoto: niente da mappare
+            return BytesIO(b"")
+
+def _extract_text_pdfminer(source: PdfSource) -> str:
     try:
-        return extract_text(BytesIO(file_bytes)) or ""
+        with _open_source(source) as fp:
+            return extract_text(fp) or ""
     except Exception:
         return ""
 
-def _preprocess(img: Image.Image) -> Image.Image:
+def _iter_text_layer(source: PdfSource, max_pages: int = 0) -> Iterator[str]:
+    """
+    Come extract_text di pdfminer ma una pagina alla volta: la concatenazione
+    delle pagine restituite coincide con il testo dell'intero documento.
+    """
+    rsrcmgr = PDFResourceManager(caching=True)
+    with _open_source(source) as fp, StringIO() as out:
+        device = TextConverter(rsrcmgr, out, laparams=LAParams())
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        for page in PDFPage.get_pages(fp, maxpages=max_pages, caching=True):
+            with span("pdfminer"):
+                interpreter.process_page(page)
+            txt = out.getvalue()
+            out.seek(0)
+            out.truncate(0)
+            yield txt
+
+def _page_count(source: PdfSource) -> int:
     try:
-        g = img.convert("L")
+        info = pdfinfo_from_path(source) if isinstance(source, str) else pdfinfo_from_bytes(source)
+        return int(info.get("Pages") or 0)
+    except Exception:
+        return 0
+
+# -------- Preprocessing OCR --------
+THRESHOLD = 180        # soglia fissa, sulla scala dopo l'autocontrasto
+SAUVOLA_BLOCK = 4      # le statistiche locali di Sauvola si calcolano su blocchi 4x4
+_FIXED_LUT = [255 if p > THRESHOLD else 0 for p in range(256)]
+_TRANSPOSE = {90: Image.Transpose.ROTATE_90, 180: Image.Transpose.ROTATE_180, 270: Image.Transpose.ROTATE_270}
+
+def _otsu(hist: List[int]) -> int:
+    """Soglia di Otsu (massima varianza fra le classi) dall'istogramma a 256 livelli."""
+    h = np.asarray(hist[:256], dtype=np.float64)
+    total = h.sum()
+    if total <= 0:
+        return THRESHOLD
+    p = h / total
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1.0 - omega))
+    return int(np.argmax(np.nan_to_num(sigma_b)))
+
+def _box_mean(a: np.ndarray, r: int) -> np.ndarray:
+    # media su finestre (2r+1)x(2r+1) con immagini integrali, bordi replicati
+    n = 2 * r + 1
+    c = np.pad(a, ((r + 1, r), (r + 1, r)), mode="edge").cumsum(0).cumsum(1)
+    return (c[n:, n:] - c[:-n, n:] - c[n:, :-n] + c[:-n, :-n]) / (n * n)
+
+def _sauvola(g: Image.Image) -> Image.Image:
+    """
+    Soglia locale di Sauvola: T = m * (1 + k * (s / R - 1)) su una finestra
+    `ocr_sauvola_window`. Media e varianza sono calcolate per blocchi 4x4 (a
+    strisce, per non allocare l'immagine intera in float) e la superficie di
+    soglia è riportata a piena risoluzione con un resize bilineare.
+    """
+    f = SAUVOLA_BLOCK
+    raw = np.asarray(g)
+    bh, bw = raw.shape[0] // f, raw.shape[1] // f
+    if bh < 1 or bw < 1:
+        return g.point(_FIXED_LUT, "1")
+    mean = np.empty((bh, bw))
+    sq = np.empty((bh, bw))
+    rows = 256
+    for y in range(0, bh, rows):
+        blk = raw[y * f:min(bh, y + rows) * f, :bw * f].astype(np.float32)
+        blk = blk.reshape(-1, f, bw, f)
+        mean[y:y + rows] = blk.mean(axis=(1, 3))
+        sq[y:y + rows] = (blk * blk).mean(axis=(1, 3))
+    r = max(1, settings.ocr_sauvola_window // (2 * f))
+    m = _box_mean(mean, r)
+    s = np.sqrt(np.maximum(_box_mean(sq, r) - m * m, 0.0))
+    t = m * (1.0 + settings.ocr_sauvola_k * (s / 128.0 - 1.0))  # R = 128
+    surface = Image.fromarray(np.clip(np.floor(t), 0, 255).astype(np.uint8), "L").resize(g.size, Image.BILINEAR)
+    # g > T  <=>  g - T > 0 (subtract satura a 0)
+    return ImageChops.subtract(g, surface).point([0] + [255] * 255, "1")
+
+def _preprocess(img: Image.Image, method: Optional[str] = None) -> Image.Image:
+    """
+    Scala di grigi, autocontrasto, ingrandimento 1.5x, sharpen e
+    binarizzazione in un'immagine a 1 bit: quella che va a tesseract e,
+    ruotata, nelle varianti. La soglia è fissa (default: stessi pixel della
+    vecchia pipeline a 8 bit), di Otsu o locale di Sauvola (`ocr_threshold`).
+    """
+    try:
+        method = method or settings.ocr_threshold
+        g = img if img.mode == "L" else img.convert("L")
+        # prima del resize: resize e sharpen saturano a 0/255, quindi
+        # l'autocontrasto non si può spostare dopo senza cambiare i pixel
         g = ImageOps.autocontrast(g)
         w, h = g.size
-        g = g.resize((int(w*1.5), int(h*1.5)))
-        g = g.filter(ImageFilter.SHARPEN)
-        g = g.point(lambda p: 255 if p > 180 else 0)
-        return g
+        g = g.resize((int(w*1.5), int(h*1.5))).filter(ImageFilter.SHARPEN)
+        if method == "sauvola":
+            return _sauvola(g)
+        if method == "otsu":
+            t = _otsu(g.histogram())
+            return g.point([255 if p > t else 0 for p in range(256)], "1")
+        return g.point(_FIXED_LUT, "1")
     except Exception:
         return img
 
-def _ocr_one(img: Image.Image) -> str:
+def _rotate(img: Image.Image, angle: int) -> Image.Image:
+    if not angle:
+        return img
+    op = _TRANSPOSE.get(angle % 360)
+    return img.transpose(op) if op is not None else img.rotate(angle, expand=True, fillcolor=255)
+
+def _ocr_one(img: Image.Image, config: str = "") -> str:
     try:
-        return pytesseract.image_to_string(img, lang="ita+eng")
+        return ocr_engine.image_to_string(img, config=config)
     except Exception:
-        try:
-            return pytesseract.image_to_string(img, lang="eng")
-        except Exception:
-            return ""
+        return ""
 
-def _extract_text_ocr(file_bytes: bytes) -> str:
+def _text_from_data(data: Dict[str, List[Any]]) -> str:
+    """Ricompone il testo dall'output di image_to_data (righe e paragrafi)."""
+    out: List[str] = []
+    line: List[str] = []
+    cur_line = cur_par = None
+    for i, word in enumerate(data.get("text", [])):
+        word = (word or "").strip()
+        if not word:
+            continue
+        par = (data["page_num"][i], data["block_num"][i], data["par_num"][i])
+        key = par + (data["line_num"][i],)
+        if key != cur_line and line:
+            out.append(" ".join(line))
+            line = []
+            if par != cur_par:
+                out.append("")
+        cur_line, cur_par = key, par
+        line.append(word)
+    if line:
+        out.append(" ".join(line))
+    return "\n".join(out) + "\n" if out else ""
+
+def _ocr_one_scored(img: Image.Image) -> tuple[str, Optional[float]]:
+    """Testo + confidenza media delle parole (0-100) in un solo passaggio di tesseract."""
     try:
-        images = convert_from_bytes(file_bytes, dpi=300, first_page=1, last_page=1, fmt="png", thread_count=1)
-        if not images:
-            return ""
-        base = images[0]
-        variants = [_preprocess(base), _preprocess(base.rotate(90, expand=True)), _preprocess(base.rotate(270, expand=True))]
-        candidates: List[str] = [_ocr_one(v) for v in variants]
-        return max(candidates, key=lambda t: len(t.strip())) if candidates else ""
+        data = ocr_engine.image_to_data(img)
     except Exception:
-        return ""
+        return _ocr_one(img), None
+    confs = [float(c) for c, w in zip(data.get("conf", []), data.get("text", [])) if (w or "").strip() and float(c) >= 0]
+    return _text_from_data(data), (round(sum(confs) / len(confs), 1) if confs else None)
+
+ROTATIONS = (0, 90, 270)
+OCR_KEYWORDS = ("fattura", "totale", "iva", "imponibile", "partita")
+
+def _ocr_rotated(img: Image.Image, angle: int, scored: bool = False) -> tuple[str, Optional[float]]:
+    # `img` è già preprocessata (1 bit): si ruota solo quella, niente
+    # preprocessing per ogni variante. Eseguita anche nei processi del pool
+    # OCR: deve restare top-level
+    g = _rotate(img, angle)
+    return _ocr_one_scored(g) if scored else (_ocr_one(g), None)
+
+def _plausible_ocr(text: str) -> bool:
+    """Testo chiaramente leggibile: abbastanza lungo, con parole chiave e importi."""
+    s = text.strip()
+    if len(s) < settings.pdf_min_text_chars:
+        return False
+    low = s.lower()
+    return sum(1 for kw in OCR_KEYWORDS if kw in low) >= 2 and RE_AMOUNT.search(s) is not None
+
+OcrCandidate = tuple[int, str, Optional[float]]  # (rotazione, testo, confidenza parole)
+
+def _longest(candidates: List[OcrCandidate]) -> OcrCandidate:
+    return max(candidates, key=lambda c: len(c[1].strip())) if candidates else (0, "", None)
+
+def _first_plausible(results: Iterator[OcrCandidate]) -> OcrCandidate:
+    """
+    Primo candidato plausibile nell'ordine di ROTATIONS (i successivi non
+    vengono consumati), altrimenti il testo più lungo.
+    """
+    candidates: List[OcrCandidate] = []
+    for cand in results:
+        if _plausible_ocr(cand[1]):
+            return cand
+        candidates.append(cand)
+    return _longest(candidates)
+
+def _ocr_variants_parallel(img: Image.Image, scored: bool = False, submit: Optional[Callable[..., Future]] = None) -> OcrCandidate:
+    """
+    Le tre rotazioni in parallelo (sul pool OCR, o con `submit` altrove),
+    lette nell'ordine di ROTATIONS: vince la prima plausibile, come in
+    seriale, anche se una rotazione successiva finisce prima. All'uscita le
+    varianti rimaste vengono cancellate, ma solo in modo best-effort: un
+    task già passato a un processo (in esecuzione o nella sua coda interna)
+    non si può interrompere dentro tesseract e arriva comunque in fondo,
+    occupando lo slot finché non termina.
+    """
+    submit = submit or ocr_executor.submit
+    futures = [submit(_ocr_rotated, img, angle, scored) for angle in ROTATIONS]
+    try:
+        return _first_plausible((angle, *fut.result()) for angle, fut in zip(ROTATIONS, futures))
+    finally:
+        for fut in futures:
+            fut.cancel()
+
+def _ocr_variants(img: Image.Image, scored: bool = False) -> OcrCandidate:
+    try:
+        if ocr_executor.is_running():
+            return _ocr_variants_parallel(img, scored)
+        if ocr_executor.in_worker():
+            # parsing dentro un processo del pool (extraction_executor): le
+            # rotazioni vanno in thread, tesseract lavora senza GIL
+            pool = ThreadPoolExecutor(max_workers=len(ROTATIONS), thread_name_prefix="ocr-rotation")
+            try:
+                return _ocr_variants_parallel(
+                    img, scored, lambda fn, *a: pool.submit(contextvars.copy_context().run, fn, *a)
+                )
+            finally:
+                pool.shutdown(wait=False, cancel_futures=True)
+    except Exception:
+        pass
+    return _first_plausible((angle, *_ocr_rotated(img, angle, scored)) for angle in ROTATIONS)
 
-def _extract_text_auto(file_bytes: bytes) -> str:
-    txt = _extract_text_pdfminer(file_bytes)
-    if len(txt.strip()) >= 200:
-        return txt
-    ocr_txt = _extract_text_ocr(file_bytes)
-    return ocr_txt if len(ocr_txt.strip()) > len(txt.strip()) else txt
+def _probe_orientation(img: Image.Image, dpi: int = 300) -> tuple[Optional[int], float]:
+    """
+    OSD di tesseract su una miniatura (~150 DPI): restituisce la rotazione da
+    applicare con Image.rotate (gradi antiorari) e la confidenza della stima.
+    """
+    try:
+        factor = dpi // 150
+        thumb = img.reduce(factor) if factor > 1 else img
+        osd = pytesseract.image_to_osd(thumb, output_type=pytesseract.Output.DICT)
+        # "rotate" di tesseract è in senso orario, Image.rotate in senso antiorario
+        return (-int(osd.get("rotate", 0))) % 360, float(osd.get("orientation_conf", 0.0))
+    except Exception:
+        return None, 0.0
+
+def _dpi_levels() -> List[int]:
+    levels = sorted(set(settings.ocr_dpi_levels)) or [300]
+    return levels if settings.ocr_adaptive_dpi else levels[-1:]
+
+def _ocr_score(text: str, word_conf: Optional[float]) -> float:
+    """
+    Qualità dell'OCR in [0, 1]: 1 se il testo porta a importi coerenti
+    (imponibile + iva = totale), altrimenti la confidenza media delle parole.
+    """
+    if text.strip():
+        f = _parse_from_text(text)["fields"]
+        imp, iva, tot = f.get("imponibile"), f.get("iva"), f.get("totale")
+        if imp is not None and iva is not None and tot is not None and abs((imp + iva) - tot) <= 0.05:
+            return 1.0
+    return (word_conf or 0.0) / 100.0
+
+# -------- OCR per regioni (intestazione / riquadro totali) --------
+ROI_MIN_LINES = 6      # sotto questo numero di righe di testo si fa subito la pagina intera
+ROI_PAD = 8            # pixel di margine attorno a ogni banda
+
+def _text_lines(img: Image.Image) -> List[tuple[int, int]]:
+    """
+    Righe di testo (inizio, fine) dal profilo di proiezione orizzontale
+    dell'immagine a 1 bit: una riga è una sequenza di righe di pixel con
+    abbastanza inchiostro.
+    """
+    ink = ~np.asarray(img.convert("1"))
+    rows = ink.sum(axis=1) > max(2, img.width // 500)
+    edges = np.diff(np.concatenate(([0], rows.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+def _roi_bands(img: Image.Image) -> Optional[tuple[tuple[int, int], tuple[int, int]]]:
+    """
+    Bande (alto, basso) di intestazione e piè di pagina: le righe nella prima
+    `ocr_roi_header` e nell'ultima `ocr_roi_footer` frazione dell'area scritta,
+    tagliate fra una riga e l'altra. None se il documento è troppo corto o le
+    bande si toccano (tanto vale OCR della pagina intera).
+    """
+    lines = _text_lines(img)
+    if len(lines) < ROI_MIN_LINES:
+        return None
+    top, bottom = lines[0][0], lines[-1][1]
+    height = bottom - top
+    head = [l for l in lines if l[0] < top + settings.ocr_roi_header * height]
+    foot = [l for l in lines if l[1] > bottom - settings.ocr_roi_footer * height]
+    if not head or not foot or head[-1][1] >= foot[0][0]:
+        return None
+    return (
+        (max(0, top - ROI_PAD), head[-1][1] + ROI_PAD),
+        (foot[0][0] - ROI_PAD, min(img.height, bottom + ROI_PAD)),
+    )
+
+def _fmt_amount(v: float) -> str:
+    return f"{v:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+def _ocr_roi(img: Image.Image) -> Optional[str]:
+    """
+    OCR della sola intestazione (configurazione normale) e del riquadro
+    totali (whitelist di cifre e `,.€%`). La whitelist toglie le etichette: gli
+    importi letti vengono riconciliati (imponibile + iva = totale) e riscritti
+    con le etichette canoniche, così il testo restituito si analizza come
+    quello di un OCR completo. None se intestazione e importi non bastano a
+    `_parse_from_text`: si passa alla pagina intera.
+    """
+    bands = _roi_bands(img)
+    if bands is None:
+        return None
+    (h0, h1), (f0, f1) = bands
+    header = _ocr_one(img.crop((0, h0, img.width, h1)))
+    band = _ocr_one(
+        img.crop((0, f0, img.width, f1)),
+        config=f"--psm 6 -c tessedit_char_whitelist={settings.ocr_amount_whitelist}",
+    )
+    vals = sorted(set(round(v, 2) for _, v in DocIndex(band).amount_pairs()))
+    found = reconcile(vals, permutations=False)
+    if found["totale"] is None:
+        return None
+    text = _roi_text(header, found)
+    return text if _is_complete(_parse_from_text(text)["fields"]) else None
+
+def _roi_text(header: str, found: Dict[str, Optional[float]]) -> str:
+    """
+    Testo sintetico per gli importi riconciliati. _amount_after_label cerca
+    nelle righe *dopo* l'etichetta (max per totale/imponibile, min per l'IVA):
+    ogni importo va sulla riga sotto la sua etichetta, in ordine totale,
+    imponibile, IVA, così ogni finestra vede solo importi non più grandi.
+    """
+    return (
+        f"{header.rstrip()}\n\n"
+        f"Totale documento\n{_fmt_amount(found['totale'])}\n"
+        f"Totale imponibile\n{_fmt_amount(found['imponibile'])}\n"
+        f"Totale IVA\n{_fmt_amount(found['iva'])}\n"
+    )
+
+@timed("ocr_render")
+def _render_page(source: PdfSource, page: int, dpi: int) -> Optional[Image.Image]:
+    convert = convert_from_path if isinstance(source, str) else convert_from_bytes
+    images = convert(source, dpi=dpi, first_page=page, last_page=page, fmt="png", thread_count=1)
+    # scala di grigi prima di ruotare: stesso risultato di _preprocess,
+    # ma un terzo dei byte da passare ai processi OCR
+    return images[0].convert("L") if images else None
+
+@timed("ocr")
+def _ocr_page(source: PdfSource, page: int = 1) -> Dict[str, Any]:
+    """
+    OCR di una pagina. Prima la sonda di orientamento e un solo OCR; le tre
+    varianti ruotate solo se la sonda è incerta (o il testo esce vuoto).
+    In modalità adattiva si parte dal DPI più basso e si ri-renderizza a DPI
+    più alto solo se il punteggio resta sotto `ocr_min_score`. Con `ocr_roi`
+    e orientamento certo si provano prima solo intestazione e totali.
+    """
+    info: Dict[str, Any] = {
+        "page": page, "text": "", "angle": None, "confidence": None, "fallback": False,
+        "dpi": None, "escalations": 0, "word_conf": None, "roi": False,
+    }
+    try:
+        levels = _dpi_levels()
+        scored = len(levels) > 1
+        probe: Optional[tuple[Optional[int], float]] = None
+        best: Optional[Dict[str, Any]] = None
+        best_score = -1.0
+        for step, dpi in enumerate(levels):
+            base = _render_page(source, page, dpi)
+            if base is None:
+                break
+            if probe is None:
+                # l'orientamento non dipende dal DPI: una sola sonda per pagina
+                probe = _probe_orientation(base, dpi)
+            angle, conf = probe
+            # un solo preprocessing per rendering: le rotazioni lavorano sull'immagine a 1 bit
+            prep = _preprocess(base)
+            res: Dict[str, Any] = {"confidence": round(conf, 2) if angle is not None else None, "dpi": dpi, "escalations": step}
+            txt, wconf = "", None
+            if angle is not None and conf >= settings.ocr_osd_min_conf:
+                roi_txt = _ocr_roi(_rotate(prep, angle)) if settings.ocr_roi else None
+                if roi_txt is not None:
+                    # intestazione e importi completi: niente OCR della pagina intera
+                    res.update(angle=angle, fallback=False, roi=True, text=roi_txt, word_conf=None)
+                    best = res
+                    break
+                txt, wconf = _ocr_rotated(prep, angle, scored)
+                res.update(angle=angle, fallback=False)
+            if not txt.strip():
+                angle, txt, wconf = _ocr_variants(prep, scored)
+                res.update(angle=angle, fallback=True)
+            res.update(text=txt, word_conf=wconf)
+            score = _ocr_score(txt, wconf) if scored else 1.0
+            if score > best_score:
+                best, best_score = res, score
+            if score >= settings.ocr_min_score:
+                break
+        if best is not None:
+            info.update(best)
+            info["escalations"] = step
+        return info
+    except Exception:
+        return info
+
+def _extract_text_ocr(source: PdfSource, page: int = 1) -> str:
+    return _ocr_page(source, page)["text"]
+
+def _iter_pages(source: PdfSource, max_pages: Optional[int] = None, workers: Optional[int] = None) -> Iterator[tuple[str, Optional[Dict[str, Any]]]]:
+    """
+    Restituisce (testo, info OCR) pagina per pagina, in ordine: text layer di
+    pdfminer e OCR solo per le pagine con poco testo (info è None se l'OCR non
+    è stato eseguito). Le pagine da OCR sono renderizzate in parallelo (al
+    massimo `workers` in volo); se il consumatore si ferma (early exit) il
+    lavoro ancora in coda viene cancellato.
+    """
+    max_pages = settings.pdf_max_pages if max_pages is None else max_pages
+    workers = max(1, settings.pdf_page_workers if workers is None else workers)
+    min_chars = settings.pdf_min_text_chars
+
+    def _layer_pages() -> Iterator[str]:
+        done = 0
+        try:
+            for txt in _iter_text_layer(source, max_pages=max_pages):
+                done += 1
+                yield txt
+        except Exception:
+            # PDF non leggibile da pdfminer: le pagine restanti passano in OCR
+            n = _page_count(source)
+            if max_pages:
+                n = min(n, max_pages)
+            for _ in range(done, n):
+                yield ""
+
+    def _resolve(txt: str, f: Optional[Future]) -> tuple[str, Optional[Dict[str, Any]]]:
+        if f is None:
+            return txt, None
+        info = f.result()
+        ocr_txt = info.pop("text")
+        return (ocr_txt if len(ocr_txt.strip()) > len(txt.strip()) else txt), info
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-page")
+    pending: Deque[tuple[str, Optional[Future]]] = deque()
+    try:
+        for page_no, layer_txt in enumerate(_layer_pages(), start=1):
+            fut = None
+            if len(layer_txt.strip()) < min_chars:
+                # copia del contesto: gli span dell'OCR restano della richiesta corrente
+                fut = pool.submit(contextvars.copy_context().run, _ocr_page, source, page_no)
+            pending.append((layer_txt, fut))
+            # finestra piena: restituisci la pagina più vecchia prima di proseguire
+            while len(pending) > workers or (pending and pending[0][1] is None):
+                yield _resolve(*pending.popleft())
+        while pending:
+            yield _resolve(*pending.popleft())
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _iter_page_texts(source: PdfSource, max_pages: Optional[int] = None, workers: Optional[int] = None) -> Iterator[str]:
+    with closing(_iter_pages(source, max_pages=max_pages, workers=workers)) as pages:
+        for txt, _info in pages:
+            yield txt
+
+def _extract_text_auto(source: PdfSource) -> str:
+    return "".join(_iter_page_texts(source))
 
 # -------- Parsing principale --------
+@timed("parse_text")
 def _parse_from_text(text: str) -> Dict[str, Any]:
-    ll = split_lines(text)
-    one_line = re.sub(r"[\r\n]+", " ", text)
+    idx = DocIndex(text)
+    one_line = idx.one_line
 
     # P.IVA / CF
     piva = first_match(IVA_LABELED, text) or first_match(IVA_RAW, text)
@@ -342,7 +784,7 @@ def _parse_from_text(text: str) -> Dict[str, Any]:
     currency = "EUR" if ("€" in text or first_match(CURRENCY_REGEX, text)) else "EUR"
 
     # === Importi da etichette esplicite (PRIORITARI) ===
-    lbl = _totals_by_explicit_labels(ll)
+    lbl = _totals_by_explicit_labels(idx)
     imponibile = lbl.get("imponibile")
     iva        = lbl.get("iva")
     totale     = lbl.get("totale")
@@ -374,7 +816,7 @@ def _parse_from_text(text: str) -> Dict[str, Any]:
     # --- Importi (fallback 3): euristica
     incoerente = (imponibile is not None and iva is not None and totale is not None and abs((imponibile + iva) - totale) > 0.05)
     if (imponibile is None or iva is None or totale is None) or incoerente:
-        guess = _assign_amounts_by_heuristic(text, ll)
+        guess = _assign_amounts_by_heuristic(idx)
         if iva is None or incoerente:
             if guess["iva"] is not None: iva = guess["iva"]
         if imponibile is None or incoerente:
@@ -428,7 +870,7 @@ def _parse_from_text(text: str) -> Dict[str, Any]:
             pass
 
     # Numero fattura
-    invoice_number = _invoice_number_from_lines(ll)
+    invoice_number = _invoice_number_from_lines(idx)
     if not invoice_number:
         m = RE_FATTURA_ONELINE.search(one_line)
         if m:
@@ -439,8 +881,7 @@ def _parse_from_text(text: str) -> Dict[str, Any]:
         invoice_number = first_match(INVOICE_NO_REGEX, text)
 
     # Intestatario
-    idx_piva = next((i for i, l in enumerate(ll) if IVA_LABELED.search(l) or IVA_RAW.search(l)), None)
-    intestatario = _guess_intestatario(ll, idx_piva)
+    intestatario = _guess_intestatario(idx, idx.idx_piva)
 
     # P.IVA → canonicalizza
     if piva:
@@ -466,6 +907,36 @@ def _parse_from_text(text: str) -> Dict[str, Any]:
         "righe": []
     }
 
-def parse_pdf_invoice(file_bytes: bytes) -> Dict[str, Any]:
-    text = _extract_text_auto(file_bytes)
-    return _parse_from_text(text)
+# -------- Early exit multi-pagina --------
+HEADER_FIELDS = ("intestatario", "partita_iva", "invoice_number", "data_emissione")
+
+def _is_complete(fields: Dict[str, Any]) -> bool:
+    if any(fields.get(k) is None for k in HEADER_FIELDS):
+        return False
+    imp, iva, tot = fields.get("imponibile"), fields.get("iva"), fields.get("totale")
+    if imp is None or iva is None or tot is None:
+        return False
+    return abs((imp + iva) - tot) <= 0.05
+
+def parse_pdf_invoice(source: PdfSource) -> Dict[str, Any]:
+    # Le pagine arrivano una alla volta: ci si ferma appena intestazione e
+    # importi (imponibile + iva = totale) sono completi.
+    text = ""
+    parsed: Optional[Dict[str, Any]] = None
+    ocr_pages: List[Dict[str, Any]] = []
+    read = 0
+    with closing(_iter_pages(source)) as pages:
+        for page_text, info in pages:
+            read += 1
+            if info is not None:
+                ocr_pages.append(info)
+            text += page_text
+            parsed = _parse_from_text(text)
+            if _is_complete(parsed["fields"]):
+                break
+    if parsed is None:
+        parsed = _parse_from_text(text)
+    parsed["pages"] = read  # pagine lette davvero (l'uscita anticipata salta le altre)
+    if ocr_pages:
+        parsed["ocr"] = {"pages": ocr_pages}
+    return parsed
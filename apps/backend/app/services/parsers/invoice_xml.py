@@ -1,15 +1,12 @@
-from typing import Dict, Any, List, Optional
+from io import BytesIO
+from typing import Dict, Any, Iterator, List, Optional, Tuple, Union
 from lxml import etree
 
+from ...utils.timing import timed
+
 def _txt(node: Optional[etree._Element]) -> Optional[str]:
     return node.text.strip() if node is not None and node.text else None
 
-def _first(root, tag: str) -> Optional[etree._Element]:
-    if root is None:
-        return None
-    res = root.xpath(f".//*[local-name()='{tag}']")
-    return res[0] if res else None
-
 def _to_float_str(s: Optional[str]) -> Optional[float]:
     """
     Converte stringhe numeriche in float gestendo:
@@ -38,71 +35,215 @@ def _to_float_str(s: Optional[str]) -> Optional[float]:
     except Exception:
         return None
 
-def parse_xml_fatturapa(file_bytes: bytes) -> Dict[str, Any]:
-    parser = etree.XMLParser(recover=True, huge_tree=True)
-    xml = etree.fromstring(file_bytes, parser=parser)
+# Parsing in streaming (iterparse, un solo passaggio): per ogni campo vale il
+# primo elemento con quel nome locale (namespace ignorato) dentro il
+# contenitore indicato, in ordine di documento, come faceva la vecchia XPath
+# `.//*[local-name()='X']`. Le righe (DettaglioLinee) escono man mano che si
+# chiudono e ogni elemento chiuso viene svuotato: la memoria resta costante
+# anche con migliaia di righe.
+#
+# Un file può essere un lotto: un solo FatturaElettronicaHeader (cedente) e
+# più FatturaElettronicaBody, uno per fattura. I dati del documento si
+# cercano dentro ciascun body; senza body (XML non standard) vale il primo
+# del file.
+#
+# Spec: nome locale -> None (foglia: se ne legge il testo) oppure sotto-spec
+# (contenitore: vale solo il primo, e i campi si cercano al suo interno).
+_HEADER_SPEC: Dict[str, Any] = {
+    "CedentePrestatore": {
+        "Anagrafica": {"Denominazione": None, "Nome": None, "Cognome": None},
+        "IdFiscaleIVA": {"IdPaese": None, "IdCodice": None},
+        "CodiceFiscale": None,
+    },
+}
+_BODY_TAG = "FatturaElettronicaBody"
+_BODY_SPEC: Dict[str, Any] = {
+    "DatiGeneraliDocumento": {
+        "Numero": None,
+        "Data": None,
+        "Divisa": None,
+        "ImportoTotaleDocumento": None,
+        "TotaleImposta": None,
+        "TotaleImponibile": None,
+    },
+    "DettaglioPagamento": {"DataScadenzaPagamento": None},
+}
+_LINE_TAG = "DettaglioLinee"
+_LINE_SPEC: Dict[str, Any] = {
+    "Descrizione": None,
+    "Quantita": None,
+    "PrezzoUnitario": None,
+    "AliquotaIVA": None,
+    "PrezzoTotale": None,
+}
 
-    # Cedente/Prestatore
-    cedente = _first(xml, "CedentePrestatore")
-    anagrafica = _first(cedente, "Anagrafica") if cedente is not None else None
-    denominazione = _first(anagrafica, "Denominazione") if anagrafica is not None else None
-    nome = _first(anagrafica, "Nome") if anagrafica is not None else None
-    cognome = _first(anagrafica, "Cognome") if anagrafica is not None else None
 
-    intestatario = _txt(denominazione) if denominazione is not None else None
+class _Scope:
+    """Contenitore aperto: raccoglie in `out` il primo `prefix + nome` di ogni campo."""
+
+    __slots__ = ("spec", "out", "prefix", "claimed")
+
+    def __init__(self, spec: Dict[str, Any], out: Dict[str, Optional[str]], prefix: str = "") -> None:
+        self.spec = spec
+        self.out = out
+        self.prefix = prefix
+        self.claimed: set = set()
+
+
+def _local(tag: Any) -> Optional[str]:
+    if not isinstance(tag, str):
+        return None
+    return tag.rpartition("}")[2]
+
+
+def _line(values: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    def _num(tag: str) -> float:
+        return _to_float_str(values.get(tag)) or 0.0
+
+    return {
+        "descrizione": values.get("Descrizione"),
+        "qta": _num("Quantita"),
+        "prezzo_unitario": _num("PrezzoUnitario"),
+        "aliquota_iva": _num("AliquotaIVA"),
+        "totale_riga": _num("PrezzoTotale"),
+    }
+
+
+def _fields(v: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    # Cedente/Prestatore
+    intestatario = v.get("CedentePrestatore/Anagrafica/Denominazione")
     if not intestatario:
-        intestatario = " ".join([p for p in [_txt(nome), _txt(cognome)] if p])
+        intestatario = " ".join([p for p in [
+            v.get("CedentePrestatore/Anagrafica/Nome"),
+            v.get("CedentePrestatore/Anagrafica/Cognome"),
+        ] if p])
 
     # P.IVA
-    id_fiscale = _first(cedente, "IdFiscaleIVA") if cedente is not None else None
-    id_paese = _first(id_fiscale, "IdPaese") if id_fiscale is not None else None
-    id_codice = _first(id_fiscale, "IdCodice") if id_fiscale is not None else None
-    paese = _txt(id_paese) or "IT"
-    codice = _txt(id_codice)
+    paese = v.get("CedentePrestatore/IdFiscaleIVA/IdPaese") or "IT"
+    codice = v.get("CedentePrestatore/IdFiscaleIVA/IdCodice")
     partita_iva = f"{paese}{codice}" if codice else None
 
-    # Codice Fiscale (se presente)
-    codice_fiscale = _txt(_first(cedente, "CodiceFiscale")) if cedente is not None else None
+    return {
+        "intestatario": intestatario,
+        "partita_iva": partita_iva,
+        "codice_fiscale": v.get("CedentePrestatore/CodiceFiscale"),
+        "invoice_number": v.get("DatiGeneraliDocumento/Numero"),
+        "data_emissione": v.get("DatiGeneraliDocumento/Data"),
+        "data_scadenza": v.get("DettaglioPagamento/DataScadenzaPagamento"),
+        "valuta": v.get("DatiGeneraliDocumento/Divisa") or "EUR",
+        "imponibile": _to_float_str(v.get("DatiGeneraliDocumento/TotaleImponibile")),
+        "iva": _to_float_str(v.get("DatiGeneraliDocumento/TotaleImposta")),
+        "totale": _to_float_str(v.get("DatiGeneraliDocumento/ImportoTotaleDocumento")),
+    }
+
+
+def iter_fatturapa(source: Union[bytes, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Scorre una FatturaPA (bytes, percorso o file aperto in binario) in un solo
+    passaggio. Produce ("riga", riga) per ogni DettaglioLinee e ("fields",
+    campi) alla fine di ogni FatturaElettronicaBody (o del file, se non ce ne
+    sono): le righe appartengono alla fattura del "fields" che le segue.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    header: Dict[str, Optional[str]] = {}
+    whole: Dict[str, Optional[str]] = {}
+    doc = [_Scope(_HEADER_SPEC, header), _Scope(_BODY_SPEC, whole)]
+    bodies = 0
+    in_body = False
+    scopes: List[_Scope] = []
+    actions: List[Optional[list]] = []  # per ogni elemento aperto: cosa fare alla chiusura
+    pending: List[Dict[str, Optional[str]]] = []
+    open_lines = 0
+    seen_root = False
+
+    for event, elem in etree.iterparse(source, events=("start", "end"), recover=True, huge_tree=True):
+        if event == "start":
+            name = _local(elem.tag)
+            todo = None
+            for scope in scopes:
+                if name not in scope.spec or name in scope.claimed:
+                    continue
+                scope.claimed.add(name)
+                sub = scope.spec[name]
+                key = scope.prefix + name
+                todo = todo or []
+                if sub is None:
+                    todo.append(("leaf", scope.out, key))
+                else:
+                    child = _Scope(sub, scope.out, key + "/")
+                    todo.append(("scope", child))
+            if name == _LINE_TAG:
+                values: Dict[str, Optional[str]] = {}
+                pending.append(values)
+                open_lines += 1
+                todo = todo or []
+                todo.append(("scope", _Scope(_LINE_SPEC, values)))
+                todo.append(("line",))
+            elif name == _BODY_TAG and not in_body:
+                in_body = True
+                body: Dict[str, Optional[str]] = {}
+                todo = todo or []
+                todo.append(("scope", _Scope(_BODY_SPEC, body)))
+                todo.append(("body", body))
+            for action in todo or ():
+                if action[0] == "scope":
+                    scopes.append(action[1])
+            if not actions and not seen_root:
+                seen_root = True
+                # la radice non è fra i discendenti di sé stessa: i campi
+                # d'intestazione si cercano dentro
+                scopes[:0] = doc
+            actions.append(todo)
+            continue
+
+        for action in actions.pop() or ():
+            kind = action[0]
+            if kind == "leaf":
+                action[1][action[2]] = _txt(elem)
+            elif kind == "scope":
+                scopes.remove(action[1])
+            elif kind == "line":
+                open_lines -= 1
+                if not open_lines:
+                    for values in pending:
+                        yield "riga", _line(values)
+                    pending.clear()
+            elif kind == "body":
+                bodies += 1
+                in_body = False
+                yield "fields", _fields({**header, **action[1]})
+        # elemento chiuso: via il contenuto e i fratelli già letti
+        elem.clear()
+        parent = elem.getparent()
+        if parent is not None:
+            while elem.getprevious() is not None:
+                del parent[0]
 
-    # Dati documento
-    dati_generali_doc = _first(xml, "DatiGeneraliDocumento")
-    invoice_number = _txt(_first(dati_generali_doc, "Numero")) if dati_generali_doc is not None else None
-    issue_date = _txt(_first(dati_generali_doc, "Data")) if dati_generali_doc is not None else None
-    currency = _txt(_first(dati_generali_doc, "Divisa")) if dati_generali_doc is not None else "EUR"
-    total = _to_float_str(_txt(_first(dati_generali_doc, "ImportoTotaleDocumento"))) if dati_generali_doc is not None else None
-    iva = _to_float_str(_txt(_first(dati_generali_doc, "TotaleImposta"))) if dati_generali_doc is not None else None
-    imponibile = _to_float_str(_txt(_first(dati_generali_doc, "TotaleImponibile"))) if dati_generali_doc is not None else None
+    if not seen_root:
+        raise ValueError("XML senza elementi leggibili")
+    if not bodies:
+        yield "fields", _fields({**header, **whole})
 
-    # Scadenza (se presente)
-    dettaglio_pag = _first(xml, "DettaglioPagamento")
-    due_date = _txt(_first(dettaglio_pag, "DataScadenzaPagamento")) if dettaglio_pag is not None else None
 
-    # Linee
+def iter_invoices(source: Union[bytes, Any]) -> Iterator[Dict[str, Any]]:
+    """Una fattura ({"fields", "righe"}) per FatturaElettronicaBody, man mano che si legge."""
     lines: List[Dict[str, Any]] = []
-    for det in xml.xpath("//*[local-name()='DettaglioLinee']"):
-        def _num(tag: str) -> float:
-            return _to_float_str(_txt(_first(det, tag))) or 0.0
-
-        lines.append({
-            "descrizione": _txt(_first(det, "Descrizione")),
-            "qta": _num("Quantita"),
-            "prezzo_unitario": _num("PrezzoUnitario"),
-            "aliquota_iva": _num("AliquotaIVA"),
-            "totale_riga": _num("PrezzoTotale"),
-        })
+    for kind, item in iter_fatturapa(source):
+        if kind == "riga":
+            lines.append(item)
+        else:
+            yield {"fields": item, "righe": lines}
+            lines = []
 
-    return {
-        "fields": {
-            "intestatario": intestatario,
-            "partita_iva": partita_iva,
-            "codice_fiscale": codice_fiscale,
-            "invoice_number": invoice_number,
-            "data_emissione": issue_date,
-            "data_scadenza": due_date,
-            "valuta": currency or "EUR",
-            "imponibile": imponibile,
-            "iva": iva,
-            "totale": total
-        },
-        "righe": lines
-    }
+
+@timed("parse_xml")
+def parse_xml_fatturapa(file_bytes: bytes) -> Dict[str, Any]:
+    """Prima (di solito unica) fattura del file; per i lotti v. parse_xml_lotto."""
+    return next(iter_invoices(file_bytes))
+
+
+@timed("parse_xml")
+def parse_xml_lotto(file_bytes: bytes) -> Dict[str, Any]:
+    """Tutte le fatture del file, in ordine: {"fatture": [{"fields", "righe"}, ...]}."""
+    return {"fatture": list(iter_invoices(file_bytes))}
@@ -1,6 +1,12 @@
 import uuid
-from typing import List, Dict, Any, Optional
-from .db import execute
+from itertools import islice
+from typing import Callable, Iterable, List, Dict, Any, Optional, Sequence
+
+import psycopg2.extras
+
+from ..core.config import settings
+from .db import execute, transaction
+from ..utils.timing import timed
 
 def _to_float(x) -> float:
     try:
@@ -17,6 +23,62 @@ def _norm_aliquota(v: float) -> float:
         return round(v / 100.0, 3)
     return round(v, 3)
 
+_HEADER_COLUMNS = """
+  id, s3_bucket, s3_key, filename, invoice_number, intestatario, partita_iva,
+  codice_fiscale, issue_date, due_date, currency, imponibile, iva, totale
+"""
+_LINE_COLUMNS = "id, invoice_id, line_number, descrizione, qta, prezzo_unitario, aliquota_iva, totale_riga"
+
+_INSERT_LINE = f"""
+INSERT INTO invoice_lines ({_LINE_COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+# content_sha256 (layout per contenuto, infra/db/init.sql) si scrive solo con
+# s3_content_addressed attivo: i database creati prima possono non avere la
+# colonna finché non si applica l'ALTER TABLE.
+def _with_sha256() -> bool:
+    return bool(settings.s3_content_addressed)
+
+
+def _header_columns() -> str:
+    return _HEADER_COLUMNS.rstrip() + (",\n  content_sha256\n" if _with_sha256() else "\n")
+
+
+def _insert_header_sql() -> str:
+    columns = _header_columns()
+    return f"INSERT INTO invoices ({columns}) VALUES ({', '.join(['%s'] * (columns.count(',') + 1))})"
+
+
+def _header_params(
+    id, s3_bucket, s3_key, filename, invoice_number, intestatario, partita_iva,
+    codice_fiscale, issue_date, due_date, currency, imponibile, iva, totale,
+    content_sha256=None,
+) -> tuple:
+    params = (
+        id, s3_bucket, s3_key, filename, invoice_number, intestatario, partita_iva,
+        codice_fiscale, issue_date, due_date, currency,
+        None if imponibile is None else round(_to_float(imponibile), 2),
+        None if iva is None else round(_to_float(iva), 2),
+        None if totale is None else round(_to_float(totale), 2),
+    )
+    return params + (content_sha256,) if _with_sha256() else params
+
+
+def _line_params(invoice_id: str, lines: List[Dict[str, Any]]) -> List[tuple]:
+    rows = []
+    for idx, line in enumerate(lines, start=1):
+        line_id = str(uuid.uuid4())
+        descrizione = line.get("descrizione")
+        qta = _to_float(line.get("qta", 0))
+        prezzo_unitario = round(_to_float(line.get("prezzo_unitario", 0)), 2)
+        aliquota_iva = _norm_aliquota(_to_float(line.get("aliquota_iva", 0)))
+        totale_riga = round(_to_float(line.get("totale_riga", qta * prezzo_unitario * (1 + aliquota_iva/100.0))), 2)
+        rows.append((line_id, invoice_id, idx, descrizione, qta, prezzo_unitario, aliquota_iva, totale_riga))
+    return rows
+
+
+@timed("db_header")
 def insert_invoice_header(
     *,
     id: str,
@@ -33,39 +95,106 @@ def insert_invoice_header(
     imponibile: Optional[float],
     iva: Optional[float],
     totale: Optional[float],
+    content_sha256: Optional[str] = None,
 ):
-    query = """
-    INSERT INTO invoices (
-      id, s3_bucket, s3_key, filename, invoice_number, intestatario, partita_iva,
-      codice_fiscale, issue_date, due_date, currency, imponibile, iva, totale
-    ) VALUES (
-      %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-    )
-    """
-    params = (
+    execute(_insert_header_sql(), _header_params(
         id, s3_bucket, s3_key, filename, invoice_number, intestatario, partita_iva,
-        codice_fiscale, issue_date, due_date, currency,
-        None if imponibile is None else round(_to_float(imponibile), 2),
-        None if iva is None else round(_to_float(iva), 2),
-        None if totale is None else round(_to_float(totale), 2),
-    )
-    execute(query, params)
+        codice_fiscale, issue_date, due_date, currency, imponibile, iva, totale,
+        content_sha256,
+    ))
 
+@timed("db_lines")
 def insert_invoice_lines(*, invoice_id: str, lines: List[Dict[str, Any]]):
     if not lines:
         return
-    for idx, line in enumerate(lines, start=1):
-        line_id = str(uuid.uuid4())
-        descrizione = line.get("descrizione")
-        qta = _to_float(line.get("qta", 0))
-        prezzo_unitario = round(_to_float(line.get("prezzo_unitario", 0)), 2)
-        aliquota_iva = _norm_aliquota(_to_float(line.get("aliquota_iva", 0)))
-        totale_riga = round(_to_float(line.get("totale_riga", qta * prezzo_unitario * (1 + aliquota_iva/100.0))), 2)
+    for params in _line_params(invoice_id, lines):
+        execute(_INSERT_LINE, params)
+
+
+# Un oggetto S3 può essere referenziato da più fatture (lotti, layout per
+# contenuto): il conteggio dei riferimenti sono le righe di `invoices` con
+# quella chiave. Chi inserisce prende un advisory lock condiviso sulla chiave,
+# chi cancella l'oggetto lo prende esclusivo, entrambi fino al commit: un
+# oggetto non viene mai cancellato mentre una nuova fattura lo sta adottando.
+
+def _lock_objects(cur, keys: Sequence[tuple], shared: bool) -> None:
+    fn = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+    names = sorted({f"{bucket}/{key}" for bucket, key in keys})
+    cur.execute(f"SELECT {fn}(hashtextextended(k, 0)) FROM unnest(%s::text[]) AS k", (names,))
+
+
+def _release_object(cur, bucket: str, key: str, delete_object: Callable[..., None]) -> bool:
+    cur.execute("SELECT 1 FROM invoices WHERE s3_bucket = %s AND s3_key = %s LIMIT 1", (bucket, key))
+    if cur.fetchone() is not None:
+        return False
+    # dentro la transazione: se S3 fallisce il rollback lascia tutto com'era
+    delete_object(key, bucket=bucket)
+    return True
+
+
+def _insert_chunk(cur, items: List[Dict[str, Any]], page_size: int) -> None:
+    headers = [_header_params(**it["header"]) for it in items]
+    lines = [row for it in items for row in _line_params(it["header"]["id"], it.get("righe") or [])]
+    _lock_objects(cur, [(it["header"]["s3_bucket"], it["header"]["s3_key"]) for it in items], shared=True)
+    psycopg2.extras.execute_values(
+        cur, f"INSERT INTO invoices ({_header_columns()}) VALUES %s", headers, page_size=page_size
+    )
+    if lines:
+        psycopg2.extras.execute_values(
+            cur, f"INSERT INTO invoice_lines ({_LINE_COLUMNS}) VALUES %s", lines, page_size=page_size
+        )
+
+
+@timed("db_batch")
+def insert_invoices_batch(
+    items: Iterable[Dict[str, Any]],
+    page_size: int = 500,
+    before_commit: Optional[Callable[[], None]] = None,
+) -> int:
+    """
+    Inserisce molte fatture in un'unica transazione e ne ritorna il numero.
+    Gli item si consumano `page_size` alla volta (una INSERT multi-riga per
+    blocco): da un generatore, come i body di un lotto letti man mano, in
+    memoria c'è un blocco solo. Ogni item ha "header" (gli argomenti di
+    insert_invoice_header) e "righe". Se fallisce, non resta niente della
+    batch. `before_commit` gira con i lock sugli oggetti S3 presi (es. per
+    verificare che l'oggetto esista ancora).
+    """
+    rest = iter(items)
+    chunk = list(islice(rest, page_size))
+    if not chunk:
+        return 0
+    count = 0
+    with transaction() as cur:
+        while chunk:
+            _insert_chunk(cur, chunk, page_size)
+            count += len(chunk)
+            chunk = list(islice(rest, page_size))
+        if before_commit is not None:
+            before_commit()
+    return count
+
+
+@timed("db_delete")
+def delete_invoice(invoice_id: str, delete_object: Callable[..., None]) -> bool:
+    """
+    Cancella la fattura (e le righe); l'oggetto S3 solo se nessun'altra
+    fattura lo referenzia. False se la fattura non esiste.
+    """
+    with transaction() as cur:
+        cur.execute("SELECT s3_bucket, s3_key FROM invoices WHERE id = %s", (invoice_id,))
+        row = cur.fetchone()
+        if row is None:
+            return False
+        bucket, key = row
+        _lock_objects(cur, [(bucket, key)], shared=False)
+        cur.execute("DELETE FROM invoices WHERE id = %s", (invoice_id,))
+        _release_object(cur, bucket, key, delete_object)
+    return True
+
 
-        query = """
-        INSERT INTO invoice_lines (
-          id, invoice_id, line_number, descrizione, qta, prezzo_unitario, aliquota_iva, totale_riga
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        params = (line_id, invoice_id, idx, descrizione, qta, prezzo_unitario, aliquota_iva, totale_riga)
-        execute(query, params)
+def release_object(bucket: str, key: str, delete_object: Callable[..., None]) -> bool:
+    """Cancella l'oggetto S3 se nessuna fattura lo referenzia (upload rimasto orfano)."""
+    with transaction() as cur:
+        _lock_objects(cur, [(bucket, key)], shared=False)
+        return _release_object(cur, bucket, key, delete_object)
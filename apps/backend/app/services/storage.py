@@ -1,48 +1,139 @@
+import asyncio
+import contextvars
 import os
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Any, Callable, Dict, Optional, Set, Union
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
+from ..core.config import settings
+from ..utils.timing import timed
+from . import storage_local
+
 S3_ENDPOINT = os.getenv("S3_ENDPOINT") or os.getenv("MINIO_ENDPOINT") or "http://minio:9000"
+S3_PUBLIC_ENDPOINT = os.getenv("S3_PUBLIC_ENDPOINT") or os.getenv("MINIO_PUBLIC_ENDPOINT")
 S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY") or os.getenv("MINIO_ACCESS_KEY") or "minioadmin"
 S3_SECRET_KEY = os.getenv("S3_SECRET_KEY") or os.getenv("MINIO_SECRET_KEY") or "minioadmin"
-S3_BUCKET     = os.getenv("S3_BUCKET")     or os.getenv("MINIO_BUCKET")     or "ai-agent-dev"
-S3_REGION     = os.getenv("S3_REGION") or "us-east-1"
+# bucket e regione: da settings (S3_BUCKET/MINIO_BUCKET, S3_REGION), come per
+# il backend locale
+
+# Unico punto di accesso allo storage (S3/MinIO o disco locale) per API,
+# worker e health. Un client boto3 per processo e per endpoint: quello
+# interno (upload, download, HEAD) e quello pubblico, usato solo per firmare
+# gli URL presigned (l'host fa parte della firma). I client sono thread-safe
+# e tengono il loro pool HTTP (`s3_max_pool_connections`); i bucket
+# verificati restano in cache: niente costruzione del client e HEAD bucket a
+# ogni chiamata.
+_clients: Dict[str, Any] = {}
+_client_lock = threading.Lock()
+_buckets_ok: Set[str] = set()
+_async_pool: Optional[ThreadPoolExecutor] = None
+
+# Backend: con settings.storage_backend = "local" le funzioni pubbliche qui
+# sotto (upload, download, HEAD, delete, ping, URL firmati) passano alle
+# omonime di storage_local.py, su disco e senza rete; il resto dell'app non
+# cambia.
+
+def is_local() -> bool:
+    return settings.storage_backend == "local"
+
+
+def check() -> None:
+    """All'avvio: col backend locale, verifica (o genera) la chiave degli URL firmati."""
+    if is_local():
+        storage_local.check_secret()
+
+
+def _pluggable(fn: Callable) -> Callable:
+    local = getattr(storage_local, fn.__name__)
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if is_local():
+            return local(*args, **kwargs)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def local_path(key: str, bucket: Optional[str] = None) -> Optional[str]:
+    """Percorso del file dell'oggetto col backend locale (leggibile senza copie), altrimenti None."""
+    return storage_local.object_path(key, bucket or settings.s3_bucket) if is_local() else None
+
+
+def s3_client(endpoint: Optional[str] = None):
+    endpoint = endpoint or S3_ENDPOINT
+    with _client_lock:
+        client = _clients.get(endpoint)
+        if client is None:
+            client = _clients[endpoint] = _new_s3_client(endpoint)
+        return client
+
+
+def signing_client():
+    """Client per gli URL presigned: firma con l'endpoint pubblico, se configurato."""
+    return s3_client(S3_PUBLIC_ENDPOINT or S3_ENDPOINT)
 
-def _s3_client():
-    use_ssl = S3_ENDPOINT.strip().lower().startswith("https://")
+
+def _new_s3_client(endpoint: str):
+    use_ssl = endpoint.strip().lower().startswith("https://")
     return boto3.client(
         "s3",
-        endpoint_url=S3_ENDPOINT,
+        endpoint_url=endpoint,
         aws_access_key_id=S3_ACCESS_KEY,
         aws_secret_access_key=S3_SECRET_KEY,
-        region_name=S3_REGION,
+        region_name=settings.s3_region,
         use_ssl=use_ssl,
-        config=Config(signature_version="s3v4", s3={"addressing_style": "path"}),
+        config=Config(
+            signature_version="s3v4",
+            s3={"addressing_style": "path"},
+            max_pool_connections=max(1, settings.s3_max_pool_connections),
+        ),
     )
 
+
+def close_clients() -> None:
+    global _async_pool
+    with _client_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _buckets_ok.clear()
+        pool, _async_pool = _async_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+    for client in clients:
+        client.close()
+
 def _ensure_bucket(s3, bucket: str):
+    if bucket in _buckets_ok:
+        return
     try:
         s3.head_bucket(Bucket=bucket)
+        _buckets_ok.add(bucket)
         return
     except ClientError as e:
         code = int(e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0))
         if code in (404, 301):
-            if S3_REGION == "us-east-1":
+            if settings.s3_region == "us-east-1":
                 s3.create_bucket(Bucket=bucket)
             else:
                 s3.create_bucket(
                     Bucket=bucket,
-                    CreateBucketConfiguration={"LocationConstraint": S3_REGION},
+                    CreateBucketConfiguration={"LocationConstraint": settings.s3_region},
                 )
+            _buckets_ok.add(bucket)
         else:
             raise
 
+@timed("s3_upload")
+@_pluggable
 def upload_bytes(key: str, data: bytes, content_type: Optional[str] = None, bucket: Optional[str] = None):
-    s3 = _s3_client()
-    bucket = bucket or S3_BUCKET
+    s3 = s3_client()
+    bucket = bucket or settings.s3_bucket
     try:
         _ensure_bucket(s3, bucket)
         extra = {"ContentType": content_type} if content_type else {}
@@ -50,3 +141,145 @@ def upload_bytes(key: str, data: bytes, content_type: Optional[str] = None, buck
         return {"bucket": bucket, "key": key}
     except Exception as e:
         raise RuntimeError(f"Errore upload su S3/MinIO ({S3_ENDPOINT}): {e}")
+
+def _transfer_config() -> TransferConfig:
+    # oltre una parte il file va in multipart: parti lette dal disco e
+    # caricate in parallelo, in memoria al più `concurrency` parti
+    part = max(5 * 1024 * 1024, settings.s3_part_size)  # minimo S3 per parte
+    return TransferConfig(
+        multipart_threshold=part,
+        multipart_chunksize=part,
+        max_concurrency=max(1, settings.s3_upload_concurrency),
+    )
+
+@timed("s3_upload")
+@_pluggable
+def upload_file(key: str, path: str, content_type: Optional[str] = None, bucket: Optional[str] = None):
+    """Come upload_bytes ma dal file `path`, in streaming (multipart se grande)."""
+    s3 = s3_client()
+    bucket = bucket or settings.s3_bucket
+    try:
+        _ensure_bucket(s3, bucket)
+        extra = {"ContentType": content_type} if content_type else {}
+        s3.upload_file(path, bucket, key, ExtraArgs=extra, Config=_transfer_config())
+        return {"bucket": bucket, "key": key}
+    except Exception as e:
+        raise RuntimeError(f"Errore upload su S3/MinIO ({S3_ENDPOINT}): {e}")
+
+# Layout indirizzato per contenuto (settings.s3_content_addressed): la chiave
+# è lo SHA-256 del file, così lo stesso documento caricato più volte occupa
+# un solo oggetto e un solo upload. Più fatture puntano allo stesso oggetto:
+# la cancellazione passa da repository_invoices, che lo rimuove solo quando
+# non lo referenzia più nessuna fattura.
+
+def content_key(sha256: str) -> str:
+    return f"objects/sha256/{sha256[:2]}/{sha256}"
+
+@_pluggable
+def object_exists(key: str, bucket: Optional[str] = None) -> bool:
+    s3 = s3_client()
+    bucket = bucket or settings.s3_bucket
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        code = int(e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0))
+        if code == 404:
+            return False
+        raise RuntimeError(f"Errore HEAD su S3/MinIO ({S3_ENDPOINT}): {e}")
+
+def upload_content_addressed(
+    sha256: str,
+    source: Union[bytes, str],
+    content_type: Optional[str] = None,
+    bucket: Optional[str] = None,
+) -> Dict[str, str]:
+    """Carica byte o file sotto content_key(sha256), saltando il PUT se l'oggetto esiste già."""
+    bucket = bucket or settings.s3_bucket
+    key = content_key(sha256)
+    if not object_exists(key, bucket):
+        upload = upload_file if isinstance(source, str) else upload_bytes
+        upload(key, source, content_type=content_type, bucket=bucket)
+    return {"bucket": bucket, "key": key, "sha256": sha256}
+
+@timed("s3_delete")
+@_pluggable
+def delete_object(key: str, bucket: Optional[str] = None) -> None:
+    s3 = s3_client()
+    bucket = bucket or settings.s3_bucket
+    try:
+        s3.delete_object(Bucket=bucket, Key=key)
+    except Exception as e:
+        raise RuntimeError(f"Errore cancellazione su S3/MinIO ({S3_ENDPOINT}): {e}")
+
+@timed("s3_download")
+@_pluggable
+def download_file(key: str, path: str, bucket: Optional[str] = None) -> None:
+    """Scarica l'oggetto nel file `path` a blocchi (parti in parallelo)."""
+    s3 = s3_client()
+    bucket = bucket or settings.s3_bucket
+    try:
+        s3.download_file(bucket, key, path, Config=_transfer_config())
+    except Exception as e:
+        raise RuntimeError(f"Errore download da S3/MinIO ({S3_ENDPOINT}): {e}")
+
+@timed("s3_download")
+@_pluggable
+def download_bytes(key: str, bucket: Optional[str] = None) -> bytes:
+    s3 = s3_client()
+    bucket = bucket or settings.s3_bucket
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except Exception as e:
+        raise RuntimeError(f"Errore download da S3/MinIO ({S3_ENDPOINT}): {e}")
+
+@_pluggable
+def ping() -> None:
+    s3_client().list_buckets()
+
+@_pluggable
+def presigned_url(bucket: str, key: str, expires_in: int = 900, **response_params: str) -> str:
+    """URL GET firmato (nessuna chiamata di rete); `response_params` es. ResponseContentType."""
+    return signing_client().generate_presigned_url(
+        ClientMethod="get_object",
+        Params={"Bucket": bucket, "Key": key, **response_params},
+        ExpiresIn=expires_in,
+    )
+
+
+# -------- Variante asyncio --------
+# boto3 è sincrono: per le route async le stesse funzioni girano in un thread
+# pool dedicato, grande quanto il pool HTTP dei client (più thread si
+# limiterebbero ad aspettare una connessione), col contesto della richiesta.
+
+def _get_async_pool() -> ThreadPoolExecutor:
+    global _async_pool
+    with _client_lock:
+        if _async_pool is None:
+            _async_pool = ThreadPoolExecutor(
+                max_workers=max(1, settings.s3_max_pool_connections), thread_name_prefix="s3"
+            )
+        return _async_pool
+
+async def arun(fn: Callable, *args, **kwargs) -> Any:
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_async_pool(), partial(ctx.run, fn, *args, **kwargs))
+
+async def aupload_bytes(key: str, data: bytes, content_type: Optional[str] = None, bucket: Optional[str] = None):
+    return await arun(upload_bytes, key, data, content_type=content_type, bucket=bucket)
+
+async def aupload_file(key: str, path: str, content_type: Optional[str] = None, bucket: Optional[str] = None):
+    return await arun(upload_file, key, path, content_type=content_type, bucket=bucket)
+
+async def adownload_bytes(key: str, bucket: Optional[str] = None) -> bytes:
+    return await arun(download_bytes, key, bucket=bucket)
+
+async def aobject_exists(key: str, bucket: Optional[str] = None) -> bool:
+    return await arun(object_exists, key, bucket=bucket)
+
+async def adelete_object(key: str, bucket: Optional[str] = None) -> None:
+    return await arun(delete_object, key, bucket=bucket)
+
+async def aping() -> None:
+    return await arun(ping)
@@ -0,0 +1,190 @@
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import quote, urlencode
+
+from ..core.config import settings
+
+# Backend di storage su disco locale (settings.storage_backend = "local"):
+# installazioni a nodo singolo senza MinIO e test che esercitano il codice di
+# storage vero. Stesse funzioni (e firme) della parte S3 di storage.py, che le
+# usa al posto di boto3 quando il backend è selezionato.
+#
+# - Un oggetto è un file in <root>/<bucket>/<aa>/<bb>/<sha256(key)>: directory
+#   a due livelli, nomi sicuri qualunque sia la chiave.
+# - Le scritture sono atomiche: file temporaneo nella stessa directory, fsync,
+#   os.replace. Un file caricato dal disco (upload HTTP) viene collegato con un
+#   hard link quando possibile, senza copiarne i byte.
+# - Gli URL "presigned" puntano alla route GET /files/{bucket}/{key} e sono
+#   firmati con HMAC-SHA256 (`storage_local_secret`) su bucket, chiave,
+#   scadenza e header della risposta, come quelli S3. Senza chiave
+#   configurata se ne genera una casuale, salvata in <root>/.url-secret e
+#   condivisa da tutti i processi; una chiave d'esempio rimasta nella
+#   configurazione blocca l'avvio (check_secret, chiamata dal lifespan).
+
+_BUCKET_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+COPY_CHUNK = 1024 * 1024
+SECRET_FILE = ".url-secret"  # non è un bucket valido: la route /files non lo serve
+_WEAK_SECRETS = {"change-me", "cambiami"}  # valori d'esempio (default e .env.example)
+
+_secret_lock = threading.Lock()
+_secrets: Dict[str, bytes] = {}  # root -> chiave generata
+
+
+def _root() -> str:
+    return os.path.abspath(settings.storage_local_root)
+
+
+def object_path(key: str, bucket: str) -> str:
+    if not _BUCKET_RE.match(bucket or "") or ".." in bucket:
+        raise ValueError(f"bucket non valido: {bucket!r}")
+    h = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(_root(), bucket, h[:2], h[2:4], h)
+
+
+def _write_atomic(path: str, write) -> None:
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            write(out)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def upload_bytes(key: str, data: bytes, content_type: Optional[str] = None, bucket: Optional[str] = None):
+    bucket = bucket or settings.s3_bucket
+    _write_atomic(object_path(key, bucket), lambda out: out.write(data))
+    return {"bucket": bucket, "key": key}
+
+
+def upload_file(key: str, path: str, content_type: Optional[str] = None, bucket: Optional[str] = None):
+    bucket = bucket or settings.s3_bucket
+    target = object_path(key, bucket)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = os.path.join(os.path.dirname(target), f".tmp-link-{os.getpid()}-{time.monotonic_ns()}")
+    try:
+        # stesso filesystem: nessuna copia, il file dell'upload diventa l'oggetto
+        os.link(path, tmp)
+        os.replace(tmp, target)
+    except OSError:
+        def copy(out):
+            with open(path, "rb") as src:
+                shutil.copyfileobj(src, out, COPY_CHUNK)
+        _write_atomic(target, copy)
+    return {"bucket": bucket, "key": key}
+
+
+def download_bytes(key: str, bucket: Optional[str] = None) -> bytes:
+    with open(object_path(key, bucket or settings.s3_bucket), "rb") as f:
+        return f.read()
+
+
+def download_file(key: str, path: str, bucket: Optional[str] = None) -> None:
+    with open(object_path(key, bucket or settings.s3_bucket), "rb") as src, open(path, "wb") as out:
+        shutil.copyfileobj(src, out, COPY_CHUNK)
+
+
+def object_exists(key: str, bucket: Optional[str] = None) -> bool:
+    return os.path.isfile(object_path(key, bucket or settings.s3_bucket))
+
+
+def delete_object(key: str, bucket: Optional[str] = None) -> None:
+    try:
+        os.unlink(object_path(key, bucket or settings.s3_bucket))
+    except FileNotFoundError:
+        pass
+
+
+def ping() -> None:
+    root = _root()
+    os.makedirs(root, exist_ok=True)
+    if not os.access(root, os.W_OK):
+        raise RuntimeError(f"{root} non scrivibile")
+
+
+# -------- URL firmati --------
+
+_RESPONSE_PARAMS = {"ResponseContentDisposition": "disposition", "ResponseContentType": "content_type"}
+
+
+def _load_or_create_secret(root: str) -> bytes:
+    path = os.path.join(root, SECRET_FILE)
+    os.makedirs(root, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-secret-", dir=root)  # già 0600
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(secrets.token_hex(32).encode("ascii"))
+            out.flush()
+            os.fsync(out.fileno())
+        # link: fallisce se un altro processo l'ha già creata, e allora vale la sua
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp)
+    with open(path, "rb") as f:
+        secret = f.read().strip()
+    if not secret:
+        raise RuntimeError(f"{path} vuoto: cancellarlo o impostare storage_local_secret")
+    return secret
+
+
+def _secret() -> bytes:
+    configured = settings.storage_local_secret
+    if configured in _WEAK_SECRETS:
+        raise RuntimeError(
+            f"storage_local_secret = {configured!r} non è una chiave: impostarne una propria, "
+            f"o lasciarla vuota per generarla in <storage_local_root>/{SECRET_FILE}"
+        )
+    if configured:
+        return configured.encode("utf-8")
+    root = _root()
+    with _secret_lock:
+        secret = _secrets.get(root)
+        if secret is None:
+            secret = _secrets[root] = _load_or_create_secret(root)
+        return secret
+
+
+def check_secret() -> None:
+    """All'avvio: rifiuta la chiave d'esempio e prepara quella generata."""
+    _secret()
+
+
+def _signature(bucket: str, key: str, expires: int, disposition: str, content_type: str) -> str:
+    msg = "\n".join((bucket, key, str(expires), disposition, content_type)).encode("utf-8")
+    return hmac.new(_secret(), msg, hashlib.sha256).hexdigest()
+
+
+def presigned_url(bucket: str, key: str, expires_in: int = 900, **response_params: str) -> str:
+    expires = int(time.time()) + expires_in
+    query = {"expires": expires}
+    for param, name in _RESPONSE_PARAMS.items():
+        if response_params.get(param):
+            query[name] = response_params[param]
+    query["signature"] = _signature(bucket, key, expires, query.get("disposition", ""), query.get("content_type", ""))
+    base = settings.storage_local_url.rstrip("/")
+    return f"{base}/{quote(bucket)}/{quote(key)}?{urlencode(query)}"
+
+
+def verify(bucket: str, key: str, expires: int, signature: str, disposition: str = "", content_type: str = "") -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_signature(bucket, key, expires, disposition, content_type), signature)
+
@@ -0,0 +1,184 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Span/timer leggeri per misurare le fasi di una richiesta (parsing, OCR, S3,
+# Postgres). Ogni span:
+# - si somma al raccoglitore della richiesta corrente (ContextVar), se c'è:
+#   è quello che finisce nell'header Server-Timing e in InvoiceOut.timings;
+# - alimenta sempre un istogramma di processo per fase (GET /debug/timings).
+# Senza raccoglitore attivo il costo è un paio di perf_counter e un lock.
+# Il lavoro eseguito in un processo del pool si misura con run_collected() e
+# si riporta nella richiesta con replay().
+
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class Timings:
+    """Durate (ms) e conteggi per fase di una singola richiesta."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self.ms: Dict[str, float] = {}
+        self.count: Dict[str, int] = {}
+        self.spans: List[Tuple[str, float]] = []  # singoli span, per replay()
+
+    def add(self, name: str, ms: float) -> None:
+        with self._lock:
+            self.ms[name] = self.ms.get(name, 0.0) + ms
+            self.count[name] = self.count.get(name, 0) + 1
+            self.spans.append((name, ms))
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000
+
+    def as_dict(self) -> Dict[str, float]:
+        with self._lock:
+            out = {k: round(v, 2) for k, v in self.ms.items()}
+        out["total"] = round(self.total_ms(), 2)
+        return out
+
+    def server_timing(self) -> str:
+        """Valore dell'header Server-Timing (https://www.w3.org/TR/server-timing/)."""
+        return ", ".join(f"{k};dur={v}" for k, v in self.as_dict().items())
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.n = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.n += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Stima per bucket (limite superiore del bucket che contiene il quantile)."""
+        if not self.n:
+            return None
+        rank, seen = q * self.n, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return float(BUCKETS_MS[i]) if i < len(BUCKETS_MS) else round(self.max_ms, 2)
+        return round(self.max_ms, 2)
+
+    def snapshot(self) -> Dict[str, object]:
+        return {
+            "count": self.n,
+            "sum_ms": round(self.sum_ms, 2),
+            "max_ms": round(self.max_ms, 2),
+            "p50_ms": self.quantile(0.50),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {
+                (f"le_{b}" if i < len(BUCKETS_MS) else "inf"): c
+                for i, (b, c) in enumerate(zip(list(BUCKETS_MS) + [None], self.counts))
+            },
+        }
+
+
+_current: ContextVar[Optional[Timings]] = ContextVar("timings", default=None)
+_hist_lock = threading.Lock()
+_histograms: Dict[str, Histogram] = {}
+
+
+def _observe(name: str, ms: float) -> None:
+    rec = _current.get()
+    if rec is not None:
+        rec.add(name, ms)
+    with _hist_lock:
+        h = _histograms.get(name)
+        if h is None:
+            h = _histograms[name] = Histogram()
+        h.observe(ms)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(name, (time.perf_counter() - t0) * 1000)
+
+
+def timed_iter(name: str, items: Iterable[Any]) -> Iterator[Any]:
+    """
+    Uno span `name` per un iteratore consumato a pezzi (es. i body di un
+    lotto letti man mano che l'insert li chiede): conta solo il tempo speso a
+    produrre gli elementi, non quello di chi li consuma.
+    """
+    rest = iter(items)
+    ms = 0.0
+    try:
+        while True:
+            t0 = time.perf_counter()
+            try:
+                item = next(rest)
+            except StopIteration:
+                return
+            finally:
+                ms += (time.perf_counter() - t0) * 1000
+            yield item
+    finally:
+        _observe(name, ms)
+
+
+def timed(name: str) -> Callable[[Callable], Callable]:
+    """Decoratore: la funzione intera è uno span `name`."""
+    def deco(fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+@contextmanager
+def collect() -> Iterator[Timings]:
+    """Attiva un raccoglitore per il contesto corrente (es. una richiesta)."""
+    rec = Timings()
+    token = _current.set(rec)
+    try:
+        yield rec
+    finally:
+        _current.reset(token)
+
+
+def run_collected(fn: Callable, *args, **kwargs) -> Tuple[Any, List[Tuple[str, float]]]:
+    """
+    Esegue `fn` con un raccoglitore suo e ritorna (risultato, span). Gira nei
+    processi del pool (deve restare top-level): il chiamante passa gli span a
+    replay() nel proprio contesto.
+    """
+    with collect() as rec:
+        result = fn(*args, **kwargs)
+    return result, rec.spans
+
+
+def replay(spans: List[Tuple[str, float]]) -> None:
+    """Riporta nel raccoglitore corrente e negli istogrammi gli span misurati altrove."""
+    for name, ms in spans:
+        _observe(name, ms)
+
+
+def histograms() -> Dict[str, Dict[str, object]]:
+    with _hist_lock:
+        return {name: h.snapshot() for name, h in sorted(_histograms.items())}
+
+
+def reset_histograms() -> None:
+    with _hist_lock:
+        _histograms.clear()
+
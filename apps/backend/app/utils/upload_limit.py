@@ -0,0 +1,47 @@
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ..core.config import settings
+
+# Limite al corpo delle richieste (upload), controllato prima che Starlette
+# scriva il multipart sullo spool: con Content-Length oltre `max_upload_bytes`
+# la risposta è subito 413 senza leggere il corpo; senza (chunked) si contano
+# i byte ricevuti e ci si ferma appena si supera il limite.
+
+
+def _too_large() -> str:
+    return f"Request body too large (max {settings.max_upload_bytes} bytes)"
+
+
+class MaxUploadSizeMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        limit = settings.max_upload_bytes
+        headers = dict(scope.get("headers") or [])
+        try:
+            declared = int(headers.get(b"content-length", b"") or -1)
+        except ValueError:
+            declared = -1
+        if declared > limit:
+            await JSONResponse({"detail": _too_large()}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # FastAPI lascia passare le HTTPException del parsing del form
+                    raise HTTPException(status_code=413, detail=_too_large())
+            return message
+
+        await self.app(scope, limited_receive, send)
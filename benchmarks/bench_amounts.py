@@ -0,0 +1,88 @@
+"""
+Benchmark della riconciliazione importi (imponibile + iva = totale).
+
+Genera documenti sintetici con 50/500/5000 importi (la terna vera è in alto,
+così la passata sulle ultime 20 righe fallisce e scatta quella su tutto il
+documento) e misura _assign_amounts_by_heuristic. Per confronto misura anche
+la vecchia enumerazione cubica fino a --cubic-max importi.
+
+    python benchmarks/bench_amounts.py [--sizes 50 500 5000] [--cubic-max 500]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apps", "backend"))
+
+from app.services.parsers.invoice_pdf import DocIndex, _amounts_with_indexes, _assign_amounts_by_heuristic  # noqa: E402
+
+
+def _fmt(v: float) -> str:
+    s = f"{v:,.2f}"
+    return s.replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def synthetic_document(n: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    rows = ["Totale imponibile 1.000,00", "Totale IVA 220,00", "Totale documento 1.220,00"]
+    while len(rows) < n:
+        # importi "rumorosi" > 50: la passata finale deve comunque provarli tutti
+        rows.append(f"Riga {len(rows)} importo {_fmt(rng.randrange(5000, 9_000_000) + 0.37)}")
+    return "\n".join(rows)
+
+
+def cubic_reference(vals):
+    best = {"iva": None, "imponibile": None, "totale": None}
+    best_err = 1e9
+    m = len(vals)
+    for i in range(m):
+        for j in range(i + 1, m):
+            for k in range(j + 1, m):
+                iva, imp, tot = vals[i], vals[j], vals[k]
+                if tot < imp or tot < iva:
+                    continue
+                if tot > 50 and iva < 1:
+                    continue
+                err = abs((imp + iva) - tot)
+                if err <= 0.05 and tot >= imp > 0 and iva > 0:
+                    if err < best_err or (abs(err - best_err) <= 0.001 and tot > (best["totale"] or 0)):
+                        best = {"iva": iva, "imponibile": imp, "totale": tot}
+                        best_err = err
+    return best
+
+
+def _time(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000])
+    ap.add_argument("--cubic-max", type=int, default=50, help="misura il vecchio algoritmo fino a N importi")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    results = []
+    for n in args.sizes:
+        text = synthetic_document(n)
+        idx = DocIndex(text)
+        got = _assign_amounts_by_heuristic(idx)
+        row = {"amounts": n, "engine_s": round(_time(lambda: _assign_amounts_by_heuristic(idx), args.repeat), 4), "result": got}
+        if n <= args.cubic_max:
+            vals = sorted(set(round(v, 2) for _, v in _amounts_with_indexes(idx)))
+            assert cubic_reference(vals) == got, "risultato diverso dal riferimento cubico"
+            row["cubic_s"] = round(_time(lambda: cubic_reference(vals), 1), 4)
+        results.append(row)
+        print(json.dumps(row), flush=True)
+
+
+if __name__ == "__main__":
+    main()
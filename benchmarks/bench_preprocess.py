@@ -0,0 +1,98 @@
+"""
+Benchmark del preprocessing OCR (_preprocess) su una pagina A4 sintetica.
+
+Confronta la vecchia pipeline (preprocessing completo di ognuna delle tre
+rotazioni, autocontrasto come passaggio a sé, soglia con lambda) con quella
+attuale (un solo preprocessing a 1 bit, poi solo trasposizioni) per ogni
+metodo di soglia. Per ogni variante misura il tempo (migliore di --repeat) e
+il picco di memoria in un processo separato (ru_maxrss).
+
+    python benchmarks/bench_preprocess.py [--dpi 300] [--repeat 3]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apps", "backend"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import corpus  # noqa: E402
+from PIL import ImageChops, ImageFilter, ImageOps  # noqa: E402
+from app.services.parsers.invoice_pdf import ROTATIONS, _preprocess, _rotate  # noqa: E402
+
+
+def legacy_preprocess(img):
+    g = img.convert("L")
+    g = ImageOps.autocontrast(g)
+    w, h = g.size
+    g = g.resize((int(w*1.5), int(h*1.5)))
+    g = g.filter(ImageFilter.SHARPEN)
+    g = g.point(lambda p: 255 if p > 180 else 0)
+    return g
+
+
+def legacy(img, _method):
+    return [legacy_preprocess(img.rotate(a, expand=True) if a else img) for a in ROTATIONS]
+
+
+def current(img, method):
+    prep = _preprocess(img, method)
+    return [_rotate(prep, a) for a in ROTATIONS]
+
+
+VARIANTS = {
+    "legacy": (legacy, None),
+    "fixed": (current, "fixed"),
+    "otsu": (current, "otsu"),
+    "sauvola": (current, "sauvola"),
+}
+
+
+def _page(dpi: int):
+    inv = corpus._invoice(random.Random(0), 25)
+    return corpus.scan_image(inv, 0, dpi)
+
+
+def _measure(name: str, dpi: int, repeat: int, out) -> None:
+    fn, method = VARIANTS[name]
+    img = _page(dpi)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        res = fn(img, method)
+        best = min(best, time.perf_counter() - t0)
+        del res
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    out.put({"variant": name, "time_s": round(best, 4), "peak_mb": round(peak / 1024, 1)})
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--dpi", type=int, default=300)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    img = _page(args.dpi)
+    old = legacy_preprocess(img)
+    for name in VARIANTS:
+        q = ctx.Queue()
+        p = ctx.Process(target=_measure, args=(name, args.dpi, args.repeat, q))
+        p.start()
+        row = q.get()
+        p.join()
+        if name != "legacy":
+            new = _preprocess(img, VARIANTS[name][1]).convert("L")
+            diff = ImageChops.difference(old, new).histogram()
+            row["same_pixels_vs_legacy"] = round(diff[0] / sum(diff), 4)
+        print(json.dumps(row), flush=True)
+
+
+if __name__ == "__main__":
+    main()
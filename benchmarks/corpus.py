@@ -0,0 +1,256 @@
+"""
+Corpus sintetico per i benchmark dei parser, con golden JSON.
+
+Genera in modo deterministico (seed) tre famiglie di documenti di varie
+dimensioni:
+
+- ``text-*``: PDF con text layer (reportlab), da poche righe a più pagine;
+- ``scan-*``: PDF "scansionati" (solo immagine, ruotata di 0/90/180/270°);
+- ``xml-*``:  FatturaPA XML con numero crescente di DettaglioLinee.
+
+Il golden di ogni documento sono i campi veri usati per generarlo, non
+l'output del parser: l'accuratezza misura il parser contro la verità.
+
+    python benchmarks/corpus.py OUT_DIR [--seed 0] [--scale 1]
+"""
+import argparse
+import json
+import os
+import random
+from datetime import date, timedelta
+from io import BytesIO
+from typing import Any, Dict, List
+
+from PIL import Image, ImageDraw, ImageFont
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+GOLDEN_FIELDS = (
+    "intestatario", "partita_iva", "invoice_number", "data_emissione",
+    "imponibile", "iva", "totale",
+)
+
+# (famiglia, righe di dettaglio, documenti per unità di --scale)
+PROFILES = (
+    ("text-s", 3, 8),
+    ("text-m", 40, 6),
+    ("text-l", 250, 3),
+    ("scan-s", 3, 6),
+    ("scan-m", 25, 3),
+    ("xml-s", 1, 8),
+    ("xml-m", 50, 6),
+    ("xml-l", 2000, 2),
+)
+
+NAMES = (
+    "Rossi Mario", "Bianchi Laura", "Esposito Giuseppe", "Ferrari Anna",
+    "ALFA SRL", "Studio Verdi SAS", "Colombo Impianti SRL", "Ricci Paola",
+)
+STREETS = ("Via Roma", "Corso Italia", "Via Garibaldi", "Piazza Duomo", "Viale Europa")
+CITIES = (("24100", "Bergamo"), ("20121", "Milano"), ("00184", "Roma"), ("10121", "Torino"))
+NUMBER_FORMATS = ("Fattura {n} del {d}", "Fattura n. {n} del {d}", "Fattura nr {n} del {d}")
+ITEMS = ("Consulenza", "Provvigioni", "Manutenzione impianto", "Licenza software", "Trasporto merci")
+VAT_RATES = (22, 10, 4)
+
+
+def _it(v: float) -> str:
+    s = f"{v:,.2f}"
+    return s.replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def _invoice(rng: random.Random, n_lines: int) -> Dict[str, Any]:
+    rate = rng.choice(VAT_RATES)
+    lines = []
+    for k in range(n_lines):
+        qta = rng.randint(1, 5)
+        prezzo = round(rng.uniform(10, 900), 2)
+        lines.append({
+            "descrizione": f"{rng.choice(ITEMS)} {k + 1}",
+            "qta": qta,
+            "prezzo_unitario": prezzo,
+            "totale_riga": round(qta * prezzo, 2),
+        })
+    imponibile = round(sum(r["totale_riga"] for r in lines), 2)
+    iva = round(imponibile * rate / 100.0, 2)
+    cap, city = rng.choice(CITIES)
+    issued = date(2021, 1, 1) + timedelta(days=rng.randrange(1500))
+    return {
+        "fields": {
+            "intestatario": rng.choice(NAMES),
+            "partita_iva": "IT" + "".join(str(rng.randrange(10)) for _ in range(11)),
+            "invoice_number": str(rng.randint(1, 9999)),
+            "data_emissione": issued.isoformat(),
+            "imponibile": imponibile,
+            "iva": iva,
+            "totale": round(imponibile + iva, 2),
+        },
+        "rate": rate,
+        "number_format": rng.choice(NUMBER_FORMATS),
+        "address": f"{rng.choice(STREETS)}, {rng.randint(1, 200)} - {cap} {city}",
+        "righe": lines,
+    }
+
+
+def _text_rows(inv: Dict[str, Any]) -> List[str]:
+    f = inv["fields"]
+    issued = date.fromisoformat(f["data_emissione"]).strftime("%d/%m/%Y")
+    rows = [
+        f["intestatario"],
+        inv["address"],
+        f"Partita IVA {f['partita_iva'][2:]}",
+        inv["number_format"].format(n=f["invoice_number"], d=issued),
+        "Cliente: Beta Distribuzione SPA",
+        "",
+    ]
+    for r in inv["righe"]:
+        rows.append(f"{r['descrizione']}  {r['qta']} x {_it(r['prezzo_unitario'])}  {_it(r['totale_riga'])}")
+    rows += [
+        "",
+        "Totale imponibile", _it(f["imponibile"]),
+        f"IVA {inv['rate']}%", _it(f["iva"]),
+        "Totale documento", _it(f["totale"]),
+    ]
+    return rows
+
+
+def text_pdf(inv: Dict[str, Any]) -> bytes:
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    _, h = A4
+    y = h - 50
+    for row in _text_rows(inv):
+        if y < 50:
+            c.showPage()
+            y = h - 50
+        c.drawString(40, y, row)
+        y -= 16
+    c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+def _font(size: int):
+    for name in ("DejaVuSans.ttf", "Arial.ttf"):
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def scan_image(inv: Dict[str, Any], angle: int = 0, dpi: int = 150) -> Image.Image:
+    """Pagina A4 renderizzata come immagine in scala di grigi e ruotata."""
+    w, h = int(8.27 * dpi), int(11.69 * dpi)
+    img = Image.new("L", (w, h), 255)
+    draw = ImageDraw.Draw(img)
+    font = _font(dpi // 6)
+    y = dpi // 2
+    for row in _text_rows(inv):
+        draw.text((dpi // 2, y), row, fill=0, font=font)
+        y += dpi // 4
+        if y > h - dpi // 2:
+            break
+    if angle:
+        img = img.rotate(angle, expand=True, fillcolor=255)
+    return img
+
+
+def scan_pdf(inv: Dict[str, Any], angle: int, dpi: int = 150) -> bytes:
+    """PDF "scansionato": solo l'immagine della pagina, niente text layer."""
+    buf = BytesIO()
+    scan_image(inv, angle, dpi).save(buf, format="PDF", resolution=dpi)
+    return buf.getvalue()
+
+
+def fatturapa_xml(inv: Dict[str, Any]) -> bytes:
+    f = inv["fields"]
+    righe = "".join(
+        f"""
+      <DettaglioLinee>
+        <NumeroLinea>{k}</NumeroLinea>
+        <Descrizione>{r['descrizione']}</Descrizione>
+        <Quantita>{r['qta']:.2f}</Quantita>
+        <PrezzoUnitario>{r['prezzo_unitario']:.2f}</PrezzoUnitario>
+        <PrezzoTotale>{r['totale_riga']:.2f}</PrezzoTotale>
+        <AliquotaIVA>{inv['rate']:.2f}</AliquotaIVA>
+      </DettaglioLinee>"""
+        for k, r in enumerate(inv["righe"], start=1)
+    )
+    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica versione="FPR12" xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">
+  <FatturaElettronicaHeader>
+    <CedentePrestatore>
+      <DatiAnagrafici>
+        <IdFiscaleIVA>
+          <IdPaese>IT</IdPaese>
+          <IdCodice>{f['partita_iva'][2:]}</IdCodice>
+        </IdFiscaleIVA>
+        <Anagrafica>
+          <Denominazione>{f['intestatario']}</Denominazione>
+        </Anagrafica>
+      </DatiAnagrafici>
+    </CedentePrestatore>
+  </FatturaElettronicaHeader>
+  <FatturaElettronicaBody>
+    <DatiGenerali>
+      <DatiGeneraliDocumento>
+        <TipoDocumento>TD01</TipoDocumento>
+        <Divisa>EUR</Divisa>
+        <Data>{f['data_emissione']}</Data>
+        <Numero>{f['invoice_number']}</Numero>
+        <ImportoTotaleDocumento>{f['totale']:.2f}</ImportoTotaleDocumento>
+      </DatiGeneraliDocumento>
+    </DatiGenerali>
+    <DatiBeniServizi>{righe}
+      <DatiRiepilogo>
+        <AliquotaIVA>{inv['rate']:.2f}</AliquotaIVA>
+        <ImponibileImporto>{f['imponibile']:.2f}</ImponibileImporto>
+        <Imposta>{f['iva']:.2f}</Imposta>
+      </DatiRiepilogo>
+    </DatiBeniServizi>
+  </FatturaElettronicaBody>
+</p:FatturaElettronica>
+"""
+    return xml.encode("utf-8")
+
+
+def build(out_dir: str, seed: int = 0, scale: int = 1) -> Dict[str, Dict[str, Any]]:
+    """Scrive i documenti in OUT_DIR/docs e il golden in OUT_DIR/golden.json."""
+    rng = random.Random(seed)
+    docs_dir = os.path.join(out_dir, "docs")
+    os.makedirs(docs_dir, exist_ok=True)
+    golden: Dict[str, Dict[str, Any]] = {}
+    for family, n_lines, count in PROFILES:
+        for i in range(count * scale):
+            inv = _invoice(rng, n_lines)
+            meta: Dict[str, Any] = {"family": family, "lines": n_lines}
+            if family.startswith("xml"):
+                name, data = f"{family}-{i:03d}.xml", fatturapa_xml(inv)
+            elif family.startswith("scan"):
+                meta["rotation"] = angle = (0, 90, 180, 270)[i % 4]
+                name, data = f"{family}-{i:03d}.pdf", scan_pdf(inv, angle)
+            else:
+                name, data = f"{family}-{i:03d}.pdf", text_pdf(inv)
+            with open(os.path.join(docs_dir, name), "wb") as fh:
+                fh.write(data)
+            golden[name] = {**meta, "fields": inv["fields"]}
+    with open(os.path.join(out_dir, "golden.json"), "w", encoding="utf-8") as fh:
+        json.dump({"seed": seed, "scale": scale, "documents": golden}, fh, indent=1, sort_keys=True)
+    return golden
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("out_dir")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--scale", type=int, default=1, help="moltiplica il numero di documenti per famiglia")
+    args = ap.parse_args()
+    golden = build(args.out_dir, args.seed, args.scale)
+    print(f"{len(golden)} documenti in {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
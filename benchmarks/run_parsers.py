@@ -0,0 +1,217 @@
+"""
+Benchmark dei parser e regressione sul corpus golden (benchmarks/corpus.py).
+
+Misura il tempo per chiamata delle funzioni principali, per famiglia di
+documenti (text-*, scan-*, xml-*):
+
+    _extract_text_pdfminer, _extract_text_ocr, _parse_from_text,
+    _assign_amounts_by_heuristic, parse_xml_fatturapa, parse_pdf_invoice
+
+e l'accuratezza campo per campo dell'output normalizzato (quello salvato nel
+DB) rispetto al golden. Il risultato è un JSON confrontabile fra run: con
+--baseline il runner esce con codice 1 se una funzione rallenta oltre
+--max-slowdown o un campo perde accuratezza oltre --max-accuracy-drop.
+
+    python benchmarks/run_parsers.py --out before.json
+    python benchmarks/run_parsers.py --baseline before.json --out after.json
+
+Senza tesseract/poppler l'OCR viene saltato (e indicato in "skipped").
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apps", "backend"))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import corpus  # noqa: E402
+from app.services.invoice_fields import normalize_parsed  # noqa: E402
+from app.services.parsers import PARSER_VERSION  # noqa: E402
+from app.services.parsers.invoice_pdf import (  # noqa: E402
+    DocIndex, _assign_amounts_by_heuristic, _extract_text_ocr, _extract_text_pdfminer,
+    _parse_from_text, parse_pdf_invoice,
+)
+from app.services.parsers.invoice_xml import parse_xml_fatturapa  # noqa: E402
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(__file__), ".corpus")
+# sotto questa differenza assoluta un rallentamento è rumore di misura
+NOISE_FLOOR_MS = 0.2
+
+
+def _ocr_available() -> bool:
+    return bool(shutil.which("tesseract") and shutil.which("pdftoppm"))
+
+
+def _load_corpus(path: str, seed: int, scale: int, rebuild: bool) -> Dict[str, Dict[str, Any]]:
+    golden_path = os.path.join(path, "golden.json")
+    if not rebuild and os.path.exists(golden_path):
+        with open(golden_path, encoding="utf-8") as fh:
+            golden = json.load(fh)
+        if (golden.get("seed"), golden.get("scale")) == (seed, scale):
+            return golden["documents"]
+    return corpus.build(path, seed, scale)
+
+
+def _best_of(fn: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[min(len(ms) - 1, int(round(0.95 * (len(ms) - 1))))]
+    return {
+        "n": len(ms),
+        "total_s": round(sum(ms) / 1000, 4),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "p50_ms": round(statistics.median(ms), 3),
+        "p95_ms": round(p95, 3),
+    }
+
+
+def _same(expected: Any, got: Any) -> bool:
+    if isinstance(expected, float):
+        return got is not None and abs(float(got) - expected) <= 0.01
+    if isinstance(expected, str) and isinstance(got, str):
+        return " ".join(expected.split()).casefold() == " ".join(got.split()).casefold()
+    return expected == got
+
+
+def run(corpus_dir: str, seed: int = 0, scale: int = 1, repeat: int = 5, rebuild: bool = False) -> Dict[str, Any]:
+    docs = _load_corpus(corpus_dir, seed, scale, rebuild)
+    ocr = _ocr_available()
+    samples: Dict[str, Dict[str, List[float]]] = {}
+    hits: Dict[str, Dict[str, List[int]]] = {}
+    skipped: Dict[str, str] = {}
+
+    def timed(name: str, family: str, fn: Callable[[], Any]) -> None:
+        samples.setdefault(name, {}).setdefault(family, []).append(_best_of(fn, repeat))
+
+    for name in sorted(docs):
+        meta = docs[name]
+        family = meta["family"]
+        with open(os.path.join(corpus_dir, "docs", name), "rb") as fh:
+            data = fh.read()
+
+        if family.startswith("xml"):
+            timed("parse_xml_fatturapa", family, lambda: parse_xml_fatturapa(data))
+            parsed = parse_xml_fatturapa(data)
+        else:
+            if family.startswith("scan"):
+                if not ocr:
+                    skipped[family] = "tesseract/pdftoppm non disponibili"
+                    continue
+                timed("_extract_text_ocr", family, lambda: _extract_text_ocr(data))
+                text = _extract_text_ocr(data)
+            else:
+                timed("_extract_text_pdfminer", family, lambda: _extract_text_pdfminer(data))
+                text = _extract_text_pdfminer(data)
+            idx = DocIndex(text)
+            timed("_parse_from_text", family, lambda: _parse_from_text(text))
+            timed("_assign_amounts_by_heuristic", family, lambda: _assign_amounts_by_heuristic(idx))
+            timed("parse_pdf_invoice", family, lambda: parse_pdf_invoice(data))
+            parsed = parse_pdf_invoice(data)
+
+        fields = normalize_parsed(parsed)["fields"]
+        fam_hits = hits.setdefault(family, {})
+        for field in corpus.GOLDEN_FIELDS:
+            fam_hits.setdefault(field, []).append(int(_same(meta["fields"][field], fields.get(field))))
+
+    accuracy = {
+        family: {field: round(sum(v) / len(v), 4) for field, v in per_field.items()}
+        for family, per_field in sorted(hits.items())
+    }
+    return {
+        "meta": {
+            "parser_version": PARSER_VERSION,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "corpus": {"seed": seed, "scale": scale, "documents": len(docs)},
+            "repeat": repeat,
+        },
+        "timings": {
+            fn: {family: _summary(s) for family, s in sorted(per_family.items())}
+            for fn, per_family in sorted(samples.items())
+        },
+        "accuracy": accuracy,
+        "skipped": skipped,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], max_slowdown: float, max_accuracy_drop: float) -> List[str]:
+    """Regressioni di `current` rispetto a `baseline` (lista vuota = ok)."""
+    problems = []
+    for fn, per_family in current["timings"].items():
+        for family, cur in per_family.items():
+            base = baseline.get("timings", {}).get(fn, {}).get(family)
+            if not base:
+                continue
+            # mediana sui documenti: meno sensibile della media a un singolo outlier
+            cur_ms, base_ms = cur["p50_ms"], base["p50_ms"]
+            if cur_ms > base_ms * (1 + max_slowdown) and cur_ms - base_ms > NOISE_FLOOR_MS:
+                problems.append(
+                    f"tempo {fn}[{family}]: p50 {cur_ms:.3f} ms contro {base_ms:.3f} ms "
+                    f"(+{100 * (cur_ms / base_ms - 1):.0f}%)"
+                )
+    for family, per_field in current["accuracy"].items():
+        for field, acc in per_field.items():
+            base = baseline.get("accuracy", {}).get(family, {}).get(field)
+            if base is not None and acc < base - max_accuracy_drop - 1e-9:
+                problems.append(f"accuratezza {family}.{field}: {acc:.2%} contro {base:.2%}")
+    return problems
+
+
+def _print_summary(result: Dict[str, Any]) -> None:
+    print(f"parser {result['meta']['parser_version']}, {result['meta']['corpus']['documents']} documenti")
+    for fn, per_family in result["timings"].items():
+        for family, s in per_family.items():
+            print(f"  {fn:<30} {family:<7} n={s['n']:<3} mean {s['mean_ms']:9.3f} ms  p95 {s['p95_ms']:9.3f} ms")
+    for family, per_field in result["accuracy"].items():
+        cells = "  ".join(f"{k}={v:.0%}" for k, v in per_field.items())
+        print(f"  accuratezza {family:<7} {cells}")
+    for family, why in result["skipped"].items():
+        print(f"  saltato {family}: {why}")
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--corpus", default=DEFAULT_CORPUS, help="cartella del corpus (generato se manca)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--scale", type=int, default=1)
+    ap.add_argument("--rebuild", action="store_true", help="rigenera il corpus")
+    ap.add_argument("--repeat", type=int, default=5, help="ripetizioni per misura (si tiene la migliore)")
+    ap.add_argument("--out", help="scrive il risultato JSON su file")
+    ap.add_argument("--baseline", help="JSON di un run precedente da confrontare")
+    ap.add_argument("--max-slowdown", type=float, default=0.3, help="rallentamento relativo tollerato (p50 per funzione e famiglia)")
+    ap.add_argument("--max-accuracy-drop", type=float, default=0.0, help="calo di accuratezza tollerato (0-1)")
+    args = ap.parse_args()
+
+    result = run(args.corpus, args.seed, args.scale, args.repeat, args.rebuild)
+    _print_summary(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        problems = compare(result, baseline, args.max_slowdown, args.max_accuracy_drop)
+        for p in problems:
+            print(f"REGRESSIONE {p}", file=sys.stderr)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,7 +31,11 @@ CREATE TABLE IF NOT EXISTS invoice_lines (
   totale_riga NUMERIC(12,2)
 );
 
+-- SHA-256 del file (layout S3 indirizzato per contenuto); ADD COLUMN per i DB già creati
+ALTER TABLE invoices ADD COLUMN IF NOT EXISTS content_sha256 TEXT;
+
 CREATE INDEX IF NOT EXISTS idx_invoices_s3key ON invoices (s3_key);
+CREATE INDEX IF NOT EXISTS idx_invoices_sha256 ON invoices (content_sha256);
 CREATE INDEX IF NOT EXISTS idx_invoices_piva ON invoices (partita_iva);
 CREATE INDEX IF NOT EXISTS idx_invoices_issue_date ON invoices (issue_date);
 SQL
\ No newline at end of file
@@ -15,6 +15,24 @@ export type InvoiceListResponse = {
   offset: number
 }
 
+// URL firmati di una fattura (POST /invoices/presign)
+export type PresignedInvoiceUrls = {
+  id: string
+  download?: string | null
+  preview?: string | null
+  expires_in: number
+}
+
+export type PresignBatchResponse = {
+  items: PresignedInvoiceUrls[]
+  missing: string[]
+}
+
+// Riga NDJSON di /invoices/extract/batch: una fattura estratta oppure un errore
+export type BatchResult =
+  | { id: string; filename?: string | null; fields: Record<string, unknown>; righe?: unknown[] }
+  | { filename?: string | null; error: string }
+
 const API_BASE =
   (import.meta.env.VITE_API_BASE_URL as string | undefined)?.replace(/\/$/, "") ||
   "http://localhost:8000"
@@ -46,4 +64,40 @@ export const api = {
     )
     return data.url
   },
+  // URL di download/anteprima per una pagina intera della lista in una sola
+  // richiesta (invece di una getInvoiceDownloadUrl per riga)
+  presignInvoices: (
+    ids: string[],
+    opts?: { expires_in?: number; download?: boolean; preview?: boolean }
+  ) =>
+    http<PresignBatchResponse>(`/api/v1/invoices/presign`, {
+      method: "POST",
+      body: JSON.stringify({ ids, expires_in: opts?.expires_in ?? 900, download: opts?.download ?? true, preview: opts?.preview ?? true }),
+    }),
+  // Più file in una sola richiesta: `onResult` viene chiamata per ogni riga
+  // man mano che il server la invia (ordine di completamento, non di invio)
+  extractBatch: async (files: File[], onResult: (r: BatchResult) => void) => {
+    const form = new FormData()
+    for (const f of files) form.append("files", f, f.name)
+    const res = await fetch(`${API_BASE}/api/v1/invoices/extract/batch`, { method: "POST", body: form })
+    if (!res.ok || !res.body) {
+      const text = await res.text().catch(() => "")
+      throw new Error(`HTTP ${res.status} ${res.statusText} - ${text}`)
+    }
+    const reader = res.body.getReader()
+    const decoder = new TextDecoder()
+    let buf = ""
+    for (;;) {
+      const { done, value } = await reader.read()
+      buf += decoder.decode(value, { stream: !done })
+      let nl: number
+      while ((nl = buf.indexOf("\n")) >= 0) {
+        const line = buf.slice(0, nl).trim()
+        buf = buf.slice(nl + 1)
+        if (line) onResult(JSON.parse(line) as BatchResult)
+      }
+      if (done) break
+    }
+    if (buf.trim()) onResult(JSON.parse(buf) as BatchResult)
+  },
 }
@@ -0,0 +1,32 @@
+import pytest
+
+from app.core.config import settings
+from app.services import extraction
+
+
+@pytest.fixture(autouse=True)
+def local_storage(monkeypatch, tmp_path):
+    # niente MinIO nei test: gli upload passano dal backend locale vero, in una
+    # directory per test (chiave degli URL firmati generata lì)
+    monkeypatch.setattr(settings, "storage_backend", "local")
+    monkeypatch.setattr(settings, "storage_local_root", str(tmp_path / "storage"))
+    monkeypatch.setattr(settings, "storage_local_url", "http://test/api/v1/files")
+    return tmp_path / "storage"
+
+
+@pytest.fixture(autouse=True)
+def repository(monkeypatch):
+    # niente Postgres nei test: le fatture "salvate" finiscono in questa lista,
+    # con lo stesso contratto di insert_invoices_batch (item consumati, hook
+    # prima del commit)
+    saved = []
+
+    def insert_invoices_batch(items, page_size=500, before_commit=None):
+        batch = list(items)
+        if before_commit is not None:
+            before_commit()
+        saved.extend(batch)
+        return len(batch)
+
+    monkeypatch.setattr(extraction, "insert_invoices_batch", insert_invoices_batch)
+    return saved
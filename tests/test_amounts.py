@@ -0,0 +1,76 @@
+import random
+
+from app.services.parsers.amounts import reconcile
+
+
+def _cubic_bottom(values):
+    # vecchia enumerazione di _assign_from_bottom (riferimento)
+    best = {"iva": None, "imponibile": None, "totale": None}
+    best_err = 1e9
+    n = len(values)
+    for i in range(n):
+        for j in range(i + 1, n):
+            for k in range(j + 1, n):
+                a, b, c = values[i], values[j], values[k]
+                for iva, imp, tot in ((a, b, c), (a, c, b), (b, a, c), (b, c, a), (c, a, b), (c, b, a)):
+                    if tot < imp or tot < iva:
+                        continue
+                    if tot > 50 and iva < 1:
+                        continue
+                    err = abs((imp + iva) - tot)
+                    if err <= 0.05 and tot >= imp > 0 and iva > 0:
+                        if err < best_err or (abs(err - best_err) <= 0.001 and tot > (best["totale"] or 0)):
+                            best = {"iva": round(iva, 2), "imponibile": round(imp, 2), "totale": round(tot, 2)}
+                            best_err = err
+    return best
+
+
+def _cubic_sorted(vals):
+    # vecchia enumerazione su importi unici ordinati (riferimento)
+    best = {"iva": None, "imponibile": None, "totale": None}
+    best_err = 1e9
+    m = len(vals)
+    for i in range(m):
+        for j in range(i + 1, m):
+            for k in range(j + 1, m):
+                iva, imp, tot = vals[i], vals[j], vals[k]
+                if tot < imp or tot < iva:
+                    continue
+                if tot > 50 and iva < 1:
+                    continue
+                err = abs((imp + iva) - tot)
+                if err <= 0.05 and tot >= imp > 0 and iva > 0:
+                    if err < best_err or (abs(err - best_err) <= 0.001 and tot > (best["totale"] or 0)):
+                        best = {"iva": iva, "imponibile": imp, "totale": tot}
+                        best_err = err
+    return best
+
+
+def _random_amounts(rng, n):
+    out = []
+    for _ in range(n):
+        r = rng.random()
+        if r < 0.3 and len(out) >= 2:
+            # somma (quasi) esatta di due importi già presenti
+            a, b = rng.sample(out, 2)
+            out.append(round(a + b + rng.choice([0, 0, 0.01, -0.02, 0.05, 0.06]), 2))
+        elif r < 0.4 and out:
+            out.append(rng.choice(out))  # duplicato
+        else:
+            out.append(round(rng.choice([rng.uniform(0, 2), rng.uniform(0, 100), rng.uniform(0, 5000)]), 2))
+    return out
+
+
+def test_reconcile_matches_cubic_reference():
+    rng = random.Random(1234)
+    for _ in range(400):
+        values = _random_amounts(rng, rng.randint(0, 14))
+        assert reconcile(values, permutations=True) == _cubic_bottom(values), values
+        vals = sorted(set(values))
+        assert reconcile(vals, permutations=False) == _cubic_sorted(vals), vals
+
+
+def test_reconcile_invoice_triple():
+    # come il vecchio ciclo: i ruoli iva/imponibile li sistema poi _parse_from_text
+    assert reconcile([1000.0, 220.0, 1220.0, 2.0]) == {"iva": 1000.0, "imponibile": 220.0, "totale": 1220.0}
+    assert reconcile([220.0, 1000.0, 1220.0], permutations=False) == {"iva": 220.0, "imponibile": 1000.0, "totale": 1220.0}
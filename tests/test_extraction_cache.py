@@ -0,0 +1,78 @@
+import pytest
+
+from app.services import extraction_cache
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def cache():
+    extraction_cache.set_redis_client(fakeredis.FakeRedis())
+    extraction_cache.clear_local()
+    yield extraction_cache
+    extraction_cache.clear_local()
+    extraction_cache.set_redis_client(None)
+
+
+def _parse(calls):
+    def parse(data):
+        calls.append(data)
+        return {"fields": {"totale": 12.5}, "righe": []}
+    return parse
+
+
+def test_hit_after_miss(cache):
+    calls = []
+    first = cache.get_or_parse("pdf", b"abc", _parse(calls))
+    first["fields"]["totale"] = 0  # il chiamante modifica il risultato
+    again = cache.get_or_parse("pdf", b"abc", _parse(calls))
+    assert again["fields"]["totale"] == 12.5
+    assert len(calls) == 1
+    assert cache.stats()["hits_local"] == 1
+
+    cache.clear_local()
+    cache.get_or_parse("pdf", b"abc", _parse(calls))
+    assert len(calls) == 1
+    assert cache.stats()["hits_redis"] == 1
+
+
+def test_parser_version_invalidates(cache, monkeypatch):
+    calls = []
+    cache.get_or_parse("xml", b"<x/>", _parse(calls))
+    monkeypatch.setattr(extraction_cache, "PARSER_VERSION", "test-bump")
+    cache.get_or_parse("xml", b"<x/>", _parse(calls))
+    assert len(calls) == 2
+    # anche le impostazioni OCR che cambiano l'output fanno parte della chiave
+    monkeypatch.setattr(extraction_cache.settings, "ocr_threshold", "sauvola")
+    cache.get_or_parse("xml", b"<x/>", _parse(calls))
+    assert len(calls) == 3
+
+
+def test_lru_eviction(cache, monkeypatch):
+    monkeypatch.setattr(extraction_cache.settings, "extract_cache_lru_size", 2)
+    calls = []
+    for data in (b"a", b"b", b"c"):
+        cache.get_or_parse("pdf", data, _parse(calls))
+    assert cache.stats()["local_entries"] == 2
+
+
+def test_streamed_documents_are_cached_after_a_full_read(cache, monkeypatch):
+    read = []
+
+    def iterate(data):
+        for i in range(3):
+            read.append(i)
+            yield {"fields": {"n": i}, "righe": []}
+
+    docs = cache.iter_or_parse("xml", b"<lotto/>", iterate)
+    assert next(docs)["fields"]["n"] == 0 and read == [0]  # un body alla volta
+    docs.close()  # lettura interrotta (es. insert fallito): niente in cache
+    assert [d["fields"]["n"] for d in cache.iter_or_parse("xml", b"<lotto/>", iterate)] == [0, 1, 2]
+    assert [d["fields"]["n"] for d in cache.iter_or_parse("xml", b"<lotto/>", iterate)] == [0, 1, 2]
+    assert read == [0, 0, 1, 2]
+
+    # oltre la dimensione massima di una voce si legge sempre dal parser
+    monkeypatch.setattr(extraction_cache.settings, "extract_cache_max_entry_bytes", 40)
+    for _ in range(2):
+        assert len(list(cache.iter_or_parse("xml", b"<grande/>", iterate))) == 3
+    assert len(read) == 10
@@ -0,0 +1,145 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app.api.v1.routers import health
+from app.main import app
+from app.services import extraction, extraction_executor, ocr_executor
+
+
+def slow_parse(kind, data):
+    # gira nei processi del pool: CPU pura, come una pagina in OCR
+    end = time.perf_counter() + 1.5
+    while time.perf_counter() < end:
+        sum(range(1000))
+    return {"fields": {"totale": 1.0}, "righe": []}
+
+
+@pytest.mark.asyncio
+async def test_health_stays_fast_during_extractions(monkeypatch):
+    monkeypatch.setattr(ocr_executor.settings, "ocr_workers", 3)
+    monkeypatch.setattr(extraction_executor.settings, "extract_max_inflight", 3)
+    monkeypatch.setattr(extraction_executor.settings, "extract_cache_enabled", False)
+    monkeypatch.setattr(extraction_executor, "_parse", slow_parse)
+    monkeypatch.setattr(extraction, "upload_file", lambda key, path, content_type=None: {"bucket": "b", "key": key})
+    # health senza servizi esterni: si misura solo il tempo di risposta dell'app
+    monkeypatch.setattr(health, "execute", lambda q: None)
+    monkeypatch.setattr(health.storage, "ping", lambda: None)
+    ping = SimpleNamespace(ping=lambda: True)
+    monkeypatch.setattr(health, "redis", SimpleNamespace(Redis=SimpleNamespace(from_url=lambda *a, **k: ping)))
+
+    ocr_executor.start()
+    extraction_executor.start()
+    try:
+        # pool caldo prima di misurare
+        await extraction_executor.run_io(ocr_executor.submit(abs, -1).result)
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as ac:
+
+            async def extract(i):
+                return await ac.post(
+                    "/api/v1/invoices/extract",
+                    files={"file": (f"scan{i}.pdf", b"%PDF-1.4 fake", "application/pdf")},
+                )
+
+            async def health_latency():
+                t0 = time.perf_counter()
+                assert (await ac.get("/api/v1/health")).status_code == 200
+                return time.perf_counter() - t0
+
+            baseline = max([await health_latency() for _ in range(3)])
+            jobs = [asyncio.create_task(extract(i)) for i in range(3)]
+            await asyncio.sleep(0.1)
+            rejected = await extract(99)
+            during = []
+            while not all(j.done() for j in jobs):
+                during.append(await health_latency())
+                await asyncio.sleep(0.05)
+            responses = [await j for j in jobs]
+    finally:
+        extraction_executor.shutdown()
+        ocr_executor.shutdown()
+
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert rejected.status_code == 429 and rejected.headers["retry-after"]
+    assert len(during) >= 5
+    # con il parsing nell'event loop ogni health aspetterebbe 1.5 s di CPU
+    during.sort()
+    assert during[int(0.9 * len(during))] < baseline + 0.05
+    assert during[-1] < 1.0
+
+
+def test_upload_overlaps_parsing_and_orphans_are_deleted(monkeypatch):
+    deleted = []
+
+    def slow_upload(source, filename, content_type):
+        time.sleep(0.5)
+        return {"bucket": "b", "key": filename}
+
+    def slow_parse(kind, data):
+        time.sleep(0.5)
+        if data == b"bad":
+            raise ValueError("parse")
+        return {"fields": {"totale": 1.0}, "righe": []}
+
+    monkeypatch.setattr(extraction_executor.settings, "extract_cache_enabled", False)
+    monkeypatch.setattr(extraction_executor, "_parse", slow_parse)
+    monkeypatch.setattr(extraction, "store_upload", slow_upload)
+    monkeypatch.setattr(extraction, "delete_object", lambda key, bucket=None: deleted.append(key))
+
+    extraction_executor.start()
+    try:
+        t0 = time.perf_counter()
+        out = extraction.extract_document(b"%PDF-1.4", "ok.pdf", "application/pdf")
+        elapsed = time.perf_counter() - t0
+        with pytest.raises(ValueError):
+            extraction.extract_document(b"bad", "bad.pdf", "application/pdf")
+    finally:
+        extraction_executor.shutdown()
+
+    assert out[0].s3.key == "ok.pdf"
+    assert elapsed < 0.9  # in serie sarebbero 1.0 s
+    assert deleted == ["bad.pdf"]
+
+
+def test_pool_parse_has_own_queue_and_reports_spans(monkeypatch):
+    import threading
+
+    from app.services.parsers import invoice_pdf
+    from app.utils import timing
+
+    monkeypatch.setattr(ocr_executor.settings, "ocr_workers", 1)
+    monkeypatch.setattr(ocr_executor.settings, "ocr_queue_depth", 1)
+    with open("tests/data/invoice_sample.pdf", "rb") as f:
+        pdf = f.read()
+    ocr_executor.start()
+    try:
+        # coda OCR piena: il parsing usa la sua e non resta bloccato
+        assert ocr_executor._slots.acquire(blocking=False)
+        try:
+            with timing.collect() as rec:
+                out = extraction_executor.parse("pdf", pdf)
+        finally:
+            ocr_executor._slots.release()
+        assert ocr_executor.submit(ocr_executor.in_worker).result(timeout=60) is True
+    finally:
+        ocr_executor.shutdown()
+    assert out["fields"]["totale"] is not None
+    # span misurati nel processo del pool, riportati nella richiesta
+    assert {"parse", "pdfminer", "parse_text"} <= set(rec.as_dict())
+
+    # dentro un processo del pool le rotazioni vanno in thread paralleli
+    threads = set()
+
+    def rotated(img, angle, scored=False):
+        threads.add(threading.current_thread().name)
+        time.sleep(0.1)
+        return "", None
+
+    monkeypatch.setattr(invoice_pdf, "_ocr_rotated", rotated)
+    monkeypatch.setattr(ocr_executor, "_in_worker", True)
+    assert invoice_pdf._ocr_variants(None) == (0, "", None)
+    assert len(threads) == 3 and all(t.startswith("ocr-rotation") for t in threads)
@@ -0,0 +1,49 @@
+import shutil
+import zipfile
+
+import pytest
+
+from app.cli import ingest
+
+
+@pytest.fixture
+def archive(tmp_path):
+    src = tmp_path / "in"
+    (src / "2023").mkdir(parents=True)
+    shutil.copy("tests/data/invoice_sample.pdf", src / "a.pdf")
+    shutil.copy("fattura.xml", src / "2023" / "b.xml")
+    (src / "note.txt").write_text("non è una fattura")
+    return src
+
+
+def test_ingest_batches_and_resumes(archive, tmp_path, monkeypatch):
+    uploads, batches = [], []
+    monkeypatch.setattr(ingest, "upload_bytes", lambda key, data, content_type=None: uploads.append(key) or {"bucket": "b", "key": key})
+    monkeypatch.setattr(ingest, "insert_invoices_batch", lambda items: batches.append([it["source"] for it in items]))
+    ckpt = str(tmp_path / "ckpt")
+
+    report = ingest.run(str(archive), workers=0, batch_size=1, checkpoint=ckpt)
+    assert (report["ok"], report["errors"], report["skipped"]) == (2, 0, 0)
+    assert batches == [["a.pdf"], ["2023/b.xml"]]
+    assert report["pages"] >= 2 and len(uploads) == 2
+
+    report = ingest.run(str(archive), workers=0, checkpoint=ckpt)
+    assert (report["ok"], report["skipped"]) == (0, 2)
+    assert len(batches) == 2
+
+
+def test_ingest_failed_batch_is_not_checkpointed(archive, tmp_path, monkeypatch):
+    zpath = tmp_path / "in.zip"
+    with zipfile.ZipFile(zpath, "w") as zf:
+        for p in archive.rglob("*"):
+            if p.is_file():
+                zf.write(p, p.relative_to(archive).as_posix())
+    monkeypatch.setattr(ingest, "upload_bytes", lambda key, data, content_type=None: {"bucket": "b", "key": key})
+
+    def boom(items):
+        raise RuntimeError("db giù")
+
+    monkeypatch.setattr(ingest, "insert_invoices_batch", boom)
+    with pytest.raises(RuntimeError):
+        ingest.run(str(zpath), workers=0, batch_size=10)
+    assert ingest.load_checkpoint(str(zpath) + ".ingest-checkpoint") == set()
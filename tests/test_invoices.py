@@ -1,9 +1,10 @@
 import pytest
 from httpx import AsyncClient, ASGITransport
 from app.main import app  # apps/backend/app/main.py
+from app.services import storage
 
 @pytest.mark.asyncio
-async def test_extract_invoice_pdf():
+async def test_extract_invoice_pdf(repository):
     pdf_path = "tests/data/invoice_sample.pdf"
     with open(pdf_path, "rb") as f:
         file_bytes = f.read()
@@ -23,16 +24,280 @@ async def test_extract_invoice_pdf():
     assert "filename" in data
     assert "fields" in data
     assert "totale" in data["fields"]
+    # il file è davvero nello storage (backend locale dei test) e la fattura nel repository
+    assert storage.download_bytes(data["s3"]["key"], bucket=data["s3"]["bucket"]) == file_bytes
+    assert [it["header"]["id"] for it in repository] == [data["id"]]
 
 @pytest.mark.asyncio
-async def test_list_invoices():
+async def test_list_invoices(monkeypatch):
+    from decimal import Decimal
+
+    from app.services import invoice_service
+
+    queries = []
+    row = {
+        "id": "00000000-0000-0000-0000-000000000001", "filename": "a.pdf", "s3_bucket": "b", "s3_key": "invoices/a.pdf",
+        "invoice_number": "123", "issue_date": None, "due_date": None, "currency": None, "totale": Decimal("12.20"),
+    }
+
+    def execute(sql, params):
+        queries.append(params)
+        return [{"total": 1}] if "COUNT(*)" in sql else [row]
+
+    # senza DB reale: le query (e la conversione delle righe) sono quelle vere
+    monkeypatch.setattr(invoice_service, "execute", execute)
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as ac:
         # route senza slash finale per evitare 307
-        resp = await ac.get("/api/v1/invoices?limit=5&offset=0")
+        resp = await ac.get("/api/v1/invoices?limit=5&offset=0&q=123")
+
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["total"] == 1
+    assert data["items"][0]["totale"] == 12.2 and data["items"][0]["invoice_number"] == "123"
+    assert queries[0][-2:] == (5, 0) and queries[0][0] == "%123%"
+
+
+@pytest.mark.asyncio
+async def test_extract_invoice_timings():
+    with open("tests/data/invoice_sample.pdf", "rb") as f:
+        file_bytes = f.read()
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        resp = await ac.post(
+            "/api/v1/invoices/extract?timings=true",
+            files={"file": ("invoice.pdf", file_bytes, "application/pdf")},
+        )
+        hist = (await ac.get("/api/v1/debug/timings")).json()
+
+    assert resp.status_code == 200
+    timings = resp.json()["timings"]
+    assert {"read", "cache_get", "total"} <= set(timings)
+    assert "total;dur=" in resp.headers["server-timing"]
+    assert hist["read"]["count"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_extract_invoice_lotto(monkeypatch):
+    from app.services import extraction
+
+    with open("fattura.xml", "rb") as f:
+        xml = f.read()
+    start, end = xml.index(b"<FatturaElettronicaBody>"), xml.index(b"</FatturaElettronicaBody>") + len(b"</FatturaElettronicaBody>")
+    body = xml[start:end]
+    lotto = xml[:end] + body.replace(b"<Numero>123</Numero>", b"<Numero>124</Numero>") + xml[end:]
+    batches = []
+    monkeypatch.setattr(extraction, "insert_invoices_batch", lambda items: batches.append(list(items)))
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        resp = await ac.post("/api/v1/invoices/extract?timings=true", files={"file": ("lotto.xml", lotto, "application/xml")})
 
-    # in test mockiamo → 200, senza DB reale
     assert resp.status_code == 200
     data = resp.json()
-    assert "items" in data
-    assert "total" in data
+    assert [d["fields"]["invoice_number"] for d in data] == ["123", "124"]
+    assert "parse_xml" in data[0]["timings"]
+    assert len(data[1]["righe"]) == len(data[0]["righe"]) > 0
+    assert len(batches) == 1 and [it["header"]["id"] for it in batches[0]] == [d["id"] for d in data]
+
+
+def test_lotto_streams_into_chunked_inserts(monkeypatch):
+    from contextlib import contextmanager
+    from functools import partial
+    from types import SimpleNamespace
+
+    from app.services import extraction, repository_invoices
+
+    with open("fattura.xml", "rb") as f:
+        xml = f.read()
+    start, end = xml.index(b"<FatturaElettronicaBody>"), xml.index(b"</FatturaElettronicaBody>") + len(b"</FatturaElettronicaBody>")
+    lotto = xml[:start] + xml[start:end] * 120 + xml[end:]
+
+    parsed, inserted, transactions = [0], [], []
+
+    def counting(source):
+        for doc in extraction_iter(source):
+            parsed[0] += 1
+            yield doc
+
+    @contextmanager
+    def transaction():
+        transactions.append(1)
+        yield SimpleNamespace(execute=lambda *a: None)
+
+    def execute_values(cur, sql, rows, page_size):
+        if sql.startswith("INSERT INTO invoices "):
+            inserted.append((parsed[0], len(rows)))
+
+    extraction_iter = extraction.iter_invoices
+    monkeypatch.setattr(extraction, "iter_invoices", counting)
+    monkeypatch.setattr(repository_invoices, "transaction", transaction)
+    monkeypatch.setattr(repository_invoices.psycopg2.extras, "execute_values", execute_values)
+    monkeypatch.setattr(extraction, "insert_invoices_batch", partial(repository_invoices.insert_invoices_batch, page_size=50))
+
+    out = extraction.extract_document(lotto, "lotto.xml", "application/xml", s3={"bucket": "b", "key": "lotto.xml"})
+
+    assert len(out) == 120 and transactions == [1]
+    # un INSERT per blocco, e ogni blocco parte prima di leggere il successivo
+    assert inserted == [(50, 50), (100, 50), (120, 20)]
+
+
+@pytest.mark.asyncio
+async def test_extract_archive_ndjson(monkeypatch):
+    import io
+    import json
+    import os
+    import zipfile
+
+    from app.api.v1.routers import invoices
+    from app.services import extraction
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.write("tests/data/invoice_sample.pdf", "gennaio/a.pdf")
+        zf.write("fattura.xml", "gennaio/b.xml")
+        zf.writestr("gennaio/rotto.xml", b"<x/>")
+        zf.writestr("leggimi.txt", "non è una fattura")
+    # il PDF (~370 KB) oltre la soglia va su disco, gli XML restano in memoria
+    monkeypatch.setattr(invoices.settings, "archive_spool_bytes", 100_000)
+    sources = {}
+
+    def flaky(data, filename, content_type):
+        sources[filename] = data
+        if filename == "rotto.xml":
+            raise ValueError("XML non valido")
+        return extraction.extract_document(data, filename, content_type)
+
+    monkeypatch.setattr(invoices, "extract_document", flaky)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        resp = await ac.post(
+            "/api/v1/invoices/extract/archive",
+            files={"file": ("gennaio.zip", buf.getvalue(), "application/zip")},
+        )
+
+    assert resp.status_code == 200
+    rows = [json.loads(line) for line in resp.text.splitlines()]
+    by_entry = {r["entry"]: r for r in rows[:-1]}
+    assert by_entry["gennaio/b.xml"]["invoices"][0]["fields"]["invoice_number"] == "123"
+    assert by_entry["gennaio/a.pdf"]["status"] == "ok"
+    assert by_entry["gennaio/rotto.xml"] == {"entry": "gennaio/rotto.xml", "status": "error", "error": "ValueError: XML non valido"}
+    assert rows[-1] == {"summary": {"entries": 3, "ok": 2, "errors": 1, "skipped": 1}}
+    assert isinstance(sources["b.xml"], bytes) and isinstance(sources["rotto.xml"], bytes)
+    assert isinstance(sources["a.pdf"], str) and not os.path.exists(sources["a.pdf"])
+
+
+@pytest.mark.asyncio
+async def test_extract_batch_ndjson(monkeypatch):
+    import json
+
+    from app.services import extraction
+
+    monkeypatch.setattr(extraction, "upload_file", lambda key, path, content_type=None: {"bucket": "b", "key": key})
+    monkeypatch.setattr(extraction, "delete_object", lambda key, bucket=None: None)
+    with open("fattura.xml", "rb") as f:
+        xml = f.read()
+    with open("tests/data/invoice_sample.pdf", "rb") as f:
+        pdf = f.read()
+
+    from app.services import extraction_executor
+
+    monkeypatch.setattr(extraction_executor.settings, "extract_max_inflight", 2)
+    files = [
+        ("files", ("a.xml", xml, "application/xml")),
+        ("files", ("b.pdf", pdf, "application/pdf")),
+        ("files", ("c.xml", b"garbage", "application/xml")),
+    ]
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        # posti esauriti: batch e archivi rispondono 429 come /extract
+        held = extraction_executor.try_acquire(2)
+        try:
+            busy = await ac.post("/api/v1/invoices/extract/batch", files=files)
+            busy_zip = await ac.post(
+                "/api/v1/invoices/extract/archive", files={"file": ("a.zip", b"PK\x05\x06" + b"\0" * 18, "application/zip")}
+            )
+        finally:
+            extraction_executor.release(held)
+        resp = await ac.post("/api/v1/invoices/extract/batch", files=files)
+
+    assert busy.status_code == busy_zip.status_code == 429 and busy.headers["retry-after"]
+    assert extraction_executor.stats()["inflight"] == 0
+    assert resp.status_code == 200
+    rows = {r["filename"]: r for r in map(json.loads, resp.text.splitlines())}
+    assert rows["a.xml"]["fields"]["invoice_number"] == "123"
+    assert "totale" in rows["b.pdf"]["fields"]
+    assert rows["c.xml"]["error"].startswith("ValueError")
+
+
+@pytest.mark.asyncio
+async def test_extract_rejects_oversized_upload(monkeypatch):
+    from app.core.config import settings
+
+    monkeypatch.setattr(settings, "max_upload_bytes", 1000)
+
+    async def chunked():
+        # multipart valido ma senza Content-Length: il limite scatta in lettura
+        yield b'--xyz\r\nContent-Disposition: form-data; name="file"; filename="big.pdf"\r\n\r\n'
+        for _ in range(4):
+            yield b"x" * 500
+        yield b"\r\n--xyz--\r\n"
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        declared = await ac.post("/api/v1/invoices/extract", files={"file": ("big.pdf", b"x" * 2000, "application/pdf")})
+        streamed = await ac.post(
+            "/api/v1/invoices/extract",
+            content=chunked(),
+            headers={"content-type": "multipart/form-data; boundary=xyz"},
+        )
+    assert declared.status_code == 413
+    assert streamed.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_presign_batch(monkeypatch):
+    from app.services import invoice_service
+
+    known = "00000000-0000-0000-0000-000000000001"
+    missing = "00000000-0000-0000-0000-000000000002"
+    queries = []
+
+    def refs(ids):
+        queries.append(ids)
+        return {known: {"filename": "a.pdf", "s3": {"bucket": "b", "key": "invoices/a.pdf"}}}
+
+    monkeypatch.setattr(invoice_service, "_s3_refs", refs)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        resp = await ac.post("/api/v1/invoices/presign", json={"ids": [known, missing, known], "expires_in": 600})
+
+    assert resp.status_code == 200
+    body = resp.json()
+    assert queries == [[known, missing]]
+    assert body["missing"] == [missing]
+    assert [it["id"] for it in body["items"]] == [known]
+    assert "invoices/a.pdf" in body["items"][0]["download"] and body["items"][0]["preview"]
+
+
+def test_presigned_urls_are_cached(monkeypatch):
+    from types import SimpleNamespace
+
+    from app.services import invoice_service
+
+    signed = []
+    monkeypatch.setattr(invoice_service, "presigned_url", lambda b, k, e, **p: signed.append(k) or f"url-{len(signed)}")
+    monkeypatch.setattr(invoice_service.settings, "presign_cache_reuse", 0.5)
+    clock = [1000.0]
+    monkeypatch.setattr(invoice_service, "time", SimpleNamespace(time=lambda: clock[0]))
+
+    first = invoice_service._presign_cached("b", "k", 900, {})
+    clock[0] += 300
+    again = invoice_service._presign_cached("b", "k", 900, {})
+    clock[0] += 200  # oltre metà validità: si rifirma
+    fresh = invoice_service._presign_cached("b", "k", 900, {})
+
+    assert first == ("url-1", 900)
+    assert again == ("url-1", 600)
+    assert fresh == ("url-2", 900)
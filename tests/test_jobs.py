@@ -0,0 +1,100 @@
+import pytest
+from httpx import ASGITransport, AsyncClient
+
+from app.cli import worker
+from app.main import app
+from app.services import jobs, storage
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def queue():
+    # oggetti nello storage locale e fatture nel repository finto dei test (conftest)
+    jobs.set_redis_client(fakeredis.FakeRedis())
+    yield
+    jobs.set_redis_client(None)
+
+
+@pytest.mark.asyncio
+async def test_async_extract_job_roundtrip(queue):
+    with open("fattura.xml", "rb") as f:
+        xml = f.read()
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        resp = await ac.post("/api/v1/invoices/extract?async=1", files={"file": ("f.xml", xml, "application/xml")})
+        assert resp.status_code == 202
+        job_id = resp.json()["id"]
+        assert (await ac.get(f"/api/v1/invoices/jobs/{job_id}")).json()["status"] == "queued"
+
+        worker.run(concurrency=2, burst=True, poll_s=0.1)
+
+        job = (await ac.get(f"/api/v1/invoices/jobs/{job_id}")).json()
+        assert (await ac.get("/api/v1/invoices/jobs/nope")).status_code == 404
+    assert (job["status"], job["attempts"]) == ("done", 1)
+    assert job["result"][0]["fields"]["invoice_number"] == "123"
+    s3 = job["result"][0]["s3"]
+    assert storage.download_bytes(s3["key"], bucket=s3["bucket"]) == xml
+
+
+def test_job_retries_and_visibility_timeout(queue, monkeypatch):
+    monkeypatch.setattr(jobs.settings, "jobs_max_attempts", 2)
+    job_id = jobs.enqueue("x.pdf", "application/pdf", {"bucket": "b", "key": "manca"})
+
+    # primo tentativo: il worker "muore" senza chiudere il job
+    reserved_id, stale_token = jobs.reserve(timeout=0.1)
+    assert reserved_id == job_id and jobs.requeue_expired() == 0
+    assert jobs.requeue_expired(now=9e12) == 1
+    assert jobs.get(job_id)["status"] == "queued"
+
+    # secondo tentativo: il download fallisce e i tentativi sono finiti
+    worker.run(concurrency=1, burst=True, poll_s=0.1)
+    job = jobs.get(job_id)
+    assert (job["status"], job["attempts"]) == ("failed", 2)
+    assert "FileNotFoundError" in job["error"]
+    # il worker in ritardo non può più cambiare l'esito
+    assert not jobs.complete(job_id, stale_token, [])
+    assert jobs.stats() == {"queued": 0, "processing": 0}
+
+
+def test_heartbeat_keeps_long_job_reserved(queue, monkeypatch):
+    import threading
+    import time
+
+    monkeypatch.setattr(jobs.settings, "jobs_visibility_timeout", 0.3)
+    job_id = jobs.enqueue("lungo.xml", "application/xml", storage.upload_bytes("lungo.xml", b"<x/>"))
+    reserved = jobs.reserve(timeout=0.1)
+    monkeypatch.setattr(worker, "extract_document", lambda *a, **k: time.sleep(1.0) or [])
+
+    t = threading.Thread(target=lambda: reserved and worker.process(*reserved))
+    t.start()
+    # ben oltre la scadenza iniziale: il job resta del worker che lo sta elaborando
+    time.sleep(0.7)
+    assert jobs.requeue_expired() == 0
+    t.join()
+    job = jobs.get(job_id)
+    assert (job["status"], job["attempts"]) == ("done", 1)
+
+
+def test_content_addressed_job_keeps_sha256_and_restores_object(queue, repository, monkeypatch):
+    from app.services import extraction
+
+    monkeypatch.setattr(jobs.settings, "s3_content_addressed", True)
+    with open("fattura.xml", "rb") as f:
+        xml = f.read()
+    s3 = extraction.store_upload(xml, "f.xml", "application/xml")
+    job_id = jobs.enqueue("f.xml", "application/xml", s3)
+    assert jobs.get(job_id)["s3"] == s3
+
+    # un DELETE rilascia l'oggetto condiviso mentre il job è in lavorazione:
+    # prima del commit il worker lo ricarica dalla sua copia
+    fake_insert = extraction.insert_invoices_batch
+
+    def insert_after_release(items, **kw):
+        storage.delete_object(s3["key"], bucket=s3["bucket"])
+        return fake_insert(items, **kw)
+
+    monkeypatch.setattr(extraction, "insert_invoices_batch", insert_after_release)
+    out = extraction.extract_document(xml, "f.xml", "application/xml", s3=jobs.get(job_id)["s3"])
+    assert repository[0]["header"]["content_sha256"] == s3["sha256"] and out[0].s3.key == s3["key"]
+    assert storage.download_bytes(s3["key"], bucket=s3["bucket"]) == xml
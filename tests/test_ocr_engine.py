@@ -0,0 +1,54 @@
+import os
+import time
+
+from PIL import Image
+
+from app.services import ocr_engine, ocr_executor
+
+
+def test_engine_parses_config_and_falls_back(monkeypatch):
+    assert ocr_engine._parse_config("--psm 6 -c tessedit_char_whitelist=0123,.") == (
+        6, {"tessedit_char_whitelist": "0123,."}
+    )
+    calls = []
+    monkeypatch.setattr(ocr_engine, "_binding_ok", False)
+    monkeypatch.setattr(ocr_engine, "_lang", "eng")
+    monkeypatch.setattr(
+        ocr_engine.pytesseract, "image_to_string",
+        lambda img, lang, config: calls.append((lang, config)) or "ok",
+    )
+    assert ocr_engine.image_to_string(Image.new("1", (8, 8), 1), config="--psm 6") == "ok"
+    assert calls == [("eng", "--psm 6")] and ocr_engine.engine() == "pytesseract"
+
+
+def test_executor_restarts_broken_pool(monkeypatch):
+    monkeypatch.setattr(ocr_executor.settings, "ocr_workers", 2)
+    ocr_executor.start()
+    try:
+        # il processo che muore rompe il pool: il task in volo nell'altro
+        # processo si riprova nel pool nuovo, quello che lo uccide fallisce
+        assert ocr_executor.submit(abs, -1).result(timeout=60) == 1
+        in_flight = ocr_executor.submit(time.sleep, 2)
+        time.sleep(0.5)
+        crashed = ocr_executor.submit(os._exit, 1)
+        try:
+            crashed.result(timeout=60)
+        except Exception as e:
+            assert type(e).__name__ == "BrokenProcessPool"
+        assert in_flight.result(timeout=60) is None
+        restarts = ocr_executor._restarts
+        assert restarts >= 1
+        assert ocr_executor.submit(abs, -3).result(timeout=60) == 3
+        assert ocr_executor._restarts == restarts + 1
+
+        # coda piena: /health risponde "busy" senza attendere uno slot
+        held = 0
+        while ocr_executor._slots.acquire(blocking=False):
+            held += 1
+        try:
+            assert ocr_executor.health(timeout=1)["pool"] == "busy"
+        finally:
+            for _ in range(held):
+                ocr_executor._slots.release()
+    finally:
+        ocr_executor.shutdown()
@@ -0,0 +1,316 @@
+from io import BytesIO
+
+from PIL import Image
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+from app.services.parsers import invoice_pdf
+from app.services.parsers.invoice_pdf import parse_pdf_invoice
+
+
+def _pdf(pages):
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    _, h = A4
+    for rows in pages:
+        y = h - 50
+        for row in rows:
+            c.drawString(40, y, row)
+            y -= 18
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+HEADER = [
+    "Rossi Mario",
+    "Partita IVA 01234567890",
+    "Via Roma, 1 - 24100 Bergamo",
+    "Fattura 17 del 02/01/2024",
+    "Descrizione prestazioni professionali come da accordi presi in data odierna",
+    "Provvigioni per intermediazione in riferimento alla pratica numero 42",
+]
+TOTALS = ["Totale imponibile", "1.000,00", "Totale IVA", "220,00", "Totale documento", "1.220,00"]
+
+
+def test_multipage_totals_on_second_page():
+    data = _pdf([HEADER, ["Dettaglio righe " + "x" * 200] + TOTALS])
+    f = parse_pdf_invoice(data)["fields"]
+    assert f["invoice_number"] == "17"
+    assert (f["imponibile"], f["iva"], f["totale"]) == (1000.0, 220.0, 1220.0)
+
+
+def test_multipage_early_exit(monkeypatch):
+    seen = []
+    orig = invoice_pdf._iter_text_layer
+
+    def spy(file_bytes, max_pages=0):
+        for txt in orig(file_bytes, max_pages=max_pages):
+            seen.append(txt)
+            yield txt
+
+    monkeypatch.setattr(invoice_pdf, "_iter_text_layer", spy)
+    data = _pdf([HEADER + TOTALS, ["pagina di note " + "x" * 200]] * 3)
+    f = parse_pdf_invoice(data)["fields"]
+    assert f["totale"] == 1220.0
+    assert len(seen) == 1
+
+
+def test_ocr_orientation_probe(monkeypatch):
+    monkeypatch.setattr(invoice_pdf.settings, "ocr_adaptive_dpi", False)
+    calls = []
+    monkeypatch.setattr(invoice_pdf, "convert_from_bytes", lambda *a, **k: [Image.new("RGB", (40, 60), "white")])
+    monkeypatch.setattr(invoice_pdf, "_ocr_one", lambda img: calls.append(img.size) or "testo")
+
+    conf = {"value": 9.5}
+    monkeypatch.setattr(
+        invoice_pdf.pytesseract, "image_to_osd",
+        lambda img, output_type=None: {"rotate": 90, "orientation_conf": conf["value"]},
+    )
+    info = invoice_pdf._ocr_page(b"%PDF", 1)
+    assert (info["angle"], info["fallback"], len(calls)) == (270, False, 1)
+
+    calls.clear()
+    conf["value"] = 0.3
+    info = invoice_pdf._ocr_page(b"%PDF", 1)
+    assert info["fallback"] is True
+    assert len(calls) == 3
+
+
+def test_ocr_variants_first_plausible_matches_serial(monkeypatch):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    plausible = "\n".join(HEADER + TOTALS)
+    texts = {0: "rumore", 90: plausible, 270: plausible + "\nAltro testo ancora più lungo"}
+    started, release_90 = [], threading.Event()
+
+    def rotated(img, angle, scored=False):
+        started.append(angle)
+        if angle == 90:
+            release_90.wait(5)  # 270 finisce prima ma non deve vincere
+        return texts[angle], None
+
+    monkeypatch.setattr(invoice_pdf, "_ocr_rotated", rotated)
+    release_90.set()
+    serial = invoice_pdf._ocr_variants(None)
+    assert serial == (90, plausible, None) and started == [0, 90]
+
+    started.clear()
+    release_90.clear()
+    pool = ThreadPoolExecutor(max_workers=3)
+    monkeypatch.setattr(invoice_pdf.ocr_executor, "is_running", lambda: True)
+    monkeypatch.setattr(invoice_pdf.ocr_executor, "submit", pool.submit)
+    threading.Timer(0.2, release_90.set).start()
+    try:
+        assert invoice_pdf._ocr_variants(None) == serial
+        assert sorted(started) == [0, 90, 270]
+    finally:
+        release_90.set()
+        pool.shutdown(wait=True)
+
+
+def test_ocr_adaptive_dpi_escalation(monkeypatch):
+    dpis = []
+
+    def render(*a, dpi=300, **k):
+        dpis.append(dpi)
+        return [Image.new("RGB", (40, 60), "white")]
+
+    monkeypatch.setattr(invoice_pdf, "convert_from_bytes", render)
+    monkeypatch.setattr(invoice_pdf, "_probe_orientation", lambda img, dpi=300: (0, 10.0))
+    conf = {150: 40.0, 300: 91.0}
+    monkeypatch.setattr(invoice_pdf, "_ocr_one_scored", lambda img: ("testo", conf[dpis[-1]]))
+
+    info = invoice_pdf._ocr_page(b"%PDF", 1)
+    assert dpis == [150, 300]
+    assert (info["dpi"], info["escalations"], info["word_conf"]) == (300, 1, 91.0)
+
+    dpis.clear()
+    conf[150] = 88.0
+    info = invoice_pdf._ocr_page(b"%PDF", 1)
+    assert dpis == [150]
+    assert (info["dpi"], info["escalations"]) == (150, 0)
+
+
+def test_preprocess_binarizes_once_for_all_rotations():
+    img = Image.new("L", (80, 40), 200)
+    img.paste(60, (10, 10, 50, 30))
+    for method in ("fixed", "otsu", "sauvola"):
+        g = invoice_pdf._preprocess(img, method)
+        assert (g.mode, g.size) == ("1", (120, 60))
+        assert g.getpixel((5, 5)) and not g.getpixel((45, 30))
+        assert invoice_pdf._rotate(g, 90).size == (60, 120)
+
+
+def test_preprocess_fixed_matches_legacy_pipeline():
+    import numpy as np
+    from PIL import ImageFilter, ImageOps
+
+    def legacy(img):
+        g = ImageOps.autocontrast(img.convert("L"))
+        w, h = g.size
+        g = g.resize((int(w*1.5), int(h*1.5))).filter(ImageFilter.SHARPEN)
+        return g.point(lambda p: 255 if p > 180 else 0)
+
+    rng = np.random.default_rng(0)
+    for lo, hi in ((0, 255), (40, 220), (90, 200), (128, 128)):
+        img = Image.fromarray(rng.integers(lo, hi + 1, (90, 70)).astype(np.uint8), "L")
+        for src in (img, img.convert("RGB")):
+            assert (np.asarray(legacy(src)) > 0).tolist() == np.asarray(invoice_pdf._preprocess(src, "fixed")).tolist()
+
+
+def test_ocr_roi_header_and_totals(monkeypatch):
+    monkeypatch.setattr(invoice_pdf.settings, "ocr_adaptive_dpi", False)
+    page = Image.new("L", (400, 600), "white")
+    for y in range(20, 580, 28):  # 20 "righe" di testo
+        page.paste(0, (20, y, 380, y + 12))
+    monkeypatch.setattr(invoice_pdf, "convert_from_bytes", lambda *a, **k: [page])
+    monkeypatch.setattr(invoice_pdf, "_probe_orientation", lambda img, dpi=300: (0, 10.0))
+
+    calls = []
+    totals = {"text": "1.000,00\n220,00\n1.220,00\n"}
+
+    def ocr(img, config=""):
+        calls.append((img.height, config))
+        if "whitelist" in config:
+            return totals["text"]
+        if img.height < page.height:
+            return "\n".join(HEADER[:4]) + "\n"
+        return "\n".join(HEADER + TOTALS)
+
+    monkeypatch.setattr(invoice_pdf, "_ocr_one", ocr)
+    info = invoice_pdf._ocr_page(b"%PDF", 1)
+    assert info["roi"] is True and len(calls) == 2
+    f = invoice_pdf._parse_from_text(info["text"])["fields"]
+    assert (f["imponibile"], f["iva"], f["totale"]) == (1000.0, 220.0, 1220.0)
+    # gli importi devono uscire dalle etichette esplicite, non dall'euristica
+    labels = invoice_pdf._totals_by_explicit_labels(invoice_pdf.DocIndex(info["text"]))
+    assert labels == {"imponibile": 1000.0, "iva": 220.0, "totale": 1220.0}
+
+    calls.clear()
+    totals["text"] = "17\n"
+    info = invoice_pdf._ocr_page(b"%PDF", 1)
+    assert info["roi"] is False and len(calls) == 3
+    assert "Totale documento" in info["text"]
+
+
+def test_xml_streaming_first_match_and_lines():
+    from app.services.parsers.invoice_xml import iter_fatturapa, parse_xml_fatturapa
+
+    riga = "<DettaglioLinee><Descrizione>r{0}</Descrizione><Quantita>{0}</Quantita><PrezzoTotale>1,50</PrezzoTotale></DettaglioLinee>"
+    xml = (
+        '<p:FatturaElettronica xmlns:p="urn:x"><Anagrafica><Denominazione>no</Denominazione></Anagrafica>'
+        "<CedentePrestatore><IdFiscaleIVA><IdCodice>0123</IdCodice></IdFiscaleIVA>"
+        "<Anagrafica><Nome>Mario</Nome><Cognome>Rossi</Cognome></Anagrafica></CedentePrestatore>"
+        "<DatiGeneraliDocumento><Numero>7</Numero><ImportoTotaleDocumento>1.220,00</ImportoTotaleDocumento></DatiGeneraliDocumento>"
+        + "".join(riga.format(i) for i in range(1, 4))
+        + "</p:FatturaElettronica>"
+    ).encode()
+    events = list(iter_fatturapa(xml))
+    assert [k for k, _ in events] == ["riga", "riga", "riga", "fields"]
+    out = parse_xml_fatturapa(xml)
+    f = out["fields"]
+    assert (f["intestatario"], f["partita_iva"], f["invoice_number"], f["totale"]) == ("Mario Rossi", "IT0123", "7", 1220.0)
+    assert out["righe"][2] == {"descrizione": "r3", "qta": 3.0, "prezzo_unitario": 0.0, "aliquota_iva": 0.0, "totale_riga": 1.5}
+
+
+# ---- DocIndex contro la vecchia scansione riga per riga (prima dell'indice) ----
+
+def _old_looks_like_name(s):
+    from app.services.parsers.common import is_noise_name
+
+    s = s.strip()
+    if is_noise_name(s):
+        return False
+    words = [w for w in s.split() if w.isalpha()]
+    return 2 <= len(words) <= 4 and sum(ch.isdigit() for ch in s) == 0
+
+
+def _old_intestatario(ll, idx_piva):
+    if idx_piva is not None:
+        for j in range(idx_piva - 1, max(idx_piva - 6, -1), -1):
+            if _old_looks_like_name(ll[j]):
+                return ll[j]
+    idx_cliente = next((i for i, l in enumerate(ll) if "cliente" in l.lower()), None)
+    for i, cand in enumerate(ll):
+        if idx_cliente is not None and abs(i - idx_cliente) <= 2:
+            continue
+        if _old_looks_like_name(cand):
+            return cand
+    return None
+
+
+def _old_invoice_number(ll):
+    p = invoice_pdf
+    for i, l in enumerate(ll):
+        if "fattura" in l.lower():
+            m = p.RE_FATTURA_ONELINE.search(l)
+            if m:
+                cand = m.group(1).strip()
+                if cand and not p.DATE_LIKE.match(cand) and "." not in cand and p.CAND_INVOICE.match(cand):
+                    return cand
+            for nxt in ll[i + 1:i + 5]:
+                if not p.DATE_LIKE.match(nxt) and "." not in nxt and not any(lbl in nxt.lower() for lbl in p.LABELY):
+                    if p.CAND_INVOICE.match(nxt):
+                        return nxt
+    return None
+
+
+def _old_amount_in_line(s):
+    for m in invoice_pdf.RE_AMOUNT.finditer(s):
+        if not invoice_pdf._is_amount_inside_date(s, m.start(1), m.end(1)):
+            return invoice_pdf._to_float(invoice_pdf._clean_amount(m.group(1)))
+    return None
+
+
+def _old_amount_after_label(ll, labels, role):
+    for i, line in enumerate(ll):
+        if any(lbl in line.lower() for lbl in labels):
+            steps, j, cands = 0, i + 1, []
+            while j < len(ll) and steps < 8:
+                if "%" in ll[j] and not invoice_pdf.RE_AMOUNT.search(ll[j]):
+                    j += 1
+                    continue
+                v = _old_amount_in_line(ll[j])
+                if v is not None:
+                    cands.append(v)
+                steps += 1
+                j += 1
+            if cands:
+                return min(cands) if role == "iva" else max(cands)
+    return None
+
+
+def _old_amount_pairs(ll):
+    out = []
+    for i, line in enumerate(ll):
+        for m in invoice_pdf.RE_AMOUNT.finditer(line):
+            if not invoice_pdf._is_amount_inside_date(line, m.start(1), m.end(1)):
+                out.append((i, invoice_pdf._to_float(invoice_pdf._clean_amount(m.group(1)))))
+    return out
+
+
+def test_doc_index_matches_line_scan():
+    from pathlib import Path
+
+    sample = (Path(__file__).parent / "data" / "invoice_sample.pdf").read_bytes()
+    texts = [
+        "\n".join(HEADER + TOTALS),
+        "\n".join(TOTALS[::-1] + HEADER),
+        invoice_pdf._extract_text_pdfminer(sample),
+        "Cliente\nBianchi Luca\nVia Verdi 3\nMario Rossi\nP.IVA 01234567890\nFattura\n12/2024\n"
+        "Data 01.02.2024\nTotale imponibile\nIVA 22 %\n2.500,00\nTotale IVA\n550,00\n"
+        "Totale fattura 3.050,00 del 01.02.2024\nNetto a pagare\n3 050,00\n",
+        "Fattura n. A12 del 05/06/2023\nStudio Associato Neri Gialli\n1.234,56 15.03.23 99,00\n",
+    ]
+    for text in texts:
+        idx = invoice_pdf.DocIndex(text)
+        ll = idx.lines
+        assert idx.amount_pairs() == _old_amount_pairs(ll)
+        assert invoice_pdf._guess_intestatario(idx, idx.idx_piva) == _old_intestatario(ll, idx.idx_piva)
+        assert invoice_pdf._invoice_number_from_lines(idx) == _old_invoice_number(ll)
+        labels = invoice_pdf._totals_by_explicit_labels(idx)
+        for role, names in (("imponibile", invoice_pdf.LABELS_IMPONIBILE), ("iva", invoice_pdf.LABELS_IVA),
+                            ("totale", invoice_pdf.LABELS_TOTALE)):
+            assert labels[role] == _old_amount_after_label(ll, names, role)
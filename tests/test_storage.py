@@ -0,0 +1,110 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from app.services import extraction, storage
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+
+    def head_bucket(self, Bucket):
+        return {}
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"ResponseMetadata": {"HTTPStatusCode": 404}}, "HeadObject")
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.puts += 1
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_content_addressed_upload_skips_existing_objects(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(storage.settings, "storage_backend", "s3")
+    monkeypatch.setattr(storage, "s3_client", lambda endpoint=None: s3)
+    monkeypatch.setattr(extraction.settings, "s3_content_addressed", True)
+
+    first = extraction.store_upload(b"%PDF-1.4 stessa fattura", "a.pdf", "application/pdf")
+    again = extraction.store_upload(b"%PDF-1.4 stessa fattura", "copia.pdf", "application/pdf")
+    other = extraction.store_upload(b"%PDF-1.4 altra fattura", "b.pdf", "application/pdf")
+
+    assert first == again
+    assert first["key"] == storage.content_key(first["sha256"])
+    assert other["key"] != first["key"]
+    assert s3.puts == 2
+
+
+def test_clients_are_shared_per_endpoint(monkeypatch):
+    monkeypatch.setattr(storage.settings, "storage_backend", "s3")
+    monkeypatch.setattr(storage, "S3_PUBLIC_ENDPOINT", "http://public.example:9000")
+    storage.close_clients()
+    try:
+        internal = storage.s3_client()
+        assert storage.s3_client() is internal
+        assert internal.meta.config.max_pool_connections == storage.settings.s3_max_pool_connections
+        assert storage.signing_client() is not internal
+        assert storage.signing_client() is storage.signing_client()
+        url = storage.presigned_url("b", "k.pdf", 60, ResponseContentType="application/pdf")
+        assert url.startswith("http://public.example:9000/b/k.pdf?")
+    finally:
+        storage.close_clients()
+
+
+@pytest.mark.asyncio
+async def test_local_backend_roundtrip_and_signed_urls(local_storage, tmp_path):
+    from httpx import ASGITransport, AsyncClient
+
+    from app.main import app
+    from app.services import invoice_service
+
+    upload = tmp_path / "upload.pdf"
+    upload.write_bytes(b"%PDF-1.4 dal disco")
+
+    from_bytes = extraction.store_upload(b"%PDF-1.4 in memoria", "a.pdf", "application/pdf")
+    from_file = extraction.store_upload(str(upload), "b.pdf", "application/pdf")
+    assert storage.download_bytes(from_file["key"], bucket=from_file["bucket"]) == b"%PDF-1.4 dal disco"
+    assert open(storage.local_path(from_bytes["key"]), "rb").read() == b"%PDF-1.4 in memoria"
+
+    url, ttl = invoice_service.presign_preview(from_file, "b.pdf", 600)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        ok = await ac.get(url)
+        tampered = await ac.get(url.replace("expires=", "expires=9"))
+        storage.delete_object(from_file["key"], bucket=from_file["bucket"])
+        gone = await ac.get(url)
+
+    assert ttl == 600
+    assert ok.status_code == 200 and ok.content == b"%PDF-1.4 dal disco"
+    assert ok.headers["content-type"] == "application/pdf"
+    assert ok.headers["content-disposition"] == 'inline; filename="b.pdf"'
+    assert tampered.status_code == 403
+    assert gone.status_code == 404
+    assert not storage.object_exists(from_file["key"], bucket=from_file["bucket"])
+
+
+def test_local_backend_secret_is_generated_or_refused(local_storage, monkeypatch):
+    import os
+    import stat
+
+    from app.services import storage_local
+
+    url = storage.presigned_url("b", "k.pdf", 60)
+    secret_file = local_storage / storage_local.SECRET_FILE
+    assert stat.S_IMODE(os.stat(secret_file).st_mode) == 0o600
+    # un altro processo (cache vuota) legge la stessa chiave
+    storage_local._secrets.clear()
+    _, query = url.split("?")
+    params = dict(p.split("=") for p in query.split("&"))
+    assert storage_local.verify("b", "k.pdf", int(params["expires"]), params["signature"])
+    assert storage_local.object_exists(storage_local.SECRET_FILE, bucket="b") is False
+
+    monkeypatch.setattr(storage.settings, "storage_local_secret", "change-me")
+    with pytest.raises(RuntimeError):
+        storage.check()
+    monkeypatch.setattr(storage.settings, "storage_local_secret", "una-chiave-vera")
+    storage.check()
+    assert not storage_local.verify("b", "k.pdf", int(params["expires"]), params["signature"])